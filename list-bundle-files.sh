@@ -0,0 +1,16 @@
+#!/bin/bash
+
+# Lists the files to add to a setup bundle, in the order they should be archived:
+# the manifest first, then the apt repository indexes and then everything else.
+# pi-top-usb-setup starts installing updates as soon as the indexes are extracted.
+#
+# Usage: list-bundle-files.sh <manifest> <setup folder> | tar --no-recursion -cf - -T -
+
+MANIFEST="${1:-pi-top-usb-setup-manifest.json}"
+SETUP_FOLDER="${2:-pi-top-usb-setup}"
+
+is_index=(-type f \( -name Packages -o -name Packages.gz -o -name Release \))
+
+echo "${MANIFEST}"
+find "${SETUP_FOLDER}" "${is_index[@]}"
+find "${SETUP_FOLDER}" ! \( "${is_index[@]}" \) | sort
@@ -31,10 +31,15 @@ def find_mount_point(device: str) -> str:
 @click.argument("mount_point_or_device", type=click.Path(exists=True), required=False)
 @click.option("--skip-dialog", is_flag=True)
 @click.option("--skip-update", is_flag=True)
+# Set when restarting after the app is updated, so that the new instance umounts them
+@click.option("--usb-drive", type=click.Path())
+@click.option("--mounted-image", type=click.Path())
 def main(
     mount_point_or_device,
     skip_dialog,
     skip_update,
+    usb_drive,
+    mounted_image,
 ) -> None:
     mount_point = mount_point_or_device
     if mount_point is None:
@@ -60,6 +65,10 @@ def main(
         logger.warning("'--skip-update' is deprecated; ignoring...")
     if mount_point:
         os.environ["PT_USB_SETUP_MOUNT_POINT"] = mount_point
+    if usb_drive:
+        os.environ["PT_USB_SETUP_USB_DRIVE"] = usb_drive
+    if mounted_image:
+        os.environ["PT_USB_SETUP_MOUNTED_IMAGE"] = mounted_image
 
     app = UsbSetupApp()
     app.start()
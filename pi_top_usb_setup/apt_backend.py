@@ -0,0 +1,158 @@
+import logging
+import os
+from pathlib import Path
+from typing import Any, Optional
+
+from pi_top_usb_setup.apt_status import package_phase
+from pi_top_usb_setup.exceptions import UnsupportedBackendError
+from pi_top_usb_setup.system_updater import (
+    OFFLINE_SOURCE_FILE,
+    CustomAptSource,
+    SystemUpdater,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _python_apt():
+    try:
+        import apt
+        import apt.progress.base
+        import apt_pkg
+
+        return apt, apt_pkg
+    except ImportError:
+        raise UnsupportedBackendError(
+            "The python-apt backend requires the 'python3-apt' package"
+        )
+
+
+def python_apt_available() -> bool:
+    try:
+        _python_apt()
+        return True
+    except UnsupportedBackendError:
+        return False
+
+
+def _install_progress(updater: "PythonAptUpdater"):
+    apt, _ = _python_apt()
+    base: Any = apt.progress.base.InstallProgress
+
+    class InstallProgress(base):
+        # Called with the same messages apt-get sends through APT::Status-Fd
+        def status_change(self, pkg, percent, status):
+            updater.timings.start(pkg, package_phase(status))
+            if callable(updater.on_progress):
+                updater.on_progress(float(percent))
+
+        def error(self, pkg, errormsg):
+            logger.error(f"Error installing {pkg}: {errormsg}")
+            if callable(updater.on_error):
+                updater.on_error(errormsg)
+
+        def conffile(self, current, new):
+            # dpkg is told to keep the current configuration files
+            logger.warning(f"Configuration file {current} changed")
+
+    return InstallProgress()
+
+
+class PythonAptUpdater(SystemUpdater):
+    """SystemUpdater that runs apt in-process with python-apt instead of running
+    apt-get for every step.
+
+    The package cache is loaded once and shared by 'update', 'upgrade_package' and
+    'upgrade'; it's only read again after apt changes the lists or the installed
+    packages. Package files are waited for before installing, since apt needs all of
+    them to start."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._apt, self._apt_pkg = _python_apt()
+        self._cache: Optional[Any] = None
+
+    def _configure(self) -> None:
+        # Same options the apt-get commands get
+        config = self._apt_pkg.config
+        if self.apt_repository:
+            config.set("Dir::Etc::sourcelist", OFFLINE_SOURCE_FILE)
+            config.set("Dir::Etc::sourceparts", "-")
+            config.set("APT::Get::List-Cleanup", "0")
+        # Keep current configuration files, there's no one to ask
+        config.set("DPkg::Options::", "--force-confdef")
+        config.set("DPkg::Options::", "--force-confold")
+        if self.profile.unsafe_io:
+            config.set("DPkg::Options::", "--force-unsafe-io")
+        if self.profile.defer_triggers:
+            config.set("DPkg::NoTriggers", "true")
+            config.set("DPkg::ConfigurePending", "false")
+            config.set("DPkg::TriggersPending", "false")
+        os.environ["DEBIAN_FRONTEND"] = "noninteractive"
+
+    def _open_cache(self):
+        if self._cache is None:
+            self._configure()
+            self._cache = self._apt.Cache()
+        return self._cache
+
+    def _update_lists(self) -> None:
+        with CustomAptSource(self.apt_repository, self.package_cache) as apt_source:
+            cache = self._open_cache()
+            self._wait_for_lock()
+            if apt_source:
+                # Only the offline repository is read
+                cache.update(sources_list=apt_source)
+            else:
+                cache.update()
+            cache.open()
+        self._simulations.clear()
+
+    def _commit(self, cache) -> None:
+        changes = cache.get_changes()
+        if not changes:
+            logger.info("Nothing to install")
+            return
+
+        if self.apt_repository and callable(self.wait_for_file):
+            for package in changes:
+                if package.marked_delete:
+                    continue
+                path = Path(self.apt_repository) / package.candidate.filename
+                if not self.wait_for_file(path):
+                    raise Exception(f"Package file '{path}' doesn't exist")
+
+        logger.info(f"Installing {len(changes)} packages")
+        self._wait_for_lock()
+        self._simulations.clear()
+        if not cache.commit(install_progress=_install_progress(self)):
+            raise Exception("apt couldn't install the packages")
+        # The installed packages changed
+        cache.open()
+
+    def upgrade_package(self, package_name) -> None:
+        if package_name in self.held_back:
+            logger.warning(f"'{package_name}' is held back; not upgrading it")
+            return
+        try:
+            with CustomAptSource(self.apt_repository, self.package_cache):
+                cache = self._open_cache()
+                cache[package_name].mark_install()
+                self._commit(cache)
+            self._configure_unpacked()
+        finally:
+            self._save_timings()
+
+    def upgrade(self) -> None:
+        try:
+            with CustomAptSource(self.apt_repository, self.package_cache):
+                cache = self._open_cache()
+                cache.upgrade(dist_upgrade=True)
+                # Only marked in the cache, so nothing is left held after the upgrade
+                for name in self.held_back:
+                    if name in cache:
+                        cache[name].mark_keep()
+                self._commit(cache)
+            self._finish_install()
+        finally:
+            self._save_timings()
@@ -0,0 +1,193 @@
+import hashlib
+import re
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# Checksum fields of a 'Release' file, and the algorithm of each of them
+RELEASE_CHECKSUMS = {
+    "MD5Sum": "md5",
+    "SHA1": "sha1",
+    "SHA256": "sha256",
+    "SHA512": "sha512",
+}
+
+
+def split_paragraphs(content: str) -> List[str]:
+    """Splits the content of an index into its paragraphs, as they're written"""
+    return [paragraph for paragraph in content.split("\n\n") if paragraph.strip()]
+
+
+def parse_paragraph(paragraph: str) -> Dict[str, str]:
+    """Parses the fields of a paragraph. Multiline fields only keep their first line."""
+    fields = {}
+    for line in paragraph.splitlines():
+        if ":" in line and not line.startswith((" ", "\t")):
+            name, value = line.split(":", 1)
+            fields[name] = value.strip()
+    return fields
+
+
+def parse_packages_index(content: str) -> List[Dict[str, str]]:
+    """Parses the paragraphs of a 'Packages' index into dictionaries of fields"""
+    packages = [parse_paragraph(paragraph) for paragraph in split_paragraphs(content)]
+    return [fields for fields in packages if fields]
+
+
+def read_packages_index(packages_file: Path) -> Dict[Tuple[str, str], str]:
+    """Returns the file of each package in a 'Packages' index, by name and version"""
+    files = {}
+    for fields in parse_packages_index(packages_file.read_text()):
+        try:
+            files[(fields["Package"], fields["Version"])] = fields["Filename"]
+        except KeyError:
+            continue
+    return files
+
+
+def package_hashes(content: str) -> Dict[str, str]:
+    """Returns the SHA256 of each package file in a 'Packages' index, by file name
+    relative to the repository"""
+    hashes = {}
+    for fields in parse_packages_index(content):
+        if "Filename" in fields and "SHA256" in fields:
+            hashes[str(Path(fields["Filename"]))] = fields["SHA256"]
+    return hashes
+
+
+# eg: 'libc6:any (>= 2.34) [arm64]'
+RELATION_REGEX = re.compile(
+    r"^\s*([^\s:(\[<]+)(?::\S+)?\s*(?:\(\s*(<<|<=|>=|>>|=|<|>)\s*([^)\s]+)\s*\))?"
+)
+
+# A package name, and a version constraint as an operator and a version
+Relation = Tuple[str, Optional[str], Optional[str]]
+
+
+def parse_relations(value: str) -> List[List[Relation]]:
+    """Parses a relationship field like 'Depends' into its relations, each of them a
+    list of alternatives. Architecture qualifiers and restrictions are left out."""
+    relations = []
+    for relation in value.split(","):
+        alternatives: List[Relation] = []
+        for alternative in relation.split("|"):
+            match = RELATION_REGEX.match(alternative)
+            if match:
+                name, operator, version = match.groups()
+                alternatives.append((name, operator, version))
+        if alternatives:
+            relations.append(alternatives)
+    return relations
+
+
+def package_relations(fields: Dict[str, str]) -> List[str]:
+    """Names of the packages that a package depends on or recommends, including all
+    the alternatives"""
+    names = []
+    for field in ("Pre-Depends", "Depends", "Recommends"):
+        for relation in parse_relations(fields.get(field, "")):
+            names += [name for name, _, _ in relation]
+    return names
+
+
+def _order(character: str) -> int:
+    # Sorting weight of a character in the non-digit parts of a version, as dpkg does
+    if character == "~":
+        return -1
+    if character.isdigit():
+        return 0
+    if character.isascii() and character.isalpha():
+        return ord(character)
+    return ord(character) + 256
+
+
+def _compare_part(version: str, other: str) -> int:
+    i = j = 0
+    while i < len(version) or j < len(other):
+        # Non-digit prefix, character by character; the end of the string sorts before
+        # anything but '~'
+        while (i < len(version) and not version[i].isdigit()) or (
+            j < len(other) and not other[j].isdigit()
+        ):
+            order = _order(version[i]) if i < len(version) else 0
+            other_order = _order(other[j]) if j < len(other) else 0
+            if order != other_order:
+                return order - other_order
+            i += 1
+            j += 1
+
+        # Numeric part
+        start, other_start = i, j
+        while i < len(version) and version[i].isdigit():
+            i += 1
+        while j < len(other) and other[j].isdigit():
+            j += 1
+        number = int(version[start:i] or 0)
+        other_number = int(other[other_start:j] or 0)
+        if number != other_number:
+            return number - other_number
+    return 0
+
+
+def _split_version(version: str) -> Tuple[int, str, str]:
+    epoch = 0
+    if ":" in version:
+        epoch_part, version = version.split(":", 1)
+        epoch = int(epoch_part) if epoch_part.isdigit() else 0
+    revision = ""
+    if "-" in version:
+        version, revision = version.rsplit("-", 1)
+    return epoch, version, revision
+
+
+def compare_versions(version: str, other: str) -> int:
+    """Compares two Debian package versions like 'dpkg --compare-versions' does.
+    Returns a negative number, zero or a positive number if 'version' is older than,
+    the same as or newer than 'other'."""
+    epoch, upstream, revision = _split_version(version)
+    other_epoch, other_upstream, other_revision = _split_version(other)
+    if epoch != other_epoch:
+        return epoch - other_epoch
+    return _compare_part(upstream, other_upstream) or _compare_part(
+        revision, other_revision
+    )
+
+
+def rewrite_release(content: str, files: Dict[str, bytes]) -> str:
+    """Updates the checksums of a 'Release' file for the new content of 'files', by
+    name. Other indexes listed in it are left out, since they don't match anymore."""
+    lines = []
+    algorithm = None
+    for line in content.splitlines():
+        if not line.startswith((" ", "\t")):
+            name = line.split(":", 1)[0]
+            algorithm = RELEASE_CHECKSUMS.get(name)
+            lines.append(line)
+            continue
+        if algorithm is None:
+            lines.append(line)
+            continue
+
+        parts = line.split()
+        if len(parts) != 3 or parts[2] not in files:
+            continue
+        data = files[parts[2]]
+        digest = hashlib.new(algorithm, data).hexdigest()
+        lines.append(f" {digest} {len(data):>16} {parts[2]}")
+    return "\n".join(lines) + "\n"
+
+
+def satisfies(version: str, operator: Optional[str], required: Optional[str]) -> bool:
+    """Whether 'version' meets a version constraint of a relation"""
+    if operator is None or required is None:
+        return True
+    result = compare_versions(version, required)
+    if operator == "=":
+        return result == 0
+    if operator == "<<":
+        return result < 0
+    if operator == ">>":
+        return result > 0
+    # '<' and '>' are obsolete forms of '<=' and '>='
+    if operator in ("<=", "<"):
+        return result <= 0
+    return result >= 0
@@ -0,0 +1,186 @@
+import json
+import logging
+import re
+from dataclasses import dataclass, field
+from enum import Enum
+from pathlib import Path
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class AptStatusType(Enum):
+    """Messages sent by apt through APT::Status-Fd
+    https://github.com/Debian/apt/blob/main/doc/progress-reporting.md"""
+
+    PM_STATUS = "pmstatus"
+    PM_ERROR = "pmerror"
+    PM_CONFFILE = "pmconffile"
+    DL_STATUS = "dlstatus"
+    MEDIA_CHANGE = "media-change"
+
+
+@dataclass
+class AptStatusEvent:
+    type: AptStatusType
+    # Package (which might be qualified with its architecture, eg: 'libc6:arm64'),
+    # configuration file or medium the message is about
+    subject: str
+    description: str
+    percentage: Optional[float] = None
+    # Drive to insert the medium into, for media changes
+    drive: Optional[str] = None
+
+
+# The subject can contain colons, so the percentage is what separates it from the
+# description, which can contain colons too
+STATUS_REGEX = re.compile(
+    r"^(pmstatus|pmerror|pmconffile|dlstatus|error):(.*?):(\d+(?:\.\d*)?):(.*)$"
+)
+# eg: 'processing: unpack: libc6:arm64'
+DPKG_PROCESSING_REGEX = re.compile(r"^processing: ([\w-]+): (.+)$")
+
+
+def parse_apt_status(line: str) -> Optional[AptStatusEvent]:
+    """Parses a message of apt's progress reporting protocol; returns None if it
+    isn't one"""
+    line = line.rstrip("\n")
+    if line.startswith("media-change:"):
+        parts = line.split(":", 3)
+        if len(parts) != 4:
+            return None
+        _, medium, drive, description = parts
+        return AptStatusEvent(
+            AptStatusType.MEDIA_CHANGE, medium, description.strip(), drive=drive
+        )
+
+    match = STATUS_REGEX.match(line)
+    if match is None:
+        return None
+    type, subject, percentage, description = match.groups()
+    # Older apt versions report errors as 'error'
+    if type == "error":
+        type = AptStatusType.PM_ERROR.value
+    return AptStatusEvent(
+        AptStatusType(type), subject, description.strip(), float(percentage)
+    )
+
+
+def parse_dpkg_status(line: str) -> Optional[Tuple[str, str]]:
+    """Parses the 'processing' messages of dpkg's --status-fd into the action
+    (eg: 'unpack', 'configure') and the package; returns None for other lines"""
+    match = DPKG_PROCESSING_REGEX.match(line.strip())
+    if match is None:
+        return None
+    action, package = match.groups()
+    return action, package
+
+
+def package_phase(description: str) -> Optional[str]:
+    """Phase of a package that a 'pmstatus' description is about"""
+    if description.startswith(("Preparing to configure", "Configuring")):
+        return "configure"
+    if description.startswith(("Preparing for removal", "Removing")):
+        return "remove"
+    if description.startswith(("Preparing", "Unpacking")):
+        return "unpack"
+    if description.startswith("Running") and "trigger" in description:
+        return "triggers"
+    # eg: 'Installed foo', 'Removed foo'
+    return None
+
+
+# dpkg actions, by the phase they're part of
+DPKG_PHASES = {
+    "install": "unpack",
+    "upgrade": "unpack",
+    "unpack": "unpack",
+    "configure": "configure",
+    "remove": "remove",
+    "purge": "remove",
+    "trigproc": "triggers",
+}
+
+
+@dataclass
+class PackageTimings:
+    """Time spent in each phase of the installation of every package.
+
+    The time between two status messages is attributed to the package and phase
+    announced by the first of them."""
+
+    # Seconds spent by phase, by package
+    packages: Dict[str, Dict[str, float]] = field(default_factory=dict)
+    _current: Optional[Tuple[str, str, float]] = field(
+        default=None, init=False, repr=False
+    )
+
+    def start(self, package: str, phase: Optional[str]) -> None:
+        """Called when a package enters a phase; None if it finished the last one"""
+        now = monotonic()
+        self.stop(now)
+        if phase is not None:
+            self._current = (package.split(":")[0], phase, now)
+
+    def stop(self, now: Optional[float] = None) -> None:
+        """Ends the phase in progress"""
+        if self._current is None:
+            return
+        package, phase, start = self._current
+        if now is None:
+            now = monotonic()
+        phases = self.packages.setdefault(package, {})
+        phases[phase] = phases.get(phase, 0.0) + now - start
+        self._current = None
+
+    def total(self, package: str) -> float:
+        return sum(self.packages.get(package, {}).values())
+
+    def slowest(self, count: int = 10) -> List[Tuple[str, float]]:
+        totals = [(package, self.total(package)) for package in self.packages]
+        return sorted(totals, key=lambda item: item[1], reverse=True)[:count]
+
+    def report(self) -> Dict:
+        return {
+            "total": sum(self.total(package) for package in self.packages),
+            "packages": [
+                {"package": package, "total": total, **self.packages[package]}
+                for package, total in self.slowest(len(self.packages))
+            ],
+        }
+
+    @staticmethod
+    def load(path: str) -> Dict[str, Dict[str, float]]:
+        """Seconds spent by phase, by package, in a saved report"""
+        try:
+            with open(path) as file:
+                report = json.load(file)
+            return {
+                entry["package"]: {
+                    phase: float(seconds)
+                    for phase, seconds in entry.items()
+                    if phase not in ("package", "total")
+                }
+                for entry in report["packages"]
+            }
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f"Couldn't read package timings from {path}: {e}")
+            return {}
+
+    def save(self, path: str) -> None:
+        """Saves the timings into the report in 'path'; packages that weren't
+        installed this time keep the timings of the last time they were"""
+        self.stop()
+        if not self.packages:
+            return
+        merged = PackageTimings({**self.load(path), **self.packages})
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as file:
+            json.dump(merged.report(), file, indent=2)
+        slowest = ", ".join(
+            f"{package} ({total:.1f}s)" for package, total in self.slowest(5)
+        )
+        logger.info(f"Package timings saved to {path}; slowest packages: {slowest}")
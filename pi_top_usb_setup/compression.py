@@ -0,0 +1,615 @@
+import gzip
+import logging
+import lzma
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import Executor
+from enum import Enum
+from typing import BinaryIO, Callable, Deque, Optional
+
+from pi_top_usb_setup.exceptions import UnsupportedCompressionError
+
+logger = logging.getLogger(__name__)
+
+
+# Size of the compressed reads done from the bundle file
+READ_SIZE = 1024 * 1024
+# Max size of each decompressed chunk handed over to the writer thread
+CHUNK_SIZE = 1024 * 1024
+
+
+class CompressionFormat(Enum):
+    GZIP = "gzip"
+    ZSTD = "zstd"
+    XZ = "xz"
+    LZ4 = "lz4"
+
+
+MAGIC_BYTES = {
+    CompressionFormat.GZIP: b"\x1f\x8b",
+    CompressionFormat.ZSTD: b"\x28\xb5\x2f\xfd",
+    CompressionFormat.XZ: b"\xfd7zXZ\x00",
+    CompressionFormat.LZ4: b"\x04\x22\x4d\x18",
+}
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+DEFLATE_WBITS = -zlib.MAX_WBITS
+
+# BGZF blocks are gzip members that store their compressed size in a 'BC' extra subfield
+# https://samtools.github.io/hts-specs/SAMv1.pdf (section 4.1)
+GZIP_HEADER_SIZE = 12
+GZIP_FLAG_EXTRA = 0x04
+BGZF_SUBFIELD_ID = b"BC"
+# Size of a gzip member without content nor extra fields
+GZIP_EMPTY_MEMBER_SIZE = 20
+
+# https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md
+ZSTD_SKIPPABLE_MAGIC_MASK = 0xFFFFFFF0
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A50
+ZSTD_BLOCK_TYPE_RLE = 1
+# zstd frames up to this size are decompressed in parallel, one per worker thread
+ZSTD_MAX_PARALLEL_FRAME_SIZE = 32 * 1024 * 1024
+
+# https://tukaani.org/xz/xz-file-format.txt
+XZ_HEADER_SIZE = 12
+XZ_FOOTER_SIZE = 12
+XZ_FOOTER_MAGIC = b"YZ"
+
+# https://github.com/lz4/lz4/blob/dev/doc/lz4_Frame_format.md
+LZ4_FLAG_CONTENT_SIZE = 0x08
+LZ4_FLAG_BLOCK_CHECKSUM = 0x10
+LZ4_FLAG_CONTENT_CHECKSUM = 0x04
+LZ4_FLAG_DICT_ID = 0x01
+LZ4_BLOCK_UNCOMPRESSED = 0x80000000
+
+
+def detect_format(file: BinaryIO) -> CompressionFormat:
+    """Identifies the compression format of a file by its magic bytes"""
+    position = file.tell()
+    header = file.read(max(len(magic) for magic in MAGIC_BYTES.values()))
+    file.seek(position)
+    for compression_format, magic in MAGIC_BYTES.items():
+        if header.startswith(magic):
+            return compression_format
+    raise UnsupportedCompressionError(
+        f"Unknown compression format (header: {header.hex()})"
+    )
+
+
+class CountingReader:
+    """Wraps a file object, reporting the amount of bytes read from it"""
+
+    def __init__(self, file: BinaryIO, on_read: Callable[[int], None]) -> None:
+        self._file = file
+        self._on_read = on_read
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._file.read(size)
+        self._on_read(len(data))
+        return data
+
+    def readinto(self, buffer) -> int:
+        size = self._file.readinto(buffer)  # type: ignore
+        self._on_read(size)
+        return size
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+def _zstandard():
+    try:
+        import zstandard
+
+        return zstandard
+    except ImportError:
+        raise UnsupportedCompressionError(
+            "zstd bundles require the 'zstandard' python module"
+        )
+
+
+def _lz4_frame():
+    try:
+        import lz4.frame
+
+        return lz4.frame
+    except ImportError:
+        raise UnsupportedCompressionError("lz4 bundles require the 'lz4' python module")
+
+
+def open_decompressed(file: BinaryIO, compression_format: CompressionFormat):
+    """Returns a file object that reads the decompressed content of 'file'"""
+    if compression_format == CompressionFormat.GZIP:
+        return gzip.GzipFile(fileobj=file, mode="rb")
+    if compression_format == CompressionFormat.ZSTD:
+        return (
+            _zstandard()
+            .ZstdDecompressor()
+            .stream_reader(
+                file, read_size=READ_SIZE, read_across_frames=True, closefd=False
+            )
+        )
+    if compression_format == CompressionFormat.XZ:
+        return lzma.LZMAFile(file)
+    if compression_format == CompressionFormat.LZ4:
+        return _lz4_frame().LZ4FrameFile(file)
+    raise UnsupportedCompressionError(f"Can't stream {compression_format.value} files")
+
+
+def decompress(
+    file: BinaryIO,
+    compression_format: CompressionFormat,
+    write: Callable[[bytes], None],
+    on_read: Callable[[int], None],
+) -> None:
+    """Decompresses the file in the current thread"""
+    if compression_format == CompressionFormat.GZIP:
+        inflate_gzip(file, write, on_read)
+        return
+
+    with open_decompressed(
+        CountingReader(file, on_read), compression_format  # type: ignore
+    ) as reader:
+        while True:
+            chunk = reader.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            write(chunk)
+
+
+def decompress_parallel(
+    file: BinaryIO,
+    compression_format: CompressionFormat,
+    write: Callable[[bytes], None],
+    on_read: Callable[[int], None],
+    executor: Executor,
+    max_pending: int,
+    on_block: Optional[Callable[[int], None]] = None,
+) -> bool:
+    """Decompresses independent blocks of the file in parallel using 'executor'.
+    Returns False without reading the file if its format or layout doesn't allow it.
+
+    If provided, 'on_block' is called with the offset of each block in the file right
+    before its content is written; decompression can be restarted from any of them."""
+    if compression_format == CompressionFormat.GZIP and is_bgzf(file):
+        inflate_bgzf(file, write, on_read, executor, max_pending, on_block)
+        return True
+
+    if compression_format == CompressionFormat.ZSTD and has_small_zstd_frames(file):
+        decompress_zstd_frames(file, write, on_read, executor, max_pending, on_block)
+        return True
+
+    return False
+
+
+def _write_in_order(
+    pending: Deque,
+    write: Callable[[bytes], None],
+    max_pending: int,
+    on_block: Optional[Callable[[int], None]] = None,
+) -> None:
+    # Blocks are written in order; wait for the oldest ones if there are too many in flight
+    while len(pending) >= max_pending:
+        offset, future = pending.popleft()
+        content = future.result()
+        if on_block:
+            on_block(offset)
+        write(content)
+
+
+###########
+# gzip
+###########
+def is_bgzf(file: BinaryIO) -> bool:
+    """Checks if the gzip file is a BGZF file, whose members can be inflated independently"""
+    position = file.tell()
+    try:
+        header = file.read(GZIP_HEADER_SIZE)
+        if (
+            len(header) < GZIP_HEADER_SIZE
+            or header[:2] != MAGIC_BYTES[CompressionFormat.GZIP]
+            or not header[3] & GZIP_FLAG_EXTRA
+        ):
+            return False
+        (extra_length,) = struct.unpack("<H", header[10:12])
+        return _bgzf_block_size(file.read(extra_length)) is not None
+    finally:
+        file.seek(position)
+
+
+def _bgzf_block_size(extra: bytes) -> Optional[int]:
+    # Look for the 'BC' subfield inside of the gzip 'extra' field
+    offset = 0
+    while offset + 4 <= len(extra):
+        subfield_id = extra[offset : offset + 2]
+        (subfield_length,) = struct.unpack("<H", extra[offset + 2 : offset + 4])
+        if subfield_id == BGZF_SUBFIELD_ID and subfield_length == 2:
+            (block_size,) = struct.unpack("<H", extra[offset + 4 : offset + 6])
+            return block_size + 1
+        offset += 4 + subfield_length
+    return None
+
+
+def _is_padding(file: BinaryIO, data: bytes) -> bool:
+    """Whether 'data', read where a gzip member would start, and the rest of the file
+    are zero padding"""
+    while data:
+        if data.strip(b"\0"):
+            return False
+        data = file.read(READ_SIZE)
+    return True
+
+
+def _inflate_bgzf_block(data: bytes, crc: int, size: int) -> bytes:
+    # zlib releases the GIL while inflating, so blocks can be inflated in parallel threads
+    content = zlib.decompress(data, DEFLATE_WBITS)
+    if len(content) != size or zlib.crc32(content) != crc:
+        raise zlib.error("BGZF block is corrupt")
+    return content
+
+
+def inflate_gzip(
+    file: BinaryIO, write: Callable[[bytes], None], on_read: Callable[[int], None]
+) -> None:
+    """Inflates a (possibly multi-member) gzip stream in the current thread. Zero
+    bytes between or after members (eg: padding added by tape or block devices) are
+    skipped, as 'gzip.GzipFile' does."""
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    # Whether the next data starts a new member
+    member_start = True
+    while True:
+        data = file.read(READ_SIZE)
+        if not data:
+            break
+        on_read(len(data))
+
+        while data:
+            if member_start:
+                data = data.lstrip(b"\0")
+                if not data:
+                    break
+                member_start = False
+            write(decompressor.decompress(data, CHUNK_SIZE))
+            if decompressor.eof:
+                # Start of a new gzip member
+                data = decompressor.unused_data
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+                member_start = True
+            else:
+                data = decompressor.unconsumed_tail
+
+    write(decompressor.flush())
+
+
+def inflate_bgzf(
+    file: BinaryIO,
+    write: Callable[[bytes], None],
+    on_read: Callable[[int], None],
+    executor: Executor,
+    max_pending: int,
+    on_block: Optional[Callable[[int], None]] = None,
+) -> None:
+    """Inflates a BGZF stream, inflating up to 'max_pending' blocks in parallel"""
+    pending: Deque = deque()
+    while True:
+        offset = file.tell()
+        header = file.read(GZIP_HEADER_SIZE)
+        if not header or _is_padding(file, header):
+            break
+        if (
+            len(header) < GZIP_HEADER_SIZE
+            or header[:2] != MAGIC_BYTES[CompressionFormat.GZIP]
+        ):
+            raise zlib.error("Invalid BGZF block header")
+
+        (extra_length,) = struct.unpack("<H", header[10:12])
+        extra = file.read(extra_length)
+        block_size = _bgzf_block_size(extra)
+        if block_size is None:
+            raise zlib.error("BGZF block without size information")
+
+        block = file.read(block_size - GZIP_HEADER_SIZE - extra_length)
+        on_read(block_size)
+        crc, size = struct.unpack("<II", block[-8:])
+        pending.append(
+            (offset, executor.submit(_inflate_bgzf_block, block[:-8], crc, size))
+        )
+        _write_in_order(pending, write, max_pending, on_block)
+
+    _write_in_order(pending, write, 1, on_block)
+
+
+def bgzf_extracted_size(file: BinaryIO) -> Optional[int]:
+    """Adds up the uncompressed size of every block of a BGZF file, reading only their
+    headers and trailers. Returns None if a block can't be read."""
+    file.seek(0)
+    size = 0
+    while True:
+        header = file.read(GZIP_HEADER_SIZE)
+        if not header or _is_padding(file, header):
+            return size
+        if (
+            len(header) < GZIP_HEADER_SIZE
+            or header[:2] != MAGIC_BYTES[CompressionFormat.GZIP]
+        ):
+            return None
+        (extra_length,) = struct.unpack("<H", header[10:12])
+        block_size = _bgzf_block_size(file.read(extra_length))
+        if block_size is None:
+            return None
+        # The size of the block content is in its last 4 bytes
+        file.seek(block_size - GZIP_HEADER_SIZE - extra_length - 4, os.SEEK_CUR)
+        isize = file.read(4)
+        if len(isize) < 4:
+            return None
+        size += int.from_bytes(isize, "little")
+
+
+def gzip_extracted_size(file: BinaryIO) -> Optional[int]:
+    if is_bgzf(file):
+        # Every block stores its own size, and the last one is an empty end-of-file marker
+        return bgzf_extracted_size(file)
+
+    # Uncompressed size is stored in the last 4 bytes of the gzip file
+    # https://stackoverflow.com/a/22348071
+    # Note that this is the size modulo 2^32 of the last gzip member only
+    file.seek(-4, os.SEEK_END)
+    size = int.from_bytes(file.read(4), "little")
+    if size == 0 and file.tell() > GZIP_EMPTY_MEMBER_SIZE:
+        # eg: a trailing empty member; the size of the rest is unknown
+        return None
+    return size
+
+
+###########
+# zstd
+###########
+def _zstd_frame_header(file: BinaryIO):
+    """Reads the header of the zstd frame at the current position.
+    Returns a tuple with the raw header, the frame content size (or None if unknown)
+    and whether the frame has a checksum; returns None for skippable frames."""
+    magic = file.read(4)
+    if len(magic) < 4:
+        raise EOFError
+    (magic_number,) = struct.unpack("<I", magic)
+    if magic_number & ZSTD_SKIPPABLE_MAGIC_MASK == ZSTD_SKIPPABLE_MAGIC:
+        size_bytes = file.read(4)
+        (size,) = struct.unpack("<I", size_bytes)
+        file.seek(size, os.SEEK_CUR)
+        return None
+    if magic != MAGIC_BYTES[CompressionFormat.ZSTD]:
+        raise UnsupportedCompressionError("Invalid zstd frame header")
+
+    descriptor = file.read(1)
+    flags = descriptor[0]
+    content_size_flag = flags >> 6
+    single_segment = bool(flags & 0x20)
+    has_checksum = bool(flags & 0x04)
+    dictionary_id_size = (0, 1, 2, 4)[flags & 0x03]
+    content_size_size = (1 if single_segment else 0, 2, 4, 8)[content_size_flag]
+    window_descriptor_size = 0 if single_segment else 1
+
+    rest = file.read(window_descriptor_size + dictionary_id_size + content_size_size)
+    content_size = None
+    if content_size_size:
+        field = rest[-content_size_size:]
+        content_size = int.from_bytes(field, "little")
+        if content_size_size == 2:
+            content_size += 256
+    return magic + descriptor + rest, content_size, has_checksum
+
+
+def _zstd_frame_blocks(file: BinaryIO, has_checksum: bool, read: bool) -> bytes:
+    # Walks the blocks of a frame, either reading them or seeking over them
+    blocks = []
+    while True:
+        block_header = file.read(3)
+        if len(block_header) < 3:
+            raise EOFError("Truncated zstd frame")
+        value = int.from_bytes(block_header, "little")
+        last_block = value & 1
+        block_type = (value >> 1) & 3
+        block_size = 1 if block_type == ZSTD_BLOCK_TYPE_RLE else value >> 3
+        if read:
+            blocks.append(block_header + file.read(block_size))
+        else:
+            file.seek(block_size, os.SEEK_CUR)
+        if last_block:
+            break
+    if has_checksum:
+        if read:
+            blocks.append(file.read(4))
+        else:
+            file.seek(4, os.SEEK_CUR)
+    return b"".join(blocks)
+
+
+def has_small_zstd_frames(file: BinaryIO) -> bool:
+    """Checks if the zstd file starts with a frame that is small enough to
+    be decompressed in memory and is followed by more frames"""
+    position = file.tell()
+    try:
+        header = _zstd_frame_header(file)
+        while header is None:
+            header = _zstd_frame_header(file)
+        _, _, has_checksum = header
+        _zstd_frame_blocks(file, has_checksum, read=False)
+        return (
+            file.tell() - position <= ZSTD_MAX_PARALLEL_FRAME_SIZE
+            and len(file.read(4)) == 4
+        )
+    except (EOFError, UnsupportedCompressionError, struct.error):
+        return False
+    finally:
+        file.seek(position)
+
+
+def _decompress_zstd_frame(frame: bytes) -> bytes:
+    # zstandard releases the GIL while decompressing; decompressors aren't
+    # thread-safe, so a new one is created for every frame
+    return _zstandard().ZstdDecompressor().decompressobj().decompress(frame)
+
+
+def decompress_zstd_frames(
+    file: BinaryIO,
+    write: Callable[[bytes], None],
+    on_read: Callable[[int], None],
+    executor: Executor,
+    max_pending: int,
+    on_block: Optional[Callable[[int], None]] = None,
+) -> None:
+    """Decompresses a multi-frame zstd stream, up to 'max_pending' frames in parallel"""
+    pending: Deque = deque()
+    while True:
+        position = file.tell()
+        try:
+            header = _zstd_frame_header(file)
+        except EOFError:
+            break
+        if header is None:
+            on_read(file.tell() - position)
+            continue
+
+        raw_header, _, has_checksum = header
+        frame = raw_header + _zstd_frame_blocks(file, has_checksum, read=True)
+        on_read(len(frame))
+        pending.append((position, executor.submit(_decompress_zstd_frame, frame)))
+        _write_in_order(pending, write, max_pending, on_block)
+
+    _write_in_order(pending, write, 1, on_block)
+
+
+def zstd_extracted_size(file: BinaryIO) -> Optional[int]:
+    # Add up the content size of every frame; it's optional, so it might not be available
+    size = 0
+    while True:
+        try:
+            header = _zstd_frame_header(file)
+        except EOFError:
+            return size
+        if header is None:
+            continue
+        _, content_size, has_checksum = header
+        if content_size is None:
+            return None
+        size += content_size
+        _zstd_frame_blocks(file, has_checksum, read=False)
+
+
+###########
+# xz
+###########
+def _read_multibyte_integer(data: bytes, offset: int):
+    value = 0
+    for i in range(9):
+        byte = data[offset + i]
+        value |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            return value, offset + i + 1
+    raise UnsupportedCompressionError("Invalid xz index")
+
+
+def xz_extracted_size(file: BinaryIO) -> Optional[int]:
+    # Read the index of every stream, starting from the end of the file
+    size = 0
+    end = file.seek(0, os.SEEK_END)
+    while end > 0:
+        # Skip stream padding
+        file.seek(end - 4)
+        if file.read(4) == b"\0\0\0\0":
+            end -= 4
+            continue
+
+        file.seek(end - XZ_FOOTER_SIZE)
+        footer = file.read(XZ_FOOTER_SIZE)
+        if footer[-2:] != XZ_FOOTER_MAGIC:
+            raise UnsupportedCompressionError("Invalid xz stream footer")
+        (backward_size,) = struct.unpack("<I", footer[4:8])
+        index_size = (backward_size + 1) * 4
+
+        index_start = end - XZ_FOOTER_SIZE - index_size
+        file.seek(index_start)
+        index = file.read(index_size)
+        records, offset = _read_multibyte_integer(index, 1)
+        blocks_size = 0
+        for _ in range(records):
+            unpadded_size, offset = _read_multibyte_integer(index, offset)
+            uncompressed_size, offset = _read_multibyte_integer(index, offset)
+            blocks_size += (unpadded_size + 3) & ~3
+            size += uncompressed_size
+
+        # Move to the end of the previous stream, if any
+        end = index_start - blocks_size - XZ_HEADER_SIZE
+    return size
+
+
+###########
+# lz4
+###########
+def lz4_extracted_size(file: BinaryIO) -> Optional[int]:
+    # Add up the content size of every frame; it's optional, so it might not be available
+    size = 0
+    while True:
+        magic = file.read(4)
+        if len(magic) < 4:
+            return size
+        if magic != MAGIC_BYTES[CompressionFormat.LZ4]:
+            raise UnsupportedCompressionError("Invalid lz4 frame header")
+
+        flags = file.read(2)[0]
+        if not flags & LZ4_FLAG_CONTENT_SIZE:
+            return None
+        (content_size,) = struct.unpack("<Q", file.read(8))
+        size += content_size
+        # Skip dictionary ID and header checksum
+        file.seek((4 if flags & LZ4_FLAG_DICT_ID else 0) + 1, os.SEEK_CUR)
+
+        while True:
+            (block_size,) = struct.unpack("<I", file.read(4))
+            if block_size == 0:
+                break
+            block_size &= ~LZ4_BLOCK_UNCOMPRESSED
+            if flags & LZ4_FLAG_BLOCK_CHECKSUM:
+                block_size += 4
+            file.seek(block_size, os.SEEK_CUR)
+        if flags & LZ4_FLAG_CONTENT_CHECKSUM:
+            file.seek(4, os.SEEK_CUR)
+
+
+def get_extracted_size(file: str) -> int:
+    """Gets the size of the decompressed content of a file.
+
+    The size is read from the file headers when the format stores it; otherwise the
+    file is decompressed (without writing it anywhere) to measure it."""
+    with open(file, "rb") as f:
+        compression_format = detect_format(f)
+        size = {
+            CompressionFormat.GZIP: gzip_extracted_size,
+            CompressionFormat.ZSTD: zstd_extracted_size,
+            CompressionFormat.XZ: xz_extracted_size,
+            CompressionFormat.LZ4: lz4_extracted_size,
+        }[compression_format](f)
+
+        if size is None:
+            logger.warning(
+                f"{file} doesn't store its content size; decompressing it to measure it"
+            )
+            f.seek(0)
+            size = 0
+
+            def count(chunk: bytes) -> None:
+                nonlocal size
+                size += len(chunk)  # type: ignore
+
+            decompress(f, compression_format, count, lambda _: None)
+
+    logger.info(f"Size of {file} content is {size}")
+    return size
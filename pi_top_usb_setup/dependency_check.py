@@ -0,0 +1,230 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+
+from pi_top_usb_setup.apt_index import (
+    Relation,
+    compare_versions,
+    parse_packages_index,
+    parse_relations,
+    satisfies,
+)
+from pi_top_usb_setup.dpkg_status import status_index
+from pi_top_usb_setup.exceptions import UnmetDependenciesError
+
+logger = logging.getLogger(__name__)
+
+# Relations that must be met for a package to be installed; missing recommended
+# packages are skipped by apt
+REQUIRED_RELATIONS = ("Pre-Depends", "Depends")
+
+
+def format_relation(alternatives: List[Relation]) -> str:
+    """eg: 'libfoo (>= 1.0) | libbar'"""
+    return " | ".join(
+        f"{name} ({operator} {version})" if operator else name
+        for name, operator, version in alternatives
+    )
+
+
+@dataclass
+class UnmetDependency:
+    package: str
+    version: str
+    relation: str
+
+    def __str__(self) -> str:
+        return f"{self.package} {self.version} depends on {self.relation}"
+
+
+@dataclass
+class DependencyReport:
+    # Dependencies that neither the installed packages nor the index can meet
+    unmet: List[UnmetDependency] = field(default_factory=list)
+    # Packages the upgrade can't install because of them, directly or through other
+    # held back packages; apt leaves them as they are
+    held_back: Set[str] = field(default_factory=set)
+    # Held back packages the system can't do without
+    essential: Set[str] = field(default_factory=set)
+
+
+def resolve_dependencies(
+    packages_index: str,
+    installed: Dict[str, str],
+    installed_provides: Optional[Dict[str, Set[str]]] = None,
+) -> DependencyReport:
+    """Checks that the dependencies of the packages an upgrade installs from
+    'packages_index' can be met, given the 'installed' package versions by name.
+
+    The upgrade installs the newest version in the index of every installed package
+    that has a newer one, and the packages they need that aren't installed yet,
+    recursively. Packages with dependencies that can't be met are held back, and so
+    are the ones that need them."""
+    installed_provides = installed_provides or {}
+
+    # Newest version of each package in the index, and the packages that provide
+    # each virtual package with the version they provide, if any
+    available: Dict[str, Dict[str, str]] = {}
+    provided: Dict[str, List[Tuple[str, Optional[str]]]] = {}
+    for fields in parse_packages_index(packages_index):
+        name = fields.get("Package")
+        if not name or "Version" not in fields:
+            continue
+        current = available.get(name)
+        if (
+            current is None
+            or compare_versions(fields["Version"], current["Version"]) > 0
+        ):
+            available[name] = fields
+    for name, fields in available.items():
+        for alternatives in parse_relations(fields.get("Provides", "")):
+            virtual, _, version = alternatives[0]
+            provided.setdefault(virtual, []).append((name, version))
+
+    to_install = {
+        name
+        for name, fields in available.items()
+        if name in installed
+        and compare_versions(fields["Version"], installed[name]) > 0
+    }
+    report = DependencyReport()
+
+    def final_version(name: str) -> Optional[str]:
+        if name in to_install:
+            return available[name]["Version"]
+        return installed.get(name)
+
+    def is_met(relation: Relation) -> bool:
+        name, operator, version = relation
+        final = final_version(name)
+        if final is not None and satisfies(final, operator, version):
+            return True
+        if operator is None and name in installed_provides:
+            return True
+        return any(
+            (provider in to_install or provider in installed)
+            and (
+                operator is None or satisfies(str(provided_version), operator, version)
+            )
+            for provider, provided_version in provided.get(name, [])
+            if operator is None or provided_version is not None
+        )
+
+    def installable(relation: Relation) -> Optional[str]:
+        # Package from the index that would meet the relation
+        name, operator, version = relation
+        if (
+            name in available
+            and name not in to_install
+            and name not in report.held_back
+            and satisfies(available[name]["Version"], operator, version)
+        ):
+            return name
+        candidates = [
+            provider
+            for provider, provided_version in provided.get(name, [])
+            if provider not in report.held_back
+            and (
+                operator is None
+                or (
+                    provided_version is not None
+                    and satisfies(provided_version, operator, version)
+                )
+            )
+        ]
+        # Preferably one that is installed, as the update planner does
+        return next(
+            (provider for provider in candidates if provider in installed),
+            next(iter(candidates), None),
+        )
+
+    # Packages with a relation on each name, to check again if it's held back
+    dependents: Dict[str, Set[str]] = {}
+    # Names of the held back packages and of the virtual packages they provide
+    held_back_names: Set[str] = set()
+    pending = sorted(to_install)
+    checked: Set[str] = set()
+    while pending:
+        package = pending.pop()
+        if package in checked or package not in to_install:
+            continue
+        checked.add(package)
+        fields = available[package]
+        unmet: List[List[Relation]] = []
+        for relation_field in REQUIRED_RELATIONS:
+            for alternatives in parse_relations(fields.get(relation_field, "")):
+                for name, _, _ in alternatives:
+                    dependents.setdefault(name, set()).add(package)
+                if any(is_met(alternative) for alternative in alternatives):
+                    continue
+                new_package = next(
+                    filter(None, (installable(relation) for relation in alternatives)),
+                    None,
+                )
+                if new_package is None:
+                    unmet.append(alternatives)
+                    continue
+                to_install.add(new_package)
+                pending.append(new_package)
+        if not unmet:
+            continue
+
+        for alternatives in unmet:
+            # Dependencies missing from the index, rather than on held back packages
+            if not any(name in held_back_names for name, _, _ in alternatives):
+                report.unmet.append(
+                    UnmetDependency(
+                        package, fields["Version"], format_relation(alternatives)
+                    )
+                )
+        report.held_back.add(package)
+        if fields.get("Essential") == "yes" or fields.get("Priority") == "required":
+            report.essential.add(package)
+        to_install.discard(package)
+        names = [package] + [
+            alternatives[0][0]
+            for alternatives in parse_relations(fields.get("Provides", ""))
+        ]
+        held_back_names.update(names)
+        for name in names:
+            for dependent in dependents.get(name, set()) & to_install:
+                checked.discard(dependent)
+                pending.append(dependent)
+
+    logger.info(
+        f"Checked dependencies of {len(checked)} packages: {len(report.unmet)} unmet, "
+        f"{len(report.held_back)} packages held back"
+    )
+    return report
+
+
+def check_dependencies(
+    packages_index: str,
+    installed: Dict[str, str],
+    installed_provides: Optional[Dict[str, Set[str]]] = None,
+) -> List[UnmetDependency]:
+    """Returns the dependencies of the packages an upgrade installs from
+    'packages_index' that neither the installed packages nor the index can meet"""
+    return resolve_dependencies(packages_index, installed, installed_provides).unmet
+
+
+def verify_dependencies(packages_index: str) -> Set[str]:
+    """Returns the packages that upgrading the installed packages with
+    'packages_index' holds back because of missing dependencies. Raises
+    UnmetDependenciesError if the system can't do without any of them."""
+    report = resolve_dependencies(
+        packages_index, status_index.versions(), status_index.provides()
+    )
+    for dependency in report.unmet:
+        logger.warning(f"Unmet dependency: {dependency}")
+    if report.held_back:
+        logger.warning(
+            f"{len(report.held_back)} packages will be held back: "
+            + ", ".join(sorted(report.held_back))
+        )
+    if report.essential:
+        raise UnmetDependenciesError(
+            f"Essential packages can't be upgraded: {', '.join(sorted(report.essential))}; "
+            + ", ".join(str(dependency) for dependency in report.unmet[:5])
+        )
+    return report.held_back
@@ -0,0 +1,123 @@
+import logging
+import shutil
+from dataclasses import dataclass
+from typing import Dict, Optional, Set, Tuple
+
+from pi_top_usb_setup.apt_index import parse_packages_index
+from pi_top_usb_setup.dpkg_status import installed_packages, status_index
+from pi_top_usb_setup.update_planner import plan_updates
+
+logger = logging.getLogger(__name__)
+
+
+def format_size(size: int) -> str:
+    return f"{size / 1024 / 1024:.1f} MB"
+
+
+@dataclass
+class DiskPlan:
+    """Disk space needed by a setup run, in bytes.
+
+    Extracted files stay on disk while updates are installed, so the peak usage is
+    reached at the end of the upgrade, while dpkg unpacks the last package."""
+
+    free_space: int
+    # Extracted bundle content
+    extraction: int = 0
+    # Copy of the repository index made by 'apt-get update'
+    package_lists: int = 0
+    # How much the installed packages grow once upgraded
+    installed_growth: int = 0
+    # The new files of a package are unpacked next to the ones they replace; this is
+    # the size of the biggest package
+    unpack_overhead: int = 0
+    # Folder in the filesystem the plan is for
+    drive: str = "/"
+
+    @property
+    def peak_usage(self) -> int:
+        return (
+            self.extraction
+            + self.package_lists
+            + max(self.installed_growth, 0)
+            + self.unpack_overhead
+        )
+
+    @property
+    def shortfall(self) -> int:
+        """Space missing for the setup to fit in the drive"""
+        # Filling the drive up to the last byte isn't an option either
+        if self.peak_usage < self.free_space:
+            return 0
+        return self.peak_usage - self.free_space + 1
+
+    @property
+    def fits(self) -> bool:
+        return self.shortfall == 0
+
+    def __str__(self) -> str:
+        summary = (
+            f"needs {format_size(self.peak_usage)} "
+            f"(extraction: {format_size(self.extraction)}, "
+            f"updates: {format_size(self.peak_usage - self.extraction)}), "
+            f"{format_size(self.free_space)} available"
+        )
+        if not self.fits:
+            summary += f"; {format_size(self.shortfall)} missing"
+        return summary
+
+
+def plan_disk_usage(
+    drive: str,
+    extraction_size: int,
+    packages_index: Optional[str] = None,
+    installed: Optional[Dict[str, Tuple[str, int]]] = None,
+    installed_provides: Optional[Dict[str, Set[str]]] = None,
+) -> DiskPlan:
+    """Estimates the peak disk usage in 'drive' of extracting 'extraction_size' bytes
+    and upgrading the system with the packages listed in 'packages_index'.
+
+    Only the packages the upgrade installs are counted: the installed ones that have a
+    newer version in the index and the new packages they depend on (see
+    'plan_updates'); the index usually lists many more. Packages are installed from
+    the offline repository without being copied into '/var/cache/apt/archives', so
+    that's not counted."""
+    _, _, free_space = shutil.disk_usage(drive)
+    plan = DiskPlan(free_space=free_space, extraction=extraction_size, drive=drive)
+    if packages_index is None:
+        return plan
+
+    if installed is None:
+        try:
+            installed = installed_packages()
+            installed_provides = status_index.provides()
+        except Exception as e:
+            logger.warning(
+                f"Couldn't get installed packages, not planning updates: {e}"
+            )
+            return plan
+
+    update_plan = plan_updates(
+        packages_index,
+        {package: version for package, (version, _) in installed.items()},
+        installed_provides,
+    )
+
+    # Size of each package once installed, keeping the biggest architecture
+    new_sizes: Dict[str, int] = {}
+    for fields in parse_packages_index(update_plan.packages_index):
+        package = fields.get("Package")
+        if package is None:
+            continue
+        size = fields.get("Installed-Size", "0")
+        size_in_bytes = int(size) * 1024 if size.isdigit() else 0
+        new_sizes[package] = max(size_in_bytes, new_sizes.get(package, 0))
+
+    plan.package_lists = len(packages_index.encode())
+    plan.installed_growth = sum(
+        size - installed.get(package, (None, 0))[1]
+        for package, size in new_sizes.items()
+    )
+    plan.unpack_overhead = max(new_sizes.values(), default=0)
+    logger.info(f"Disk usage plan for {drive}: {plan}")
+    return plan
@@ -0,0 +1,140 @@
+import logging
+import os
+import select
+from dataclasses import dataclass, field
+from time import monotonic, sleep
+from typing import Callable, List, Optional
+
+from pi_top_usb_setup.exceptions import DpkgLockTimeoutError
+from pi_top_usb_setup.watchdog import read_process
+
+logger = logging.getLogger(__name__)
+
+# Locks apt and dpkg take, in the order they take them
+DPKG_LOCKS = [
+    "/var/lib/dpkg/lock-frontend",
+    "/var/lib/dpkg/lock",
+    "/var/lib/apt/lists/lock",
+    "/var/cache/apt/archives/lock",
+]
+PROC_LOCKS = "/proc/locks"
+# Seconds between checks of the lock while its holder is running; holders like
+# unattended-upgrades can release it and take it again without exiting
+RECHECK_INTERVAL = 5
+INTERPRETERS = ("python", "python3", "perl", "sh", "bash")
+
+
+@dataclass
+class LockHolder:
+    path: str
+    pid: int
+    command: List[str] = field(default_factory=list)
+
+    @property
+    def name(self) -> str:
+        """Name of the program holding the lock, eg: 'unattended-upgrade'"""
+        if not self.command:
+            return f"process {self.pid}" if self.pid > 0 else "another process"
+        program = os.path.basename(self.command[0])
+        if program.rstrip("0123456789.") in INTERPRETERS and len(self.command) > 1:
+            program = os.path.basename(self.command[1])
+        return program
+
+    def __str__(self) -> str:
+        return f"{self.path} held by {self.pid} ({' '.join(self.command)})"
+
+
+def lock_holder(path: str, proc_locks: str = PROC_LOCKS) -> Optional[LockHolder]:
+    """Returns the process that holds a lock on a file, if any, without trying to take
+    the lock"""
+    try:
+        stat = os.stat(path)
+        with open(proc_locks) as file:
+            locks = file.read()
+    except OSError:
+        return None
+
+    # eg: '1: POSIX  ADVISORY  WRITE 1234 b3:02:131094 0 EOF'; processes waiting for
+    # a lock are listed after it with '->', they don't hold it
+    device = f"{os.major(stat.st_dev):02x}:{os.minor(stat.st_dev):02x}:{stat.st_ino}"
+    for line in locks.splitlines():
+        fields = line.split()
+        if len(fields) < 6 or fields[1] == "->" or fields[5] != device:
+            continue
+        # Open file description locks have no owner process
+        pid = int(fields[4])
+        if pid == os.getpid():
+            # Taken by apt in this process, eg: by python-apt
+            continue
+        holder = LockHolder(path, pid)
+        info = read_process(pid) if pid > 0 else None
+        if info:
+            holder.command = info.command
+        return holder
+    return None
+
+
+def find_lock_holder(paths: List[str] = DPKG_LOCKS) -> Optional[LockHolder]:
+    """Returns the holder of the first apt or dpkg lock that is held, if any"""
+    for path in paths:
+        holder = lock_holder(path)
+        if holder:
+            return holder
+    return None
+
+
+def _wait_for_exit(pid: int, timeout: float) -> None:
+    """Waits up to 'timeout' seconds for a process to exit"""
+    try:
+        pidfd = os.pidfd_open(pid)  # type: ignore[attr-defined]
+    except (AttributeError, OSError):
+        # Not supported by Python or the kernel, or the process already exited
+        if read_process(pid):
+            sleep(timeout)
+        return
+    try:
+        poller = select.poll()
+        poller.register(pidfd, select.POLLIN)
+        poller.poll(timeout * 1000)
+    finally:
+        os.close(pidfd)
+
+
+def wait_for_dpkg_lock(
+    timeout: float,
+    on_wait: Optional[Callable[[Optional[LockHolder]], None]] = None,
+    paths: List[str] = DPKG_LOCKS,
+) -> None:
+    """Waits until no other process holds the apt and dpkg locks.
+
+    Instead of polling, it waits for the holder of the lock to exit, checking the
+    lock again every few seconds. 'on_wait' is called with the holder when the wait
+    starts or the holder changes, and with None once the locks are free. Raises
+    DpkgLockTimeoutError if they are still held after 'timeout' seconds."""
+    deadline = monotonic() + timeout
+    current: Optional[LockHolder] = None
+    try:
+        while True:
+            holder = find_lock_holder(paths)
+            if holder is None:
+                if current is not None:
+                    logger.info("apt and dpkg locks were released")
+                return
+            if current is None or holder.pid != current.pid:
+                logger.warning(f"Waiting for lock: {holder}")
+                if callable(on_wait):
+                    on_wait(holder)
+            current = holder
+
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                raise DpkgLockTimeoutError(
+                    f"{holder.name} didn't release {holder.path} in {timeout} seconds"
+                )
+            if holder.pid > 0:
+                _wait_for_exit(holder.pid, min(remaining, RECHECK_INTERVAL))
+            else:
+                sleep(min(remaining, RECHECK_INTERVAL))
+    finally:
+        if current is not None and callable(on_wait):
+            on_wait(None)
@@ -0,0 +1,132 @@
+import logging
+import os
+from threading import Lock
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+DPKG_STATUS_FILE = "/var/lib/dpkg/status"
+
+
+def parse_status_file(
+    content: str,
+    provides: Optional[Dict[str, Set[str]]] = None,
+    unconfigured: Optional[Set[str]] = None,
+) -> Dict[str, Tuple[str, int]]:
+    """Returns the version and installed size in bytes of every installed package in
+    the content of a dpkg 'status' file. If given, 'provides' is filled with the
+    installed packages that provide each virtual package, and 'unconfigured' with the
+    packages that are unpacked but not configured yet."""
+    packages: Dict[str, Tuple[str, int]] = {}
+
+    def add(fields: Dict[str, str]) -> None:
+        # eg: 'install ok installed' or 'hold ok installed'; packages removed but not
+        # purged, or half installed, are left out
+        status = fields.get("Status", "").split()
+        name = fields.get("Package")
+        if not name:
+            return
+        if unconfigured is not None and status[2:] in (
+            ["unpacked"],
+            ["half-configured"],
+        ):
+            unconfigured.add(name)
+        if len(status) != 3 or status[2] != "installed":
+            return
+        installed_size = fields.get("Installed-Size", "")
+        size = int(installed_size) * 1024 if installed_size.isdigit() else 0
+        # Packages installed for several architectures share the name
+        if name in packages:
+            size = max(size, packages[name][1])
+        packages[name] = (fields.get("Version", ""), size)
+        if provides is not None and "Provides" in fields:
+            for virtual in fields["Provides"].split(","):
+                # eg: 'mail-transport-agent' or 'libfoo-abi (= 1.0)'
+                virtual_name = virtual.split("(")[0].strip()
+                if virtual_name:
+                    provides.setdefault(virtual_name, set()).add(name)
+
+    fields: Dict[str, str] = {}
+    for line in content.splitlines():
+        if not line:
+            add(fields)
+            fields = {}
+        elif line[0] not in " \t":
+            # Only the first line of multiline fields is kept, nothing else needs them
+            name, _, value = line.partition(":")
+            if name in ("Package", "Status", "Version", "Installed-Size", "Provides"):
+                fields[name] = value.strip()
+    add(fields)
+    return packages
+
+
+class DpkgStatusIndex:
+    """Installed packages, read from the dpkg database without running dpkg-query.
+
+    The database is parsed once and read again only when dpkg changes it, which
+    it always does by replacing the file."""
+
+    def __init__(self, path: str = DPKG_STATUS_FILE) -> None:
+        self.path = path
+        self._lock = Lock()
+        self._packages: Dict[str, Tuple[str, int]] = {}
+        self._provides: Dict[str, Set[str]] = {}
+        self._unconfigured: Set[str] = set()
+        self._signature: Optional[Tuple[str, int, int, int]] = None
+
+    def packages(self) -> Dict[str, Tuple[str, int]]:
+        """Version and installed size in bytes of every installed package, by name"""
+        with self._lock:
+            stat = os.stat(self.path)
+            signature = (self.path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if signature != self._signature:
+                provides: Dict[str, Set[str]] = {}
+                unconfigured: Set[str] = set()
+                with open(self.path, encoding="utf-8", errors="replace") as file:
+                    self._packages = parse_status_file(
+                        file.read(), provides, unconfigured
+                    )
+                self._provides = provides
+                self._unconfigured = unconfigured
+                self._signature = signature
+                logger.debug(f"Read {len(self._packages)} packages from {self.path}")
+            return self._packages
+
+    def provides(self) -> Dict[str, Set[str]]:
+        """Installed packages that provide each virtual package, by its name"""
+        self.packages()
+        return self._provides
+
+    def unconfigured(self) -> Set[str]:
+        """Packages that are unpacked but not configured yet, eg: by an install that
+        deferred their configuration"""
+        self.packages()
+        return self._unconfigured
+
+    def versions(self, names: Optional[Iterable[str]] = None) -> Dict[str, str]:
+        """Installed version of each of the 'names' packages that is installed, or of
+        every installed package"""
+        packages = self.packages()
+        if names is None:
+            return {name: version for name, (version, _) in packages.items()}
+        return {
+            name: packages[name][0]
+            for name in (name.split(":")[0] for name in names)
+            if name in packages
+        }
+
+    def version(self, name: str) -> Optional[str]:
+        return self.versions([name]).get(name.split(":")[0])
+
+
+status_index = DpkgStatusIndex()
+
+
+def installed_packages() -> Dict[str, Tuple[str, int]]:
+    """Returns the version and installed size in bytes of every installed package"""
+    return status_index.packages()
+
+
+def installed_versions(names: Optional[Iterable[str]] = None) -> Dict[str, str]:
+    """Returns the installed version of the given packages, or of all of them"""
+    return status_index.versions(names)
@@ -6,5 +6,25 @@ class ExtractionError(Exception):
     pass
 
 
+class ChecksumMismatchError(ExtractionError):
+    pass
+
+
 class NotAnAptRepository(Exception):
     pass
+
+
+class UnsupportedCompressionError(Exception):
+    pass
+
+
+class UnmetDependenciesError(Exception):
+    pass
+
+
+class UnsupportedBackendError(Exception):
+    pass
+
+
+class DpkgLockTimeoutError(Exception):
+    pass
@@ -0,0 +1,801 @@
+import hashlib
+import json
+import logging
+import os
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from queue import Full, Queue
+from threading import Condition, Event, Thread
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from pi_top_usb_setup.apt_index import package_hashes
+from pi_top_usb_setup.compression import decompress, decompress_parallel, detect_format
+from pi_top_usb_setup.exceptions import ChecksumMismatchError
+from pi_top_usb_setup.progress import ProgressMeter, ProgressStats
+
+logger = logging.getLogger(__name__)
+
+
+CHECKPOINT_FILENAME = ".pi-top-usb-setup-checkpoint.json"
+# Written into the folders created to extract bundles into; only folders with it are
+# ever cleared before an extraction
+EXTRACTION_MARKER = ".pi-top-usb-setup-extraction"
+CHECKPOINT_VERSION = 1
+# Amount of member data processed between checkpoints
+CHECKPOINT_INTERVAL = 256 * 1024 * 1024
+# Amount of data handed to the hashing thread at once
+HASH_BATCH_SIZE = 1024 * 1024
+
+
+class PipeAborted(Exception):
+    pass
+
+
+class ChunkPipe:
+    """Bounded buffer that hands decompressed chunks from a producer thread to a
+    consumer that reads it as a file object"""
+
+    def __init__(self, max_chunks: int) -> None:
+        self._queue: Queue = Queue(maxsize=max_chunks)
+        self._aborted = Event()
+        self._error: Optional[BaseException] = None
+        self._chunk = memoryview(b"")
+        self._eof = False
+        self._bytes_read = 0
+        self._next_block: Optional[int] = None
+        # Compressed and decompressed offsets of the latest blocks read by the consumer
+        self._blocks: Deque[Tuple[int, int]] = deque(maxlen=256)
+        self._received = 0
+        # Amount of compressed data that produced the chunks read by the consumer so far
+        self.position = 0
+        # Amount of decompressed data read by the consumer so far
+        self.consumed = 0
+        # Called after every read, from the consumer thread
+        self.on_read: Optional[Callable[[], None]] = None
+        # Called with the data returned by every read, from the consumer thread
+        self.on_data: Optional[Callable[[bytes], None]] = None
+
+    def _put(self, item: Optional[Tuple[bytes, int, Optional[int]]]) -> None:
+        # Block while the buffer is full, unless the consumer stopped reading
+        while not self._aborted.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except Full:
+                continue
+        raise PipeAborted("Consumer stopped reading from pipe")
+
+    def advance(self, size: int) -> None:
+        """Called by the producer with the size of each compressed read"""
+        self._bytes_read += size
+
+    def mark_block(self, offset: int) -> None:
+        """Called by the producer when the next chunk is the start of an independent
+        compressed block, located at 'offset' in the compressed file"""
+        self._next_block = offset
+
+    def write(self, chunk: bytes) -> None:
+        if chunk:
+            self._put((chunk, self._bytes_read, self._next_block))
+            self._next_block = None
+
+    def close(self, error: Optional[BaseException] = None) -> None:
+        """Signals the consumer that no more data will be written"""
+        self._error = error
+        self._put(None)
+
+    def abort(self) -> None:
+        """Stops a producer blocked writing into the pipe"""
+        self._aborted.set()
+
+    def read(self, size: int = -1) -> bytes:
+        parts = []
+        remaining = size
+        while remaining != 0:
+            if len(self._chunk) == 0:
+                if self._eof:
+                    break
+                item = self._queue.get()
+                if item is None:
+                    self._eof = True
+                    if self._error:
+                        raise self._error
+                    break
+                chunk, self.position, block = item
+                if block is not None:
+                    self._blocks.append((block, self._received))
+                self._received += len(chunk)
+                self._chunk = memoryview(chunk)
+
+            if remaining < 0 or remaining >= len(self._chunk):
+                parts.append(self._chunk)
+                remaining -= len(self._chunk)
+                self._chunk = memoryview(b"")
+            else:
+                parts.append(self._chunk[:remaining])
+                self._chunk = self._chunk[remaining:]
+                remaining = 0
+
+        data = b"".join(parts)
+        self.consumed += len(data)
+        if self.on_data and data:
+            self.on_data(data)
+        if self.on_read:
+            self.on_read()
+        return data
+
+    def restart_point(self, offset: int) -> Optional[Tuple[int, int]]:
+        """Returns where decompression can be restarted to get the data at 'offset' of
+        the stream, as the offset of a compressed block and the amount of decompressed
+        data to discard from it"""
+        for block, start in reversed(self._blocks):
+            if start <= offset:
+                return block, offset - start
+        return None
+
+
+def normalise_member_name(name: str) -> str:
+    # Archives created from inside of the bundle folder have members prefixed with './'
+    return name[2:] if name.startswith("./") else name
+
+
+def sync_files(directory: str, names: Iterable[str]) -> None:
+    """Flushes the given files in 'directory' to disk, together with the folders
+    holding them so that their entries are not lost either. Unlike 'os.sync', writes
+    from other processes (eg: dpkg) are left alone."""
+    folders = {directory}
+    for name in names:
+        path = os.path.join(directory, name)
+        folders.add(os.path.dirname(path))
+        _fsync(path)
+    for folder in folders:
+        _fsync(folder)
+
+
+def _fsync(path: str) -> None:
+    try:
+        # Symlinks are only entries of their folder
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def skip_folders(
+    folders: Iterable[Union[str, Path]]
+) -> Callable[[tarfile.TarInfo], bool]:
+    """Returns a member filter that leaves out the content of the given folders"""
+    prefixes = tuple(f"{str(folder).rstrip('/')}/" for folder in folders)
+
+    def member_filter(member: tarfile.TarInfo) -> bool:
+        name = normalise_member_name(member.name)
+        return not f"{name}/".startswith(prefixes)
+
+    return member_filter
+
+
+def skip_members(
+    names: Iterable[Union[str, Path]]
+) -> Callable[[tarfile.TarInfo], bool]:
+    """Returns a member filter that leaves out the given members"""
+    skipped = {str(name) for name in names}
+
+    def member_filter(member: tarfile.TarInfo) -> bool:
+        return normalise_member_name(member.name) not in skipped
+
+    return member_filter
+
+
+@dataclass
+class ExtractionCheckpoint:
+    """State of an extraction saved to disk, so that it can be resumed if interrupted"""
+
+    # Identifies the bundle being extracted
+    bundle: Dict[str, Union[str, int]]
+    # Size and modification time of the extracted files by member name; None for other members
+    members: Dict[str, Optional[List[int]]] = field(default_factory=dict)
+    # Offset of the compressed block to restart decompression from, and the amount of
+    # decompressed data of that block that was already extracted
+    offset: Optional[int] = None
+    skip: int = 0
+    # Member data processed before the restart point, for progress reports
+    processed_bytes: int = 0
+    complete: bool = False
+    version: int = CHECKPOINT_VERSION
+
+    @staticmethod
+    def bundle_id(file: str) -> Dict[str, Union[str, int]]:
+        stat = os.stat(file)
+        return {
+            "name": Path(file).name,
+            "size": stat.st_size,
+            "mtime": int(stat.st_mtime),
+        }
+
+    @classmethod
+    def load(cls, path: str) -> Optional["ExtractionCheckpoint"]:
+        try:
+            with open(path) as file:
+                data = json.load(file)
+            if data.get("version") != CHECKPOINT_VERSION:
+                return None
+            return cls(**data)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Couldn't read extraction checkpoint '{path}': {e}")
+            return None
+
+    def is_for(self, file: str) -> bool:
+        return self.bundle == self.bundle_id(file)
+
+    def save(self, path: str) -> None:
+        """Saves the checkpoint, replacing the previous one atomically. The files it
+        lists must be flushed to disk first (see 'sync_files'), so that a checkpoint
+        never lists lost data."""
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(asdict(self), file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+        _fsync(os.path.dirname(os.path.abspath(path)))
+
+    def add(self, member: tarfile.TarInfo) -> None:
+        self.members[normalise_member_name(member.name)] = (
+            [member.size, int(member.mtime)] if member.isreg() else None
+        )
+
+    def verify(self, destination: str) -> bool:
+        """Checks the extracted members against the files on disk, forgetting about the
+        ones that don't match. Returns True if all of them did."""
+        verified: Dict[str, Optional[List[int]]] = {}
+        for name, expected in self.members.items():
+            path = Path(destination) / name
+            try:
+                if expected is None:
+                    if os.path.lexists(path):
+                        verified[name] = expected
+                    continue
+                stat = path.stat()
+                if [stat.st_size, int(stat.st_mtime)] == expected:
+                    verified[name] = expected
+            except OSError:
+                continue
+
+        all_verified = len(verified) == len(self.members)
+        if not all_verified:
+            logger.warning(
+                f"{len(self.members) - len(verified)} files in {destination} don't match the checkpoint"
+            )
+        self.members = verified
+        return all_verified
+
+
+class ExtractionTracker:
+    """Keeps track of the files extracted from a bundle, so that other threads can
+    start using them while the rest of the bundle is still being extracted"""
+
+    def __init__(self, destination: Union[str, Path]) -> None:
+        self.destination = Path(destination)
+        self.error: Optional[BaseException] = None
+        self._extracted: Set[Path] = set()
+        self._finished = False
+        self._condition = Condition()
+
+    def member_extracted(self, member: tarfile.TarInfo) -> None:
+        with self._condition:
+            self._extracted.add(self.destination / normalise_member_name(member.name))
+            self._condition.notify_all()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        """Called once extraction is over, successfully or not"""
+        with self._condition:
+            self.error = error
+            self._finished = True
+            self._condition.notify_all()
+
+    @property
+    def finished(self) -> bool:
+        return self._finished
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Waits until extraction is over. Returns False on timeout"""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._finished, timeout)
+
+    def is_extracted(self, path: Union[str, Path]) -> bool:
+        """Whether 'path' is available, without waiting for it"""
+        path = Path(path)
+        with self._condition:
+            if path in self._extracted:
+                return True
+            return self._finished and not self.error and path.exists()
+
+    def wait_for(self, path: Union[str, Path]) -> bool:
+        """Waits until 'path' is extracted. Returns False if extraction finished
+        without it; raises if extraction failed."""
+        path = Path(path)
+        with self._condition:
+            self._condition.wait_for(lambda: self._finished or path in self._extracted)
+            if path in self._extracted:
+                return True
+            if self.error:
+                raise Exception(f"Extraction failed before '{path}' was available")
+            # eg: the bundle was mounted instead of extracted
+            return path.exists()
+
+
+class MemberHasher:
+    """Verifies the SHA256 of the extracted members in a background thread.
+
+    The hasher is fed a copy of the tar stream read by the extraction, so files are
+    hashed while they're written instead of being read back from disk. Expected hashes
+    come from 'hashes', by member name, and from the 'Packages' indexes found in the
+    stream, for the package files they list.
+
+    'on_complete' is called once a member is both written to disk and verified; a
+    member without an expected hash is complete once it's written."""
+
+    def __init__(
+        self,
+        hashes: Dict[str, str],
+        on_complete: Callable[[tarfile.TarInfo], None],
+        max_buffered_chunks: int = 16,
+    ) -> None:
+        self.expected = dict(hashes)
+        self.on_complete = on_complete
+        self.error: Optional[ChecksumMismatchError] = None
+        # Name of the member that didn't match its hash
+        self.corrupt_member: Optional[str] = None
+        self._pipe = ChunkPipe(max_buffered_chunks)
+        self._buffer = bytearray()
+        self._condition = Condition()
+        # Whether each member of the stream is extracted, in stream order
+        self._decisions: Deque[bool] = deque()
+        self._written: Dict[str, tarfile.TarInfo] = {}
+        self._verified: Set[str] = set()
+        self._closed = False
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add_index(self, name: str, content: str) -> None:
+        """Adds the hashes of the packages listed in the 'Packages' index 'name'"""
+        folder = Path(name).parent
+        for filename, sha256 in package_hashes(content).items():
+            self.expected.setdefault(str(folder / filename), sha256)
+
+    def feed(self, data: bytes) -> None:
+        """Called with the data of the tar stream, in order"""
+        if self.error:
+            return
+        self._buffer += data
+        if len(self._buffer) >= HASH_BATCH_SIZE:
+            self._flush()
+
+    def member_found(self, extracted: bool) -> None:
+        """Called for every member of the stream, with whether it's extracted"""
+        with self._condition:
+            self._decisions.append(extracted)
+            self._condition.notify_all()
+
+    def member_written(self, member: tarfile.TarInfo) -> None:
+        name = normalise_member_name(member.name)
+        with self._condition:
+            if name not in self._verified:
+                self._written[name] = member
+                return
+            self._verified.discard(name)
+        self.on_complete(member)
+
+    def drain(self) -> None:
+        """Waits until all the members written so far are verified"""
+        self._flush()
+        with self._condition:
+            self._condition.wait_for(
+                lambda: not self._written
+                or self.error is not None
+                or not self._thread.is_alive()
+            )
+
+    def finish(self) -> None:
+        """Waits for the hashing thread to go through the rest of the stream. Raises
+        ChecksumMismatchError if a member didn't match its hash."""
+        self.stop()
+        if self.error:
+            raise self.error
+
+    def stop(self) -> None:
+        """Ends the stream and waits for the hashing thread"""
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        self._flush()
+        try:
+            self._pipe.close()
+        except PipeAborted:
+            pass
+        self._thread.join()
+
+    def _flush(self) -> None:
+        if not self._buffer:
+            return
+        try:
+            self._pipe.write(bytes(self._buffer))
+        except PipeAborted:
+            pass
+        self._buffer = bytearray()
+
+    def _run(self) -> None:
+        try:
+            with tarfile.open(fileobj=self._pipe, mode="r|") as tar:  # type: ignore
+                for member in tar:
+                    with self._condition:
+                        self._condition.wait_for(
+                            lambda: len(self._decisions) > 0 or self._closed
+                        )
+                        if not self._decisions:
+                            return
+                        extracted = self._decisions.popleft()
+                    if not extracted:
+                        continue
+                    name = normalise_member_name(member.name)
+                    if member.isreg():
+                        self._verify(tar, member, name)
+                    self._member_verified(name)
+        except ChecksumMismatchError as e:
+            logger.error(str(e))
+            with self._condition:
+                self.error = e
+                self._condition.notify_all()
+            self._pipe.abort()
+        except Exception as e:
+            # eg: the stream ended early because extraction failed
+            logger.debug(f"Stopped verifying extracted files: {e}")
+        finally:
+            # Don't let the extraction block feeding a stream nobody reads
+            self._pipe.abort()
+            with self._condition:
+                self._condition.notify_all()
+
+    def _verify(self, tar: tarfile.TarFile, member: tarfile.TarInfo, name: str) -> None:
+        expected = self.expected.get(name)
+        is_index = Path(name).name == "Packages"
+        if expected is None and not is_index:
+            return
+
+        digest = hashlib.sha256()
+        content = bytearray()
+        fileobj = tar.extractfile(member)
+        while fileobj:
+            chunk = fileobj.read(HASH_BATCH_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            if is_index:
+                content += chunk
+
+        if expected and digest.hexdigest() != expected:
+            self.corrupt_member = name
+            raise ChecksumMismatchError(f"Checksum of '{name}' doesn't match")
+        if is_index:
+            self.add_index(name, content.decode(errors="replace"))
+
+    def _member_verified(self, name: str) -> None:
+        with self._condition:
+            member = self._written.pop(name, None)
+            if member is None:
+                self._verified.add(name)
+            self._condition.notify_all()
+        if member is not None:
+            self.on_complete(member)
+
+
+class ExtractionEngine:
+    """Extracts compressed tarballs, decompressing them in background threads
+    while the calling thread writes the extracted files to disk.
+
+    Decompressed data is passed between threads through a bounded buffer, so
+    memory usage stays constant regardless of the size of the bundle. When the
+    file allows it (BGZF or multi-frame zstd), independent blocks are decompressed
+    in parallel using 'workers' threads.
+    """
+
+    def __init__(
+        self, workers: Optional[int] = None, max_buffered_chunks: int = 16
+    ) -> None:
+        self.workers = workers if workers else os.cpu_count() or 1
+        self.max_buffered_chunks = max_buffered_chunks
+
+    def extract(
+        self,
+        file: str,
+        destination: str,
+        on_progress: Optional[Callable] = None,
+        member_filter: Optional[Callable[[tarfile.TarInfo], bool]] = None,
+        total_size: Optional[int] = None,
+        on_member_extracted: Optional[Callable[[tarfile.TarInfo], None]] = None,
+        on_stats: Optional[Callable[[ProgressStats], None]] = None,
+        checkpoint_file: Optional[str] = None,
+        hashes: Optional[Dict[str, str]] = None,
+    ) -> None:
+        """Extracts 'file' into 'destination'. If provided, only the members for which
+        'member_filter' returns True are written to disk, and 'on_member_extracted'
+        is called once each of them is complete.
+
+        When the size of the content of the bundle is known, 'total_size' is used to
+        report progress by the amount of member data processed, including the data of
+        filtered out members; otherwise, the amount of compressed data read is used.
+
+        If 'checkpoint_file' is provided, the extraction state is saved there from time
+        to time; if it's interrupted, the next call continues where it was left.
+
+        If 'hashes' is provided, members are verified against them while they're
+        extracted, together with the package files listed in the 'Packages' indexes
+        of the bundle. Members are only reported once verified, and extraction stops
+        with ChecksumMismatchError as soon as one doesn't match."""
+        logger.info(f"Extracting {file} into {destination}")
+        if not Path(file).exists():
+            raise Exception(f"File {file} doesn't exist")
+
+        os.makedirs(destination, exist_ok=True)
+
+        checkpoint = None
+        if checkpoint_file:
+            checkpoint = self._load_checkpoint(checkpoint_file, file, destination)
+            if callable(on_member_extracted):
+                for name in checkpoint.members:
+                    on_member_extracted(tarfile.TarInfo(name))
+
+        meter = ProgressMeter(
+            total_size or os.path.getsize(file), on_progress, on_stats
+        )
+        if checkpoint and checkpoint.complete:
+            logger.info(f"{file} was already extracted into {destination}")
+            meter.finish()
+            return
+
+        # Continue from the last checkpoint if possible; otherwise, start over skipping
+        # the members that were already extracted
+        restart_offset = checkpoint.offset if checkpoint else None
+        if checkpoint and restart_offset is None and checkpoint.members:
+            extracted_members = set(checkpoint.members)
+            original_filter = member_filter
+
+            def skip_extracted(member: tarfile.TarInfo) -> bool:
+                if normalise_member_name(member.name) in extracted_members:
+                    return False
+                return not callable(original_filter) or original_filter(member)
+
+            member_filter = skip_extracted
+
+        # The archive is read as a stream so that it's decompressed only once
+        pipe = ChunkPipe(self.max_buffered_chunks)
+        producer = Thread(
+            target=self._decompress, args=(file, pipe, restart_offset), daemon=True
+        )
+        producer.start()
+
+        # Data of the members already processed, and where the current one starts
+        processed_bytes = 0
+        member_start = 0
+        member_size = 0
+        # Position of the tar stream in the pipe
+        stream_start = 0
+        if checkpoint and restart_offset is not None:
+            logger.info(f"Resuming extraction of {file} from offset {restart_offset}")
+            processed_bytes = checkpoint.processed_bytes
+            stream_start = checkpoint.skip
+
+        # Members written since the last checkpoint, flushed to disk before saving it
+        unsynced: List[str] = []
+
+        def report_member(member: tarfile.TarInfo) -> None:
+            if checkpoint:
+                checkpoint.add(member)
+                unsynced.append(normalise_member_name(member.name))
+            if callable(on_member_extracted):
+                on_member_extracted(member)
+
+        hasher = None
+        if hashes is not None:
+            hasher = MemberHasher(hashes, report_member, self.max_buffered_chunks)
+            if checkpoint:
+                self._load_indexes(hasher, checkpoint, destination)
+
+        def report_progress() -> None:
+            if total_size:
+                # The data of the current member is read while it's being written
+                current = min(pipe.consumed - member_start, member_size)
+                meter.update(processed_bytes + max(current, 0))
+            else:
+                meter.update(pipe.position)
+
+        pipe.on_read = report_progress
+
+        skipped_bytes = 0
+        last_checkpoint = processed_bytes
+        try:
+            # Data of the first block that was already extracted
+            pipe.read(stream_start)
+            if hasher:
+                pipe.on_data = hasher.feed
+            with tarfile.open(fileobj=pipe, mode="r|") as tar:  # type: ignore
+                for member in tar:
+                    if hasher and hasher.error:
+                        raise hasher.error
+                    processed_bytes += member_size
+                    member_start = pipe.consumed
+                    member_size = member.size
+                    if (
+                        checkpoint_file
+                        and checkpoint
+                        and processed_bytes - last_checkpoint >= CHECKPOINT_INTERVAL
+                    ):
+                        # Everything before this member is done
+                        if hasher:
+                            hasher.drain()
+                            if hasher.error:
+                                raise hasher.error
+                        self._save_checkpoint(
+                            checkpoint_file,
+                            checkpoint,
+                            pipe.restart_point(stream_start + member.offset),
+                            processed_bytes,
+                            destination,
+                            unsynced,
+                        )
+                        last_checkpoint = processed_bytes
+
+                    extracted = not callable(member_filter) or member_filter(member)
+                    if hasher:
+                        hasher.member_found(extracted)
+                    if not extracted:
+                        skipped_bytes += member.size
+                        continue
+                    self._unlink_target(destination, member)
+                    tar.extract(member=member, path=destination)
+                    if hasher:
+                        hasher.member_written(member)
+                    else:
+                        report_member(member)
+            if hasher:
+                hasher.finish()
+        except ChecksumMismatchError:
+            if hasher and hasher.corrupt_member:
+                Path(destination, hasher.corrupt_member).unlink(missing_ok=True)
+            raise
+        finally:
+            if hasher:
+                hasher.stop()
+            pipe.abort()
+            producer.join()
+
+        if skipped_bytes:
+            logger.info(f"Skipped {skipped_bytes} bytes of filtered out members")
+
+        if checkpoint_file and checkpoint:
+            checkpoint.complete = True
+            self._save_checkpoint(
+                checkpoint_file, checkpoint, None, 0, destination, unsynced
+            )
+
+        meter.finish()
+
+    @staticmethod
+    def _unlink_target(destination: str, member: tarfile.TarInfo) -> None:
+        # Files left by a previous extraction might be hardlinked into the package
+        # cache; writing over them would change the cached file too
+        if member.isdir():
+            return
+        path = Path(destination) / normalise_member_name(member.name)
+        if path.is_symlink() or path.is_file():
+            path.unlink()
+
+    def _load_checkpoint(
+        self, checkpoint_file: str, file: str, destination: str
+    ) -> ExtractionCheckpoint:
+        checkpoint = ExtractionCheckpoint.load(checkpoint_file)
+        if checkpoint is None or not checkpoint.is_for(file):
+            return ExtractionCheckpoint(bundle=ExtractionCheckpoint.bundle_id(file))
+
+        # Files written after the checkpoint was saved will be extracted again
+        if not checkpoint.verify(destination):
+            # The restart point can't be trusted, but the files that match can be kept
+            checkpoint.offset = None
+            checkpoint.skip = 0
+            checkpoint.processed_bytes = 0
+            checkpoint.complete = False
+        logger.info(
+            f"Found checkpoint with {len(checkpoint.members)} members extracted from {file}"
+        )
+        return checkpoint
+
+    def _load_indexes(
+        self, hasher: MemberHasher, checkpoint: ExtractionCheckpoint, destination: str
+    ) -> None:
+        # The package indexes extracted before resuming still describe the packages
+        # that are left to extract
+        for name in checkpoint.members:
+            if Path(name).name != "Packages":
+                continue
+            try:
+                hasher.add_index(name, (Path(destination) / name).read_text())
+            except Exception as e:
+                logger.warning(f"Couldn't read package index '{name}': {e}")
+
+    def _save_checkpoint(
+        self,
+        checkpoint_file: str,
+        checkpoint: ExtractionCheckpoint,
+        restart_point: Optional[Tuple[int, int]],
+        processed_bytes: int,
+        destination: str,
+        unsynced: List[str],
+    ) -> None:
+        # Without a restart point (eg: formats that can't be decompressed from the middle),
+        # the extracted members are still recorded so that they're not written again
+        checkpoint.offset, checkpoint.skip = (
+            restart_point if restart_point else (None, 0)
+        )
+        checkpoint.processed_bytes = processed_bytes if restart_point else 0
+        try:
+            sync_files(destination, unsynced)
+            unsynced.clear()
+            checkpoint.save(checkpoint_file)
+        except Exception as e:
+            logger.warning(f"Couldn't save extraction checkpoint: {e}")
+
+    def _decompress(
+        self, file: str, pipe: ChunkPipe, offset: Optional[int] = None
+    ) -> None:
+        error: Optional[BaseException] = None
+        try:
+            with open(file, "rb") as compressed_file:
+                compression_format = detect_format(compressed_file)
+                logger.info(f"{file} is a {compression_format.value} file")
+
+                if offset:
+                    # Restart from an independent block
+                    compressed_file.seek(offset)
+                    pipe.advance(offset)
+
+                decompressed = False
+                if self.workers > 1 or offset:
+                    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                        decompressed = decompress_parallel(
+                            compressed_file,
+                            compression_format,
+                            pipe.write,
+                            pipe.advance,
+                            executor,
+                            max_pending=2 * self.workers,
+                            on_block=pipe.mark_block,
+                        )
+                    if decompressed:
+                        logger.info(f"Decompressed {file} using {self.workers} threads")
+
+                if not decompressed:
+                    if offset:
+                        raise Exception(f"Can't resume decompression of {file}")
+                    decompress(
+                        compressed_file, compression_format, pipe.write, pipe.advance
+                    )
+        except PipeAborted:
+            return
+        except Exception as e:
+            logger.error(f"Error decompressing {file}: {e}")
+            error = e
+
+        try:
+            pipe.close(error)
+        except PipeAborted:
+            pass
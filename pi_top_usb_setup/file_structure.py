@@ -1,7 +1,7 @@
 import logging
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 from pitop.common.command_runner import run_command
 
@@ -21,17 +21,30 @@ def get_default_certificate_paths() -> Dict[str, Dict[str, str]]:
 
 @dataclass
 class MountPointStructure:
-    """Represents a mount point where a USB drive was mounted, where the compressed setup file is expected to be found"""
+    """Represents a mount point where a USB drive was mounted, where the compressed setup file
+    (or a setup image) is expected to be found"""
 
     mount_point: str
 
     # Glob patterns
-    USB_SETUP_FILENAME_GLOB: str = "pi-top-usb-setup*.tar.gz"
+    USB_SETUP_FILENAME_GLOBS: Tuple[str, ...] = (
+        "pi-top-usb-setup*.tar.gz",
+        "pi-top-usb-setup*.tar.zst",
+        "pi-top-usb-setup*.tar.xz",
+        "pi-top-usb-setup*.tar.lz4",
+        "pi-top-usb-setup*.squashfs",
+    )
+    # Setup bundles with this extension are filesystem images, mounted instead of extracted
+    USB_SETUP_IMAGE_SUFFIX: str = ".squashfs"
 
     def find_setup_files(self) -> List[Path]:
-        # find all setup files in mount point that match the glob pattern, sorted by date
+        # find all setup files in mount point that match the glob patterns, sorted by date
         return sorted(
-            Path(self.mount_point).glob(self.USB_SETUP_FILENAME_GLOB),
+            (
+                file
+                for pattern in self.USB_SETUP_FILENAME_GLOBS
+                for file in Path(self.mount_point).glob(pattern)
+            ),
             key=lambda x: x.stat().st_mtime,
             reverse=True,
         )
@@ -39,6 +52,9 @@ class MountPointStructure:
     def is_valid(self) -> bool:
         return len(self.find_setup_files()) > 0
 
+    def is_setup_image(self, file: Path) -> bool:
+        return file.suffix == self.USB_SETUP_IMAGE_SUFFIX
+
     @classmethod
     def is_valid_mount_point(cls, mount_point: str) -> bool:
         return cls(mount_point).is_valid()
@@ -94,6 +110,15 @@ class UsbSetupStructure:
             self.UPDATES_BOOKWORM_FOLDER if is_bookworm else self.UPDATES_FOLDER
         )
 
+    def unused_updates_folders(self) -> List[Path]:
+        """Update folders for other distros, relative to the directory"""
+        used_folder = self.updates_folder().name
+        return [
+            Path(self.SETUP_FOLDER) / folder
+            for folder in (self.UPDATES_FOLDER, self.UPDATES_BOOKWORM_FOLDER)
+            if folder != used_folder
+        ]
+
     def certificates_folder(self) -> Path:
         return self.folder() / self.CERTIFICATES_FOLDER
 
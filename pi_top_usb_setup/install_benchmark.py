@@ -0,0 +1,102 @@
+"""Compares how long installing the packages of an offline repository takes with each
+install profile.
+
+The packages of the repository that are installed with the same version are
+reinstalled, which goes through the same unpacking, configuration and triggers as an
+upgrade without changing the system. Run it as root in a device:
+
+    python3 -m pi_top_usb_setup.install_benchmark /path/to/pi-top-usb-setup/updates
+"""
+
+import logging
+import os
+from pathlib import Path
+from time import monotonic
+from typing import Dict, List, Optional
+
+import click
+
+from pi_top_usb_setup.apt_index import parse_packages_index
+from pi_top_usb_setup.dpkg_status import installed_versions
+from pi_top_usb_setup.system_updater import (
+    DEFAULT_PROFILE,
+    PROVISIONING_PROFILE,
+    InstallProfile,
+    SystemUpdater,
+)
+
+logger = logging.getLogger(__name__)
+
+PROFILES = {"default": DEFAULT_PROFILE, "provisioning": PROVISIONING_PROFILE}
+
+
+def benchmark_packages(repository: str, limit: Optional[int] = None) -> List[str]:
+    """Packages of the repository installed with the same version, as 'name=version'"""
+    installed = installed_versions()
+    packages = []
+    for fields in parse_packages_index((Path(repository) / "Packages").read_text()):
+        name, version = fields.get("Package"), fields.get("Version")
+        if name and version and installed.get(name) == version:
+            packages.append(f"{name}={version}")
+    return sorted(set(packages))[:limit]
+
+
+def run_benchmark(
+    repository: str,
+    packages: List[str],
+    profiles: Dict[str, InstallProfile] = PROFILES,
+    rounds: int = 1,
+) -> Dict[str, List[float]]:
+    """Seconds it takes to reinstall 'packages' with each profile, for every round.
+    Everything is flushed to disk before the time is taken, so that profiles that
+    don't sync aren't measured without the writes they leave pending."""
+    updater = SystemUpdater(apt_repository=repository)
+    updater.update()
+
+    durations: Dict[str, List[float]] = {name: [] for name in profiles}
+    for i in range(rounds):
+        # Alternate the order so that no profile always runs with warm caches
+        names = list(profiles)
+        if i % 2:
+            names.reverse()
+        for name in names:
+            logger.info(
+                f"Round {i + 1}: reinstalling {len(packages)} packages with the '{name}' profile"
+            )
+            os.sync()
+            start = monotonic()
+            SystemUpdater(apt_repository=repository, profile=profiles[name]).reinstall(
+                packages
+            )
+            os.sync()
+            durations[name].append(monotonic() - start)
+    return durations
+
+
+@click.command()
+@click.argument("repository", type=click.Path(exists=True, file_okay=False))
+@click.option("--rounds", default=2, show_default=True)
+@click.option("--limit", type=int, help="Maximum number of packages to reinstall")
+def main(repository: str, rounds: int, limit: Optional[int]) -> None:
+    logging.basicConfig(level=logging.INFO)
+    packages = benchmark_packages(repository, limit)
+    if not packages:
+        raise click.ClickException(
+            f"No package in {repository} is installed with the same version"
+        )
+
+    durations = run_benchmark(repository, packages, rounds=rounds)
+    for name, times in durations.items():
+        average = sum(times) / len(times)
+        click.echo(
+            f"{name}: {average:.1f}s on average ({', '.join(f'{t:.1f}s' for t in times)})"
+        )
+    default, provisioning = (
+        sum(durations[name]) / len(durations[name]) for name in PROFILES
+    )
+    if provisioning > 0:
+        click.echo(f"provisioning profile is {default / provisioning:.2f}x as fast")
+
+
+if __name__ == "__main__":
+    main(prog_name="install_benchmark")  # pragma: no cover
@@ -0,0 +1,172 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import tarfile
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+from pi_top_usb_setup.compression import detect_format, open_decompressed
+from pi_top_usb_setup.extraction import normalise_member_name
+
+logger = logging.getLogger(__name__)
+
+
+MANIFEST_FILENAME = "pi-top-usb-setup-manifest.json"
+MANIFEST_VERSION = 1
+SETUP_FOLDER = "pi-top-usb-setup"
+# Repository indexes archived at the beginning of bundles by 'list-bundle-files.sh'
+INDEX_FILENAMES = ("Packages", "Packages.gz", "Release")
+# Files next to the 'Packages' index that 'apt-get update' reads, if the repository has them
+RELEASE_FILENAMES = ("Release", "InRelease", "Release.gpg")
+
+
+@dataclass
+class BundleManifest:
+    """Describes the content of a setup bundle"""
+
+    # Size of every file in the bundle, by member name
+    members: Dict[str, int] = field(default_factory=dict)
+    # Size of the content of each folder inside of the setup folder (eg: 'pi-top-usb-setup/updates')
+    folder_sizes: Dict[str, int] = field(default_factory=dict)
+    total_size: int = 0
+    member_count: int = 0
+    # SHA256 of every file in the bundle, by member name
+    hashes: Dict[str, str] = field(default_factory=dict)
+    version: int = MANIFEST_VERSION
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "BundleManifest":
+        return cls(
+            members=data.get("members", {}),
+            folder_sizes=data.get("folder_sizes", {}),
+            total_size=data["total_size"],
+            member_count=data["member_count"],
+            hashes=data.get("hashes", {}),
+            version=data.get("version", MANIFEST_VERSION),
+        )
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+    @classmethod
+    def create(cls, directory: str) -> "BundleManifest":
+        """Creates the manifest for the setup folder inside of 'directory'"""
+        manifest = cls()
+        for root, dirs, files in os.walk(Path(directory) / SETUP_FOLDER):
+            manifest.member_count += len(dirs) + len(files)
+            for file in files:
+                path = Path(root) / file
+                if path.is_symlink():
+                    continue
+                name = str(path.relative_to(directory))
+                size = path.stat().st_size
+                manifest.members[name] = size
+                manifest.hashes[name] = file_hash(path)
+                manifest.total_size += size
+
+                parts = Path(name).parts
+                if len(parts) > 2:
+                    folder = str(Path(*parts[:2]))
+                    manifest.folder_sizes[folder] = (
+                        manifest.folder_sizes.get(folder, 0) + size
+                    )
+        # Count the setup folder itself
+        manifest.member_count += 1
+        return manifest
+
+    def extracted_size(self, skipped_folders: Iterable = ()) -> int:
+        """Size of the bundle content, leaving out the given folders"""
+        return self.total_size - sum(
+            self.folder_sizes.get(str(folder), 0) for folder in skipped_folders
+        )
+
+
+def file_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_manifest(member: tarfile.TarInfo) -> bool:
+    return normalise_member_name(member.name) == MANIFEST_FILENAME
+
+
+@dataclass
+class BundleHead:
+    """Files archived at the beginning of a compressed setup bundle"""
+
+    manifest: Optional[BundleManifest] = None
+    # Repository indexes of the requested folder, by name
+    index_files: Dict[str, bytes] = field(default_factory=dict)
+
+
+def read_bundle_head(file: str, folder: Optional[str] = None) -> BundleHead:
+    """Reads the manifest of a compressed setup bundle, if it has one, and the
+    repository indexes of 'folder', if they're archived before any other file, as
+    'list-bundle-files.sh' does. Only the beginning of the bundle is decompressed,
+    once for all of them."""
+    head = BundleHead()
+    try:
+        with open(file, "rb") as compressed_file:
+            with open_decompressed(
+                compressed_file, detect_format(compressed_file)
+            ) as reader:
+                with tarfile.open(fileobj=reader, mode="r|") as tar:
+                    for member in tar:
+                        if is_manifest(member):
+                            content = tar.extractfile(member).read()  # type: ignore
+                            head.manifest = _parse_manifest(file, content)
+                            continue
+                        if folder is None:
+                            break
+                        if not member.isreg():
+                            continue
+                        path = Path(normalise_member_name(member.name))
+                        if path.name not in INDEX_FILENAMES:
+                            break
+                        if path.parent == Path(folder):
+                            content = tar.extractfile(member).read()  # type: ignore
+                            head.index_files[path.name] = content
+    except Exception as e:
+        logger.warning(f"Couldn't read the beginning of {file}: {e}")
+    if head.manifest is None:
+        logger.info(f"{file} doesn't have a manifest")
+    if folder is not None and "Packages" not in head.index_files:
+        logger.info(f"{file} doesn't start with the {folder} index")
+    return head
+
+
+def _parse_manifest(file: str, content: bytes) -> Optional[BundleManifest]:
+    try:
+        return BundleManifest.from_dict(json.loads(content))
+    except Exception as e:
+        logger.warning(f"Couldn't read manifest from {file}: {e}")
+        return None
+
+
+def read_manifest(file: str) -> Optional[BundleManifest]:
+    """Reads the manifest of a compressed setup bundle, if it has one.
+    Only the beginning of the bundle is decompressed."""
+    return read_bundle_head(file).manifest
+
+
+def main() -> None:
+    # Usage: python3 -m pi_top_usb_setup.manifest <folder> > pi-top-usb-setup-manifest.json
+    # The manifest must be the first member of the bundle to be read without decompressing it all
+    parser = argparse.ArgumentParser(
+        description="Creates the manifest for a pi-top USB setup bundle"
+    )
+    parser.add_argument(
+        "directory", help=f"Folder that contains the '{SETUP_FOLDER}' directory"
+    )
+    args = parser.parse_args()
+    print(json.dumps(BundleManifest.create(args.directory).to_dict(), indent=2))
+
+
+if __name__ == "__main__":
+    main()  # pragma: no cover
@@ -1,8 +1,8 @@
 import json
 import logging
-from os import listdir, makedirs, path, walk
+from os import listdir, makedirs, path, scandir
 from shutil import copy2, rmtree
-from typing import Callable, Dict, Optional
+from typing import Callable, Dict, Iterator, Optional, Tuple
 
 from pitop.common.command_runner import run_command
 from pt_os_web_portal.backend.helpers.finalise import (
@@ -24,11 +24,29 @@ from pt_os_web_portal.backend.helpers.wifi_country import set_wifi_country
 
 from pi_top_usb_setup.file_structure import UsbSetupStructure
 from pi_top_usb_setup.network import Network
+from pi_top_usb_setup.progress import ProgressMeter, ProgressStats
 from pi_top_usb_setup.utils import print_folder_recursively
 
 logger = logging.getLogger(__name__)
 
 
+def scan_files(folder: str) -> Iterator[Tuple[str, int]]:
+    """Yields the path and size of every file inside 'folder', like 'os.walk' would
+    find them. Sizes come from the directory scan itself, so each file is only
+    stat'ed once."""
+    subfolders = []
+    with scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                # Symlinks to folders are not followed
+                if not entry.is_symlink():
+                    subfolders.append(entry.path)
+            else:
+                yield entry.path, entry.stat().st_size
+    for subfolder in subfolders:
+        yield from scan_files(subfolder)
+
+
 class CoreOperations:
     def __init__(self, fs: UsbSetupStructure) -> None:
         self.fs = fs
@@ -154,7 +172,11 @@ class CoreOperations:
                 logger.info(f"Running command '{command}' ...")
                 run_command(command, timeout=60)
 
-    def copy_files(self, on_progress: Optional[Callable] = None) -> None:
+    def copy_files(
+        self,
+        on_progress: Optional[Callable] = None,
+        on_stats: Optional[Callable[[ProgressStats], None]] = None,
+    ) -> None:
         """Copies the files from the files directory of the setup bundle into the device"""
         logger.info("Copying files...")
 
@@ -168,31 +190,29 @@ class CoreOperations:
         except Exception as e:
             logger.error(f"Error listing files in {files_folder_path}: {e}")
 
-        total_files = sum(len(files) for _, _, files in walk(str(files_folder_path)))
-        files_copied = 0
+        # Progress is measured by the amount of data copied
+        files = list(scan_files(str(files_folder_path)))
+        meter = ProgressMeter(sum(size for _, size in files), on_progress, on_stats)
 
-        for root, dirs, files in walk(str(files_folder_path)):
-            for file in files:
-                source_path = path.join(root, file)
+        for source_path, size in files:
+            # Get the relative path from the source_dir
+            relative_path = path.relpath(source_path, str(files_folder_path))
 
-                # Get the relative path from the source_dir
-                relative_path = path.relpath(source_path, str(files_folder_path))
+            # Destination path based on root
+            destination_path = path.join("/", relative_path)
 
-                # Destination path based on root
-                destination_path = path.join("/", relative_path)
+            # Create target directory if it doesn't exist
+            makedirs(path.dirname(destination_path), exist_ok=True)
 
-                # Create target directory if it doesn't exist
-                makedirs(path.dirname(destination_path), exist_ok=True)
+            # Copy file
+            copy2(source_path, destination_path)
+            logger.info(f"Copied file {source_path} to {destination_path}")
 
-                # Copy file
-                copy2(source_path, destination_path)
-                logger.info(f"Copied file {source_path} to {destination_path}")
+            # Update progress
+            meter.advance(size)
 
-                # Update progress
-                files_copied += 1
-                if on_progress:
-                    progress = int((files_copied / total_files) * 100)
-                    on_progress(progress)
+        if files:
+            meter.finish()
 
     def run_scripts(self, on_progress: Optional[Callable] = None) -> None:
         """Runs the scripts from the scripts directory of the setup bundle"""
@@ -1,74 +1,653 @@
 import logging
+import shutil
+import tarfile
 from pathlib import Path
-from typing import Callable, Optional
+from tempfile import mkdtemp
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
-from pi_top_usb_setup.exceptions import ExtractionError, NotEnoughSpaceException
-from pi_top_usb_setup.file_structure import MountPointStructure
+from pi_top_usb_setup.apt_index import package_hashes, rewrite_release
+from pi_top_usb_setup.compression import get_extracted_size
+from pi_top_usb_setup.dependency_check import verify_dependencies
+from pi_top_usb_setup.disk_planner import DiskPlan, plan_disk_usage
+from pi_top_usb_setup.dpkg_status import installed_versions, status_index
+from pi_top_usb_setup.exceptions import (
+    ChecksumMismatchError,
+    ExtractionError,
+    NotEnoughSpaceException,
+)
+from pi_top_usb_setup.extraction import (
+    CHECKPOINT_FILENAME,
+    EXTRACTION_MARKER,
+    ExtractionCheckpoint,
+    ExtractionEngine,
+    normalise_member_name,
+    skip_folders,
+    skip_members,
+)
+from pi_top_usb_setup.file_structure import MountPointStructure, UsbSetupStructure
+from pi_top_usb_setup.manifest import (
+    INDEX_FILENAMES,
+    RELEASE_FILENAMES,
+    BundleHead,
+    is_manifest,
+    read_bundle_head,
+)
+from pi_top_usb_setup.package_cache import PackageCache
+from pi_top_usb_setup.progress import ProgressStats
+from pi_top_usb_setup.storage import (
+    choose_extraction_directory,
+    existing_parent,
+    same_filesystem,
+)
+from pi_top_usb_setup.update_planner import UpdatePlan, plan_updates
 from pi_top_usb_setup.utils import (
     drive_has_enough_free_space,
-    extract_file,
-    get_tar_gz_extracted_size,
+    mount_image,
+    umount_image,
     umount_usb_drive,
 )
 
 logger = logging.getLogger(__name__)
 
+# Folder created to extract a bundle into when the chosen one has other files in it
+EXTRACTION_SUBFOLDER = "pi-top-usb-setup-extraction"
+
 
 class MountPointOperations:
-    def __init__(self, structure: MountPointStructure) -> None:
+    def __init__(
+        self,
+        structure: MountPointStructure,
+        extraction_engine: Optional[ExtractionEngine] = None,
+        package_cache: Optional[PackageCache] = None,
+        usb_drive: Optional[MountPointStructure] = None,
+        mounted_image: Optional[Path] = None,
+    ) -> None:
         self.structure = structure
+        # USB drive umounted once the setup is done; after a restart, 'structure' is
+        # the folder the previous instance extracted the bundle into (or mounted it)
+        self.usb_drive = usb_drive if usb_drive else structure
+        # Packages found in the cache are linked from it instead of extracted
+        self.package_cache = package_cache
+        self.extraction_engine = (
+            extraction_engine if extraction_engine else ExtractionEngine()
+        )
+        self.mounted_image = mounted_image
+        self.extracting = False
+        # Updates folder in the USB drive used directly by apt, if any
+        self.updates_in_place: Optional[Path] = None
+        # Packages of the bundle the upgrade will use, when only those are extracted
+        self.update_plan: Optional[UpdatePlan] = None
+        self._index_files: Dict[str, bytes] = {}
+        # Manifest and updates indexes of each bundle, by bundle and updates folder
+        self._bundle_heads: Dict[Tuple[str, str], BundleHead] = {}
 
     def extract_setup_file(
-        self, destination: Path, on_progress: Optional[Callable] = None
+        self,
+        destination: Path,
+        on_progress: Optional[Callable] = None,
+        on_member_extracted: Optional[Callable[[tarfile.TarInfo], None]] = None,
+        on_stats: Optional[Callable[[ProgressStats], None]] = None,
+        resumable: bool = False,
     ) -> None:
-        """Extracts the newest compressed setup bundle found in the mount point"""
+        """Extracts the newest compressed setup bundle found in the mount point.
+        Setup images are mounted in the destination instead.
+
+        If 'resumable', an interrupted extraction of the same bundle into 'destination'
+        is continued. Files of other bundles found in 'destination' are removed if it
+        was created to extract bundles into (see 'extraction_directory')."""
         files = self.structure.find_setup_files()
         if len(files) >= 1:
             logger.info(f"Found {len(files)} setup files; will use '{files[0]}'...")
-            self._do_extract_setup_file(files[0], destination, on_progress)
+            if self.structure.is_setup_image(files[0]):
+                self._mount_setup_image(files[0], destination)
+                return
+
+            self.extracting = True
+            try:
+                self._do_extract_setup_file(
+                    files[0],
+                    destination,
+                    on_progress,
+                    on_member_extracted,
+                    on_stats,
+                    resumable,
+                )
+            finally:
+                self.extracting = False
         else:
             logger.warning(
                 f"No compressed setup file found in '{self.structure.mount_point}'; skipping extraction"
             )
 
     def _do_extract_setup_file(
-        self, filename: Path, destination: Path, on_progress: Optional[Callable] = None
+        self,
+        filename: Path,
+        destination: Path,
+        on_progress: Optional[Callable] = None,
+        on_member_extracted: Optional[Callable[[tarfile.TarInfo], None]] = None,
+        on_stats: Optional[Callable[[ProgressStats], None]] = None,
+        resumable: bool = False,
     ) -> None:
         """Extracts the given filename into a temporary folder"""
         if not filename.exists():
             logger.warning(f"File '{filename}' doesn't exist; skipping extraction")
             return
 
-        # Get extracted size of the tar.gz file
+        checkpoint_file = None
+        already_extracted: Optional[int] = 0
+        if resumable and self._take_extraction_directory(destination):
+            checkpoint_file = str(destination / CHECKPOINT_FILENAME)
+            already_extracted = self._already_extracted(filename, destination)
+            if already_extracted is None:
+                logger.info(f"Removing files from a previous setup in {destination}")
+                shutil.rmtree(destination)
+                self._take_extraction_directory(destination)
+
+        unused_folders = self._unused_folders(destination)
+        logger.info(f"Skipping extraction of {[str(f) for f in unused_folders]}")
+        skip_unused_folders = skip_folders(unused_folders)
+
+        def is_extracted(member: tarfile.TarInfo) -> bool:
+            return not is_manifest(member) and skip_unused_folders(member)
+
+        member_filter: Callable[[tarfile.TarInfo], bool] = is_extracted
+
+        # Get extracted size from the bundle manifest or the compressed file
+        manifest = self._bundle_head(filename, destination).manifest
         try:
-            space = get_tar_gz_extracted_size(str(filename))
+            if manifest:
+                space = manifest.extracted_size(unused_folders)
+            else:
+                space = get_extracted_size(str(filename))
         except Exception as e:
             raise ExtractionError(f"Error getting extracted size of '{filename}', {e}")
 
-        # Check if there's enough free space in the SD card
-        drive = "/"
-        if not drive_has_enough_free_space(drive=drive, space=space):
-            raise NotEnoughSpaceException(
-                f"Not enough space to extract '{filename}' into {drive}"
+        hashes = dict(manifest.hashes) if manifest else {}
+        if self.update_plan:
+            skipped_members = self._write_update_plan(destination, on_member_extracted)
+            skip_update_files = skip_members(skipped_members)
+
+            def is_extracted_update(member: tarfile.TarInfo) -> bool:
+                return is_extracted(member) and skip_update_files(member)
+
+            member_filter = is_extracted_update
+            if manifest:
+                space -= sum(manifest.members.get(name, 0) for name in skipped_members)
+            # The original index isn't extracted, but packages are still checked against it
+            hashes.update(self._index_hashes(destination))
+
+        if self.package_cache:
+            if not self._index_files and not self.updates_in_place:
+                # Packages are found in the cache by the hashes in their index
+                self._index_files = self._bundle_head(filename, destination).index_files
+                hashes.update(self._index_hashes(destination))
+            cached_members = self._link_cached_packages(
+                destination, hashes, member_filter, on_member_extracted
+            )
+            if cached_members:
+                skip_cached = skip_members(cached_members)
+                previous_filter = member_filter
+
+                def is_not_cached(member: tarfile.TarInfo) -> bool:
+                    return previous_filter(member) and skip_cached(member)
+
+                member_filter = is_not_cached
+                if manifest:
+                    space -= sum(
+                        manifest.members.get(name, 0) for name in cached_members
+                    )
+            on_member_extracted = self._cache_packages(
+                destination, hashes, on_member_extracted
+            )
+
+        # Check if there's enough free space for what's left to extract, in the
+        # filesystem that receives it
+        drive = str(existing_parent(destination))
+        if not drive_has_enough_free_space(
+            drive=drive, space=max(space - (already_extracted or 0), 0)
+        ):
+            if manifest:
+                raise NotEnoughSpaceException(
+                    f"Not enough space to extract '{filename}' into {drive}"
+                )
+
+            # The size of the whole bundle includes the updates for other distros, which
+            # won't be extracted; check the free space while extracting instead
+            logger.warning(
+                f"Size of the whole '{filename}' content is bigger than the free space in {drive}; "
+                "will check free space while extracting"
             )
+            member_filter = self._check_free_space(member_filter, drive)
 
         try:
-            extract_file(
+            self.extraction_engine.extract(
                 file=str(filename),
                 destination=str(destination),
                 on_progress=on_progress,
+                member_filter=member_filter,
+                # Progress is measured over the whole bundle, skipped members included
+                total_size=manifest.total_size if manifest else space,
+                on_member_extracted=on_member_extracted,
+                on_stats=on_stats,
+                checkpoint_file=checkpoint_file,
+                # Without a manifest, packages are still checked against their index
+                hashes=hashes,
             )
             logger.info(f"File {filename} extracted into {destination}")
+        except (NotEnoughSpaceException, ChecksumMismatchError):
+            raise
         except Exception as e:
             raise ExtractionError(f"Error extracting '{filename}': {e}")
 
+        if self.package_cache:
+            self.package_cache.evict(keep=set(hashes.values()))
+
+    def _link_cached_packages(
+        self,
+        destination: Path,
+        hashes: Dict[str, str],
+        member_filter: Callable[[tarfile.TarInfo], bool],
+        on_member_extracted: Optional[Callable[[tarfile.TarInfo], None]] = None,
+    ) -> List[str]:
+        """Links the packages of the bundle that are in the package cache into
+        'destination'. Returns the members that don't need to be extracted."""
+        assert self.package_cache is not None
+        files = {
+            destination / name: sha256
+            for name, sha256 in hashes.items()
+            if name.endswith(".deb") and member_filter(tarfile.TarInfo(name))
+        }
+        linked = self.package_cache.link_packages(files)
+        members = [str(path.relative_to(destination)) for path in linked]
+        for name in members:
+            if callable(on_member_extracted):
+                on_member_extracted(tarfile.TarInfo(name))
+        return members
+
+    def _cache_packages(
+        self,
+        destination: Path,
+        hashes: Dict[str, str],
+        on_member_extracted: Optional[Callable[[tarfile.TarInfo], None]] = None,
+    ) -> Callable[[tarfile.TarInfo], None]:
+        """Wraps 'on_member_extracted' to add the extracted packages to the package
+        cache; they're only reported once their hash was checked"""
+        assert self.package_cache is not None
+        cache = self.package_cache
+        if not cache.usable_for(destination):
+            logger.info(
+                f"{cache.directory} is in another filesystem than {destination}; not caching packages"
+            )
+            return lambda member: (
+                on_member_extracted(member) if callable(on_member_extracted) else None
+            )
+
+        def on_extracted(member: tarfile.TarInfo) -> None:
+            name = normalise_member_name(member.name)
+            if name.endswith(".deb") and name in hashes:
+                cache.add(destination / name, hashes[name])
+            if callable(on_member_extracted):
+                on_member_extracted(member)
+
+        return on_extracted
+
+    def _bundle_head(self, bundle: Path, destination: Path) -> BundleHead:
+        """Manifest and updates indexes of 'bundle'; the bundle is only decompressed
+        to read them the first time"""
+        folder = str(self._updates_folder_member(destination))
+        key = (str(bundle), folder)
+        if key not in self._bundle_heads:
+            self._bundle_heads[key] = read_bundle_head(str(bundle), folder)
+        return self._bundle_heads[key]
+
+    def _updates_folder_member(self, destination: Path) -> Path:
+        """Name of the updates folder used by this device inside of the bundle"""
+        extracted_fs = UsbSetupStructure(str(destination))
+        return Path(extracted_fs.SETUP_FOLDER) / extracted_fs.updates_folder().name
+
+    def plan_updates(self, destination: Path) -> Optional[UpdatePlan]:
+        """Compares the packages in the bundle with the installed ones so that only the
+        packages that the upgrade will install are extracted, together with a
+        'Packages' index that only lists them.
+
+        The index must be archived at the beginning of the bundle, as
+        'list-bundle-files.sh' does; otherwise, all of the packages are extracted."""
+        self.update_plan = None
+        files = self.structure.find_setup_files()
+        if (
+            not files
+            or self.structure.is_setup_image(files[0])
+            or self.updates_in_place
+        ):
+            return None
+
+        index_files = self._bundle_head(files[0], destination).index_files
+        if "Packages" not in index_files:
+            return None
+
+        try:
+            installed = installed_versions()
+            installed_provides = status_index.provides()
+        except Exception as e:
+            logger.warning(f"Couldn't get installed packages: {e}")
+            return None
+
+        self.update_plan = plan_updates(
+            index_files["Packages"].decode(errors="replace"),
+            installed,
+            installed_provides,
+        )
+        self._index_files = index_files
+        return self.update_plan
+
+    def _write_update_plan(
+        self,
+        destination: Path,
+        on_member_extracted: Optional[Callable[[tarfile.TarInfo], None]] = None,
+    ) -> List[str]:
+        """Writes the indexes of the packages in the update plan into the updates
+        folder in 'destination'. Returns the members of the bundle that are replaced by
+        them or left out."""
+        assert self.update_plan is not None
+        folder = self._updates_folder_member(destination)
+        (destination / folder).mkdir(parents=True, exist_ok=True)
+
+        packages = self.update_plan.packages_index.encode()
+        written = {"Packages": packages}
+        if "Release" in self._index_files:
+            written["Release"] = rewrite_release(
+                self._index_files["Release"].decode(errors="replace"), written
+            ).encode()
+        for name, content in written.items():
+            (destination / folder / name).write_bytes(content)
+            if callable(on_member_extracted):
+                on_member_extracted(tarfile.TarInfo(str(folder / name)))
+
+        skipped = [str(folder / name) for name in INDEX_FILENAMES]
+        skipped += [str(folder / name) for name in self.update_plan.skipped_files]
+        logger.info(
+            f"Extracting {len(self.update_plan.files)} packages, "
+            f"skipping {len(self.update_plan.skipped_files)}"
+        )
+        return skipped
+
+    def _index_hashes(self, destination: Path) -> Dict[str, str]:
+        folder = self._updates_folder_member(destination)
+        index = self._index_files.get("Packages", b"").decode(errors="replace")
+        return {
+            str(folder / name): sha256 for name, sha256 in package_hashes(index).items()
+        }
+
+    def choose_extraction_directory(self, preferred: Path) -> Path:
+        """Chooses the folder to extract the setup bundle into, out of 'preferred', the
+        system folders in other disk filesystems and the folders created by previous
+        extractions, by their free space and write speed. Memory-backed filesystems
+        like tmpfs and the USB drive itself are never used."""
+        files = self.structure.find_setup_files()
+        if not files or self.structure.is_setup_image(files[0]):
+            return preferred
+
+        # The manifest knows what will be extracted; otherwise, the compressed size is
+        # the best guess that doesn't require decompressing the bundle
+        manifest = self._bundle_head(files[0], preferred).manifest
+        needed_space = (
+            manifest.extracted_size(self._unused_folders(preferred))
+            if manifest
+            else files[0].stat().st_size
+        )
+        return choose_extraction_directory(
+            preferred,
+            needed_space,
+            exclude=[self.structure.mount_point],
+            checkpoint_filename=CHECKPOINT_FILENAME,
+            marker_filename=EXTRACTION_MARKER,
+        )
+
+    def _is_protected(self, directory: Path) -> bool:
+        """Whether 'directory' holds the USB drive or the setup bundle"""
+        directory = directory.resolve()
+        protected = [Path(self.usb_drive.mount_point).resolve()]
+        protected += [file.resolve() for file in self.structure.find_setup_files()]
+        return any(directory == path or directory in path.parents for path in protected)
+
+    def owns_extraction_directory(self, directory: Path) -> bool:
+        """Whether 'directory' was created to extract bundles into, so that the files
+        in it can be removed"""
+        return (directory / EXTRACTION_MARKER).exists() and not self._is_protected(
+            directory
+        )
+
+    def _can_extract_into(self, directory: Path) -> bool:
+        if not directory.exists() or self.owns_extraction_directory(directory):
+            return True
+        return not self._is_protected(directory) and not any(directory.iterdir())
+
+    def extraction_directory(self, destination: Path) -> Path:
+        """Returns the folder to extract the setup bundle into: 'destination' if it
+        doesn't exist, is empty or was created to extract bundles into; otherwise (eg:
+        the USB drive), a folder inside of it, so that nothing in it is removed."""
+        files = self.structure.find_setup_files()
+        if (
+            not files
+            or self.structure.is_setup_image(files[0])
+            or self._can_extract_into(destination)
+        ):
+            return destination
+
+        folder = destination / EXTRACTION_SUBFOLDER
+        if not self._can_extract_into(folder):
+            folder = Path(mkdtemp(prefix=f"{EXTRACTION_SUBFOLDER}-", dir=destination))
+            (folder / EXTRACTION_MARKER).touch()
+        logger.info(f"{destination} has other files; extracting into {folder}")
+        return folder
+
+    def _take_extraction_directory(self, destination: Path) -> bool:
+        """Marks 'destination' as created to extract bundles into, if it's new or
+        empty. Returns False if it has other files, which are never removed."""
+        if self.owns_extraction_directory(destination):
+            return True
+        if not self._can_extract_into(destination):
+            logger.warning(
+                f"{destination} wasn't created to extract bundles into; extracting "
+                "over the files in it, without resuming interrupted extractions"
+            )
+            return False
+        destination.mkdir(parents=True, exist_ok=True)
+        (destination / EXTRACTION_MARKER).touch()
+        return True
+
+    def _unused_folders(self, destination: Path) -> List[Path]:
+        # Only the updates for the distro running in the device are extracted, unless
+        # they're installed from the USB drive
+        extracted_fs = UsbSetupStructure(str(destination))
+        unused_folders = extracted_fs.unused_updates_folders()
+        if self.updates_in_place:
+            unused_folders.append(
+                Path(extracted_fs.SETUP_FOLDER) / extracted_fs.updates_folder().name
+            )
+        return unused_folders
+
+    def _already_extracted(self, filename: Path, destination: Path) -> Optional[int]:
+        """Size of the files of 'filename' extracted into 'destination' by an interrupted
+        extraction; None if there's none"""
+        checkpoint = ExtractionCheckpoint.load(str(destination / CHECKPOINT_FILENAME))
+        if checkpoint is None or not checkpoint.is_for(str(filename)):
+            return None
+        return sum(size for size, _ in filter(None, checkpoint.members.values()))
+
+    def plan_disk_usage(
+        self, destination: Path, install_updates: bool = False
+    ) -> List[DiskPlan]:
+        """Checks that there's enough free space to extract the setup bundle into
+        'destination' and, if 'install_updates', to install the updates in it.
+        Returns a plan for each of the filesystems involved, raising
+        NotEnoughSpaceException with the missing space if any of them doesn't fit.
+
+        The size of the extracted files comes from the bundle manifest; without it,
+        free space is checked while extracting instead. Updates are planned using the
+        'Packages' index of the bundle, if it's archived at its beginning."""
+        files = self.structure.find_setup_files()
+        bundle = files[0] if files else None
+        if bundle and self.structure.is_setup_image(bundle):
+            # Images are mounted, and their index can't be read until then
+            bundle = None
+
+        extraction_size = 0
+        manifest = self._bundle_head(bundle, destination).manifest if bundle else None
+        if bundle and manifest:
+            extraction_size = max(
+                manifest.extracted_size(self._unused_folders(destination))
+                - (self._already_extracted(bundle, destination) or 0),
+                0,
+            )
+
+        packages_index = None
+        if bundle and manifest and self.update_plan:
+            # Only the packages in the plan are extracted
+            folder = self._updates_folder_member(destination)
+            extraction_size -= sum(
+                manifest.members.get(str(folder / name), 0)
+                for name in self.update_plan.skipped_files
+            )
+            extraction_size = max(extraction_size, 0)
+
+        if install_updates:
+            packages_index = self._packages_index(destination)
+
+        # Packages are installed into the root filesystem, which might not be the one
+        # the bundle is extracted into
+        drive = str(existing_parent(destination))
+        if same_filesystem(drive, "/"):
+            plans = [plan_disk_usage(drive, extraction_size, packages_index)]
+        else:
+            plans = [
+                plan_disk_usage(drive, extraction_size),
+                plan_disk_usage("/", 0, packages_index),
+            ]
+        for plan in plans:
+            if not plan.fits:
+                raise NotEnoughSpaceException(
+                    f"Not enough space in {plan.drive} for setup: {plan}"
+                )
+        return plans
+
+    def _packages_index(self, destination: Path) -> Optional[str]:
+        """'Packages' index of the updates that will be installed, if it can be read
+        before extracting the bundle"""
+        if self.updates_in_place:
+            return (self.updates_in_place / "Packages").read_text()
+        if self.update_plan:
+            return self.update_plan.packages_index
+        files = self.structure.find_setup_files()
+        if not files or self.structure.is_setup_image(files[0]):
+            return None
+        index = self._bundle_head(files[0], destination).index_files.get("Packages")
+        return index.decode(errors="replace") if index is not None else None
+
+    def release_files(self, destination: Path) -> List[str]:
+        """Files next to the 'Packages' index of the updates that 'apt-get update'
+        reads, as listed in the manifest of the bundle; without it, only 'Release' is
+        expected"""
+        files = self.structure.find_setup_files()
+        manifest = None
+        if files and not self.structure.is_setup_image(files[0]):
+            try:
+                manifest = self._bundle_head(files[0], destination).manifest
+            except Exception as e:
+                logger.warning(f"Couldn't read manifest of '{files[0]}': {e}")
+        if manifest is None:
+            return ["Release"]
+        folder = self._updates_folder_member(destination)
+        return [
+            name for name in RELEASE_FILENAMES if str(folder / name) in manifest.members
+        ]
+
+    def check_dependencies(self, destination: Path) -> Optional[Set[str]]:
+        """Checks that the updates include every package the upgrade needs, raising
+        UnmetDependenciesError if an essential package would be held back. Returns
+        the packages to hold back, or None if the 'Packages' index can't be read
+        before extracting the bundle, so the check wasn't done."""
+        packages_index = self._packages_index(destination)
+        if packages_index is None:
+            return None
+        return verify_dependencies(packages_index)
+
+    def _check_free_space(
+        self, member_filter: Callable[[tarfile.TarInfo], bool], drive: str
+    ) -> Callable[[tarfile.TarInfo], bool]:
+        def check(member: tarfile.TarInfo) -> bool:
+            if not member_filter(member):
+                return False
+            _, _, free_space = shutil.disk_usage(drive)
+            if member.size >= free_space:
+                raise NotEnoughSpaceException(
+                    f"Not enough space to extract '{member.name}' into {drive}"
+                )
+            return True
+
+        return check
+
+    def _mount_setup_image(self, filename: Path, destination: Path) -> None:
+        """Mounts the given setup image read-only in the destination folder"""
+        try:
+            mount_image(str(filename), str(destination))
+            self.mounted_image = destination
+            logger.info(f"Image {filename} mounted in {destination}")
+        except Exception as e:
+            raise ExtractionError(f"Error mounting '{filename}': {e}")
+
+    def umount_setup_image(self) -> None:
+        """Umounts the setup image, if one was mounted"""
+        if self.mounted_image is None:
+            return
+        umount_image(str(self.mounted_image))
+        self.mounted_image = None
+
+    def updates_in_usb_drive(self) -> Optional[Path]:
+        """Returns the updates folder of a setup bundle already extracted in the USB drive"""
+        folder = UsbSetupStructure(self.structure.mount_point).updates_folder()
+        if (folder / "Packages").exists():
+            return folder
+        return None
+
+    def use_updates_in_place(self) -> Optional[Path]:
+        """If the USB drive has an extracted updates folder, it's used from there instead
+        of extracting it; the USB drive is kept mounted until 'release_updates' is called
+        """
+        self.updates_in_place = self.updates_in_usb_drive()
+        if self.updates_in_place:
+            logger.info(f"Updates will be installed from {self.updates_in_place}")
+        return self.updates_in_place
+
+    def release_updates(self) -> None:
+        """Umounts the USB drive once the updates in it are not needed anymore"""
+        if self.updates_in_place is None:
+            return
+        self.updates_in_place = None
+        self.umount_usb_drive()
+
     def umount_usb_drive(self) -> None:
         """Umounts the USB drive"""
-        if self.usb_drive_is_present:
-            umount_usb_drive(self.structure.mount_point)
+        if self.mounted_image:
+            logger.info(
+                f"Setup image is mounted in {self.mounted_image}; not umounting USB drive"
+            )
+        elif self.usb_drive_in_use:
+            logger.info("Files in the USB drive are still in use; not umounting it")
+        elif self.usb_drive_is_present:
+            umount_usb_drive(self.usb_drive.mount_point)
         else:
             logger.info("No USB drive to umount, skipping ...")
 
     @property
     def usb_drive_is_present(self) -> bool:
-        return self.structure.is_usb_drive()
+        return self.usb_drive.is_usb_drive()
+
+    @property
+    def usb_drive_in_use(self) -> bool:
+        """Whether files in the USB drive are still needed"""
+        return (
+            self.extracting
+            or self.mounted_image is not None
+            or self.updates_in_place is not None
+        )
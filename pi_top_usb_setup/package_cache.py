@@ -0,0 +1,134 @@
+import logging
+import os
+from pathlib import Path
+from time import time_ns
+from typing import Dict, Iterable, List, Optional, Set, Union
+
+from pi_top_usb_setup.storage import existing_parent, same_filesystem
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIRECTORY = "/var/cache/pi-top-usb-setup"
+# Once the cache grows over this size, the least recently used packages are removed
+MAX_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+
+
+class PackageCache:
+    """Store of package files from previous bundles, by SHA256.
+
+    Files are hardlinked in and out of the store, so they're only kept in
+    repositories in the same filesystem. Using a file updates its access time, which
+    is what the least recently used ones are evicted by; the modification time is
+    shared with the extracted files, and checked when resuming an extraction."""
+
+    def __init__(
+        self,
+        directory: Union[str, Path] = CACHE_DIRECTORY,
+        max_size: int = MAX_CACHE_SIZE,
+    ) -> None:
+        self.directory = Path(directory)
+        self.max_size = max_size
+
+    def path(self, sha256: str) -> Path:
+        return self.directory / "sha256" / sha256[:2] / sha256
+
+    def has(self, sha256: str) -> bool:
+        return self.path(sha256).is_file()
+
+    def usable_for(self, folder: Union[str, Path]) -> bool:
+        """Whether files can be hardlinked between the store and 'folder'"""
+        try:
+            return same_filesystem(self.directory, folder) and os.access(
+                existing_parent(self.directory), os.W_OK
+            )
+        except OSError:
+            return False
+
+    def add(self, file: Union[str, Path], sha256: str) -> bool:
+        """Adds a file whose content was verified to match 'sha256' to the store"""
+        path = self.path(sha256)
+        try:
+            if path.exists():
+                self._mark_used(path)
+                return True
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Linked with a temporary name first, so that the store never has a
+            # file under a hash it doesn't match
+            temporary = path.with_name(f".{sha256}.{os.getpid()}")
+            temporary.unlink(missing_ok=True)
+            os.link(file, temporary)
+            temporary.rename(path)
+            self._mark_used(path)
+            return True
+        except OSError as e:
+            logger.warning(f"Couldn't add {file} to package cache: {e}")
+            return False
+
+    def link_packages(self, files: Dict[Path, str]) -> List[Path]:
+        """Hardlinks the packages in the store into the given paths, by SHA256.
+        Returns the paths that were linked."""
+        linked: List[Path] = []
+        if not files:
+            return linked
+        folder = os.path.commonpath([str(path) for path in files])
+        if not self.directory.exists() or not self.usable_for(folder):
+            return linked
+
+        for destination, sha256 in files.items():
+            source = self.path(sha256)
+            try:
+                if not source.is_file():
+                    continue
+                if destination.exists():
+                    if destination.stat().st_ino != source.stat().st_ino:
+                        continue
+                else:
+                    destination.parent.mkdir(parents=True, exist_ok=True)
+                    os.link(source, destination)
+                self._mark_used(source)
+                linked.append(destination)
+            except OSError as e:
+                logger.warning(f"Couldn't link {destination} from package cache: {e}")
+        if linked:
+            logger.info(f"Linked {len(linked)} packages from {self.directory}")
+        return linked
+
+    @staticmethod
+    def _mark_used(path: Path) -> None:
+        os.utime(path, ns=(time_ns(), path.stat().st_mtime_ns))
+
+    def _entries(self) -> Iterable[Path]:
+        for path in self.directory.glob("sha256/*/*"):
+            if not path.name.startswith("."):
+                yield path
+
+    def size(self) -> int:
+        return sum(path.stat().st_size for path in self._entries())
+
+    def evict(self, keep: Optional[Set[str]] = None) -> int:
+        """Removes the least recently used files until the store fits in 'max_size',
+        leaving the ones with a hash in 'keep'. Returns the number of bytes removed."""
+        keep = keep or set()
+        try:
+            entries = [(path, path.stat()) for path in self._entries()]
+        except OSError as e:
+            logger.warning(f"Couldn't read package cache: {e}")
+            return 0
+
+        total = sum(stat.st_size for _, stat in entries)
+        removed = 0
+        for path, stat in sorted(entries, key=lambda entry: entry[1].st_atime):
+            if total - removed <= self.max_size:
+                break
+            if path.name in keep:
+                continue
+            try:
+                path.unlink()
+                removed += stat.st_size
+            except OSError as e:
+                logger.warning(f"Couldn't remove {path} from package cache: {e}")
+        if removed:
+            logger.info(
+                f"Removed {removed} bytes of old packages from {self.directory}"
+            )
+        return removed
@@ -2,9 +2,9 @@ import logging
 import os
 from enum import Enum
 from pathlib import Path
-from tempfile import mkdtemp
 from threading import Thread
-from typing import Callable
+from time import monotonic
+from typing import Callable, Optional, Set, Type
 
 from pitop.common.state_manager import StateManager
 from pt_miniscreen.components.mixins import HasGutterIcons
@@ -13,14 +13,20 @@ from pt_miniscreen.core.component import Component
 from pt_miniscreen.core.components import Text
 from pt_miniscreen.core.utils import apply_layers, layer
 
+from pi_top_usb_setup.apt_backend import PythonAptUpdater, python_apt_available
 from pi_top_usb_setup.exceptions import (
     ExtractionError,
     NotAnAptRepository,
     NotEnoughSpaceException,
+    UnmetDependenciesError,
 )
+from pi_top_usb_setup.extraction import ExtractionTracker
 from pi_top_usb_setup.file_structure import MountPointStructure, UsbSetupStructure
 from pi_top_usb_setup.operations import CoreOperations, MountPointOperations
-from pi_top_usb_setup.system_updater import SystemUpdater
+from pi_top_usb_setup.package_cache import PackageCache
+from pi_top_usb_setup.progress import ProgressStats
+from pi_top_usb_setup.system_updater import PROVISIONING_PROFILE, SystemUpdater
+from pi_top_usb_setup.upgrade_estimate import UpgradeEstimate, format_eta
 from pi_top_usb_setup.utils import (
     RestartingSystemdService,
     get_package_version,
@@ -31,6 +37,9 @@ logger = logging.getLogger(__name__)
 
 
 FONT_SIZE = 10
+# Setup bundles are extracted here, unless another disk filesystem fits them better; it
+# persists across reboots so that an interrupted extraction can be resumed
+EXTRACTION_DIRECTORY = "/var/tmp/pi-top-usb-setup"
 
 
 class TextWithDots:
@@ -54,6 +63,14 @@ class TextWithDots:
         return f"{self.base} {self.dots}"
 
 
+def format_stats(stats: ProgressStats) -> str:
+    """Formats throughput and time left to fit in the miniscreen, eg: '12.3 MB/s, 1:05 left'"""
+    text = f"{stats.throughput / 1e6:.1f} MB/s"
+    if stats.eta is not None:
+        text += f", {format_eta(stats.eta)}"
+    return text
+
+
 class ConfigFileKeys(Enum):
     INSTALL_UPDATE = "install_update"
     INSTALL_CERTIFICATES = "install_certificates"
@@ -79,6 +96,12 @@ class RunStates(Enum):
     DONE = 100
 
 
+# Seconds the steps after the system update usually take. Once the duration of the
+# update is estimated, it gets a share of the rest of the progress bar by comparing
+# both; the steps after it keep their proportions in what's left
+CONFIGURATION_DURATION = 120
+
+
 class AppErrors(Enum):
     NONE = 0
     NOT_ENOUGH_SPACE = 1
@@ -90,6 +113,7 @@ class AppErrors(Enum):
     SCRIPTS_ERROR = 7
     CERTIFICATE_INSTALLATION_ERROR = 8
     NETWORK_CONFIGURATION_ERROR = 9
+    UNMET_DEPENDENCIES = 10
 
 
 class RunSetupPage(Component, HasGutterIcons):
@@ -107,10 +131,24 @@ class RunSetupPage(Component, HasGutterIcons):
                 "certificate_progress": 0,
                 "network_progress": 0,
                 "copy_progress": 0,
+                "tar_stats": None,
+                "copy_stats": None,
+                # Whether the bundle is still being extracted, since the system update
+                # starts before extraction is over
+                "extracting": False,
+                # Expected duration of the upgrade and when it started
+                "apt_estimate": None,
+                "apt_started": None,
+                # Process holding the apt and dpkg locks while waiting for it
+                "lock_holder": None,
             },
             **kwargs,
         )
 
+        # Packages the upgrade holds back because of missing dependencies, if the
+        # updates were checked before extracting them
+        self._held_back: Optional[Set[str]] = None
+
         self.state_manager = None
         try:
             self.state_manager = StateManager("pi-top-usb-setup")
@@ -121,18 +159,22 @@ class RunSetupPage(Component, HasGutterIcons):
             folder = os.environ["PT_USB_SETUP_MOUNT_POINT"]
 
             self.mount_point = MountPointStructure(folder)
-
-            # If the files are not extracted yet, we'll create a temporary directory
-            # and extract the setup file there later...
-            if not UsbSetupStructure.is_valid_directory(folder):
-                logger.info(
-                    f"There's no JSON file in '{folder}'; creating a temporary directory for extracting the setup bundle..."
-                )
-                folder = mkdtemp()
+            # Packages from previous bundles are reused instead of extracted again
+            self.package_cache = PackageCache()
+            # Left mounted by the instance that restarted the app, if any
+            usb_drive = os.environ.get("PT_USB_SETUP_USB_DRIVE")
+            mounted_image = os.environ.get("PT_USB_SETUP_MOUNTED_IMAGE")
+            self.mount_point_operations = MountPointOperations(
+                self.mount_point,
+                package_cache=self.package_cache,
+                usb_drive=MountPointStructure(usb_drive) if usb_drive else None,
+                mounted_image=Path(mounted_image) if mounted_image else None,
+            )
+
+            # Replaced by the folder the bundle is extracted into, once it's chosen
+            # in the setup thread
             self.extracted_fs = UsbSetupStructure(folder)
-
             self.core_operations = CoreOperations(self.extracted_fs)
-            self.mount_point_operations = MountPointOperations(self.mount_point)
         except Exception as e:
             logger.error(f"{e}")
             raise e
@@ -155,15 +197,16 @@ class RunSetupPage(Component, HasGutterIcons):
 
     def run_setup(self):
         try:
-            # Extract compressed file if necessary
-            self._extract_file()
+            # Choose where to extract the bundle; it can take a while, since the
+            # write speed of the disks might be measured
+            self._choose_extraction_directory()
+
+            # Extract compressed file if necessary, updating packages while it happens
+            self._extract_file_and_update_system()
 
             # Read the JSON file
             self.core_operations.read_config_file()
 
-            # Update packages
-            self._update_system()
-
             # Configure device: process json file
             self._configure_device()
 
@@ -179,16 +222,24 @@ class RunSetupPage(Component, HasGutterIcons):
             # Run scripts
             self._run_scripts()
 
+            # Setup files are not needed anymore
+            self._release_usb_drive()
+
             # Finish onboarding if necessary
             self._complete_onboarding()
 
             self.state.update({"run_state": RunStates.DONE})
+
+            # The extracted bundle is only kept to resume a setup that didn't finish
+            self._remove_extracted_files()
         except RestartingSystemdService:
             logger.warning("Restarting systemd service, exiting ...")
             return
         except Exception as e:
             logger.error(f"{e}")
 
+        self._release_usb_drive()
+
         if callable(self.on_complete):
             message = "Device setup is complete! Press any button to exit."
             if self.core_operations.requires_reboot:
@@ -199,6 +250,8 @@ class RunSetupPage(Component, HasGutterIcons):
                 message = f"There was an error during setup: E{self.state.get('error').value}. Press any button to exit."
                 if self.state.get("error") == AppErrors.NOT_ENOUGH_SPACE:
                     message = "There's not enough free space in your pi-top to continue. Press any button to exit"
+                elif self.state.get("error") == AppErrors.UNMET_DEPENDENCIES:
+                    message = "The updates in the USB drive are missing packages. Press any button to exit"
             self.on_complete(
                 {
                     "message": message,
@@ -206,27 +259,139 @@ class RunSetupPage(Component, HasGutterIcons):
                 }
             )
 
-    def _extract_file(self):
+    def _choose_extraction_directory(self):
+        folder = Path(self.mount_point.mount_point)
+        # If the files are not extracted yet, we'll extract the setup file into the
+        # extraction directory later...
+        if not UsbSetupStructure.is_valid_directory(str(folder)):
+            folder = self.mount_point_operations.choose_extraction_directory(
+                Path(EXTRACTION_DIRECTORY)
+            )
+            logger.info(
+                f"There's no JSON file in '{self.mount_point.mount_point}'; will extract the setup bundle into '{folder}'..."
+            )
+        # Folders with other files, like the USB drive, are never emptied
+        folder = self.mount_point_operations.extraction_directory(folder)
+        self.extracted_fs = UsbSetupStructure(str(folder))
+        self.core_operations = CoreOperations(self.extracted_fs)
+
+    def _extract_file_and_update_system(self):
+        # apt starts as soon as the repository index is extracted, waiting for each
+        # package file when it needs it
         self.state.update({"run_state": RunStates.EXTRACTING_TAR})
+        install_updates = self._should_run(ConfigFileKeys.INSTALL_UPDATE)
+        if install_updates:
+            # Updates already extracted in the USB drive are installed from there;
+            # otherwise, only the packages newer than the installed ones are extracted
+            if not self.mount_point_operations.use_updates_in_place():
+                try:
+                    self.mount_point_operations.plan_updates(
+                        Path(self.extracted_fs.directory)
+                    )
+                except Exception as e:
+                    logger.warning(f"Couldn't plan updates: {e}")
+
+        # Don't start if the disk would fill up halfway through
+        try:
+            self.mount_point_operations.plan_disk_usage(
+                Path(self.extracted_fs.directory), install_updates
+            )
+        except NotEnoughSpaceException as e:
+            logger.error(f"{e}")
+            self.mount_point_operations.release_updates()
+            self._handle_extraction_error(e)
+        except Exception as e:
+            logger.warning(f"Couldn't plan disk usage: {e}")
+
+        # Nor if the upgrade would fail halfway through because of missing packages
+        if install_updates:
+            try:
+                self._held_back = self.mount_point_operations.check_dependencies(
+                    Path(self.extracted_fs.directory)
+                )
+            except UnmetDependenciesError as e:
+                logger.error(f"{e}")
+                self.mount_point_operations.release_updates()
+                self._handle_extraction_error(e)
+            except Exception as e:
+                logger.warning(f"Couldn't check dependencies of updates: {e}")
+
+        tracker = ExtractionTracker(self.extracted_fs.directory)
+        self.state.update({"extracting": True})
+        Thread(target=self._extract_file, args=(tracker,), daemon=True).start()
+
+        try:
+            self._update_system(tracker)
+        except RestartingSystemdService:
+            raise
+        except Exception:
+            self.mount_point_operations.release_updates()
+            # The update might have failed because extraction did
+            tracker.wait()
+            if tracker.error:
+                self._handle_extraction_error(tracker.error)
+            raise
+
+        self.mount_point_operations.release_updates()
+        tracker.wait()
+        if tracker.error:
+            self._handle_extraction_error(tracker.error)
+
+    def _extract_file(self, tracker: ExtractionTracker):
         try:
             self.mount_point_operations.extract_setup_file(
                 destination=Path(self.extracted_fs.directory),
                 on_progress=lambda percentage: self.state.update(
                     {"tar_progress": percentage}
                 ),
+                on_member_extracted=tracker.member_extracted,
+                on_stats=lambda stats: self.state.update({"tar_stats": stats}),
+                resumable=True,
             )
-            # Umount USB drive
-            self.mount_point_operations.umount_usb_drive()
-        except NotEnoughSpaceException:
+            # Umount USB drive, unless files in it are still needed
+            if not self._setup_files_in_usb_drive:
+                self.mount_point_operations.umount_usb_drive()
+        except Exception as e:
+            logger.error(f"{e}")
+            tracker.finish(e)
+            return
+        finally:
+            self.state.update({"extracting": False})
+        tracker.finish()
+
+    def _handle_extraction_error(self, error: BaseException):
+        if isinstance(error, NotEnoughSpaceException):
             self.state.update(
                 {"run_state": RunStates.ERROR, "error": AppErrors.NOT_ENOUGH_SPACE}
             )
-            raise
-        except ExtractionError:
+        elif isinstance(error, UnmetDependenciesError):
+            self.state.update(
+                {"run_state": RunStates.ERROR, "error": AppErrors.UNMET_DEPENDENCIES}
+            )
+        elif isinstance(error, ExtractionError):
             self.state.update(
                 {"run_state": RunStates.ERROR, "error": AppErrors.EXTRACTION}
             )
-            raise
+        raise error
+
+    @property
+    def _setup_files_in_usb_drive(self) -> bool:
+        directory = Path(self.extracted_fs.directory)
+        mount_point = Path(self.mount_point.mount_point)
+        return directory == mount_point or mount_point in directory.parents
+
+    def _release_usb_drive(self):
+        # The USB drive is kept mounted while files in it are in use
+        self.mount_point_operations.release_updates()
+        self.mount_point_operations.umount_setup_image()
+        self.mount_point_operations.umount_usb_drive()
+
+    def _remove_extracted_files(self):
+        # Packages added to the package cache are hardlinks, so they're not removed
+        # with the folder; nor is a folder that wasn't created to extract bundles into
+        directory = Path(self.extracted_fs.directory)
+        if self.mount_point_operations.owns_extraction_directory(directory):
+            self.core_operations.cleanup()
 
     def _should_run(self, stage: ConfigFileKeys) -> bool:
         should_run = False
@@ -241,18 +406,36 @@ class RunSetupPage(Component, HasGutterIcons):
             logger.error(f"Error getting state manager: {e}")
         return should_run
 
-    def _update_system(self):
+    def _update_system(self, tracker: Optional[ExtractionTracker] = None):
         if not self._should_run(ConfigFileKeys.INSTALL_UPDATE):
             logger.warning("Skipping system update due to system configuration...")
             return
 
+        updates_folder = self.mount_point_operations.updates_in_place
+        if updates_folder:
+            # Nothing to wait for, the updates are not being extracted
+            tracker = None
+        else:
+            updates_folder = self.extracted_fs.updates_folder()
+
         try:
-            updater = SystemUpdater(
-                apt_repository=str(self.extracted_fs.updates_folder()),
+            updater = self._system_updater_class()(
+                apt_repository=str(updates_folder),
                 on_progress=lambda percentage: self.state.update(
                     {"apt_progress": percentage}
                 ),
                 on_error=lambda message: logger.error(f"{message}"),
+                wait_for_file=tracker.wait_for if tracker else None,
+                is_extracted=tracker.is_extracted if tracker else None,
+                package_cache=self.package_cache,
+                # There's no one to use the device until the setup is done, and an
+                # interrupted setup is run again
+                profile=PROVISIONING_PROFILE,
+                on_lock_wait=lambda holder: self.state.update({"lock_holder": holder}),
+                held_back=self._held_back,
+                release_files=self.mount_point_operations.release_files(
+                    Path(self.extracted_fs.directory)
+                ),
             )
 
             version_before_update = get_package_version("pi-top-usb-setup")
@@ -263,6 +446,15 @@ class RunSetupPage(Component, HasGutterIcons):
             logger.info("Starting system update")
             self.state.update({"run_state": RunStates.UPDATING_SYSTEM})
 
+            if self._held_back is None:
+                # The index wasn't available before extracting
+                try:
+                    updater.check_dependencies()
+                except UnmetDependenciesError:
+                    raise
+                except Exception as e:
+                    logger.warning(f"Couldn't check dependencies of updates: {e}")
+
             # Update sources
             updater.update()
 
@@ -275,11 +467,28 @@ class RunSetupPage(Component, HasGutterIcons):
                 logger.warning(
                     f"Package 'pi-top-usb-setup' was updated from '{version_before_update}' to '{version_after_update}', restarting app..."
                 )
-                restart_service_and_skip_user_confirmation_dialog(
-                    mount_point=str(self.extracted_fs.folder())
-                )
+                if tracker:
+                    # The restarted app needs the whole bundle
+                    tracker.wait()
+                    if tracker.error:
+                        raise tracker.error
+                self._restart()
                 raise RestartingSystemdService
 
+            # Estimate how long the upgrade takes to show the time left
+            estimate = None
+            try:
+                estimate = updater.estimate_upgrade()
+            except Exception as e:
+                logger.warning(f"Couldn't estimate upgrade duration: {e}")
+            self.state.update(
+                {
+                    "apt_progress": 0,
+                    "apt_estimate": estimate,
+                    "apt_started": monotonic(),
+                }
+            )
+
             # Upgrade system
             updater.upgrade()
             logger.info("Finished updating")
@@ -288,12 +497,55 @@ class RunSetupPage(Component, HasGutterIcons):
         except NotAnAptRepository as e:
             logger.warning(f"{e}")
             return
+        except UnmetDependenciesError as e:
+            self.state.update(
+                {"run_state": RunStates.ERROR, "error": AppErrors.UNMET_DEPENDENCIES}
+            )
+            raise Exception(f"Update Error: {e}")
         except Exception as e:
             self.state.update(
                 {"run_state": RunStates.ERROR, "error": AppErrors.UPDATE_ERROR}
             )
             raise Exception(f"Update Error: {e}")
 
+    def _restart(self):
+        # If updates are installed from the USB drive, the restarted app needs it too
+        mount_point = (
+            self.mount_point.mount_point
+            if self.mount_point_operations.updates_in_place
+            else self.extracted_fs.directory
+        )
+        # What's still mounted is left to the restarted app to umount
+        usb_drive = self.mount_point_operations.usb_drive.mount_point
+        mounted_image = self.mount_point_operations.mounted_image
+        restart_service_and_skip_user_confirmation_dialog(
+            mount_point=mount_point,
+            usb_drive=(
+                usb_drive
+                if usb_drive != mount_point and Path(usb_drive).exists()
+                else None
+            ),
+            mounted_image=str(mounted_image) if mounted_image else None,
+        )
+
+    def _system_updater_class(self) -> Type[SystemUpdater]:
+        """apt-get is used unless the python-apt backend is configured and available"""
+        backend = "apt-get"
+        try:
+            if isinstance(self.state_manager, StateManager):
+                backend = self.state_manager.get("app", "apt_backend", "apt-get")
+        except Exception as e:
+            logger.error(f"Error getting state manager: {e}")
+
+        if backend == "python-apt":
+            if python_apt_available():
+                logger.info("Installing updates with python-apt")
+                return PythonAptUpdater
+            logger.warning(
+                "python-apt is not available; installing updates with apt-get"
+            )
+        return SystemUpdater
+
     def _configure_device(self):
         if not self._should_run(ConfigFileKeys.CONFIGURE_DEVICE):
             logger.warning(
@@ -370,6 +622,7 @@ class RunSetupPage(Component, HasGutterIcons):
                 on_progress=lambda percentage: self.state.update(
                     {"copy_progress": percentage}
                 ),
+                on_stats=lambda stats: self.state.update({"copy_stats": stats}),
             )
         except Exception as e:
             self.state.update(
@@ -427,10 +680,13 @@ class RunSetupPage(Component, HasGutterIcons):
         elif state is RunStates.UPDATING_SYSTEM:
             # Include apt progress
             value += (
-                self.state.get("apt_progress", 0)
-                / 100
-                * (RunStates.CONFIGURING_DEVICE.value - value)
+                self._update_progress() / 100 * (self._update_progress_end() - value)
             )
+            if self.state.get("extracting"):
+                # Extraction keeps its part of the bar until it's over
+                value -= (1 - self.state.get("tar_progress", 0) / 100) * (
+                    RunStates.UPDATING_SYSTEM.value - RunStates.EXTRACTING_TAR.value
+                )
         elif state is RunStates.CONFIGURING_DEVICE:
             value += (
                 self.state.get("config_progress", 0)
@@ -474,19 +730,78 @@ class RunSetupPage(Component, HasGutterIcons):
                 * (RunStates.DONE.value - value)
             )
 
+        if value >= RunStates.CONFIGURING_DEVICE.value:
+            # Fit the steps after the system update in the part of the bar it left
+            end = self._update_progress_end()
+            value = end + (value - RunStates.CONFIGURING_DEVICE.value) / (
+                RunStates.DONE.value - RunStates.CONFIGURING_DEVICE.value
+            ) * (RunStates.DONE.value - end)
         return value
 
+    def _update_progress_end(self) -> float:
+        """Where the system update ends in the progress bar; by its estimated duration,
+        if it was estimated"""
+        estimate: Optional[UpgradeEstimate] = self.state.get("apt_estimate")
+        if estimate is None:
+            return RunStates.CONFIGURING_DEVICE.value
+        start = RunStates.UPDATING_SYSTEM.value
+        share = estimate.duration / (estimate.duration + CONFIGURATION_DURATION)
+        return start + share * (RunStates.DONE.value - start)
+
+    def _update_progress(self) -> float:
+        """Progress of the system update; based on the time it's expected to take, if
+        it was estimated, so that it moves at a steady pace"""
+        percentage = self.state.get("apt_progress", 0)
+        estimate: Optional[UpgradeEstimate] = self.state.get("apt_estimate")
+        if estimate is None:
+            return percentage
+        elapsed = monotonic() - self.state.get("apt_started")
+        return estimate.progress(elapsed, percentage)
+
+    def _update_eta(self) -> Optional[str]:
+        estimate: Optional[UpgradeEstimate] = self.state.get("apt_estimate")
+        if estimate is None:
+            return None
+        elapsed = monotonic() - self.state.get("apt_started")
+        eta = estimate.eta(elapsed, self.state.get("apt_progress", 0))
+        return f"{estimate.packages} packages, {format_eta(eta)}"
+
     def _text(self):
         run_state = self.state.get("run_state")
+        lock_holder = self.state.get("lock_holder")
+        if run_state == RunStates.UPDATING_SYSTEM and lock_holder:
+            return f"Waiting for {lock_holder.name} to finish"
+
         # If the USB device is still connected ...
         if (
             run_state == RunStates.UPDATING_SYSTEM
+            and not self.mount_point_operations.usb_drive_in_use
             and self.mount_point_operations.usb_drive_is_present
         ):
             return "You can remove the USB drive; setup process will continue"
 
+        if run_state == RunStates.UPDATING_SYSTEM and not self.state.get("extracting"):
+            eta = self._update_eta()
+            if eta:
+                return f"{self._wait_text}\n{eta}"
+
+        stats = self._current_stats()
+        if stats:
+            return f"{self._wait_text}\n{format_stats(stats)}"
+
         return str(self._wait_text)
 
+    def _current_stats(self) -> Optional[ProgressStats]:
+        """Throughput and time left of the current stage, if it reports them"""
+        run_state = self.state.get("run_state")
+        if run_state == RunStates.EXTRACTING_TAR or (
+            run_state == RunStates.UPDATING_SYSTEM and self.state.get("extracting")
+        ):
+            return self.state.get("tar_stats")
+        elif run_state == RunStates.COPYING_FILES:
+            return self.state.get("copy_stats")
+        return None
+
     def render(self, image):
         offset = 5
 
@@ -0,0 +1,152 @@
+import logging
+import os
+from threading import Condition, Thread
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Most bytes of package files read ahead of dpkg at any time. They stay in the page
+# cache until dpkg reads them, so it's kept small to not push out what the rest of
+# the system uses on 1GB devices
+PREFETCH_BUDGET = 64 * 1024 * 1024
+# Packages read ahead of the one being installed
+PREFETCH_DEPTH = 4
+
+
+def prefetch_budget(meminfo: str = "/proc/meminfo") -> int:
+    """PREFETCH_BUDGET, or less if there isn't much memory available"""
+    try:
+        with open(meminfo) as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+                    return min(PREFETCH_BUDGET, available // 16)
+    except (OSError, ValueError, IndexError):
+        pass
+    return PREFETCH_BUDGET // 4
+
+
+def _fadvise(path: str, length: int, advice: int) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, length, advice)
+    finally:
+        os.close(fd)
+
+
+class PackagePrefetcher:
+    """Reads the package files dpkg is about to install into the page cache in the
+    background, so that reading them from a slow drive overlaps with the unpacking and
+    configuration of the previous packages.
+
+    'packages' are the package names and files in installation order; 'advance' is
+    called as dpkg starts with each of them. Up to 'depth' packages ahead are read,
+    as long as the bytes read but not installed yet fit in 'budget'. Files of
+    installed packages are dropped from the page cache, since they're not read
+    again."""
+
+    def __init__(
+        self,
+        packages: List[Tuple[str, str]],
+        budget: Optional[int] = None,
+        depth: int = PREFETCH_DEPTH,
+    ) -> None:
+        self.packages = packages
+        self.budget = budget if budget is not None else prefetch_budget()
+        self.depth = depth
+        # Index of the package being installed, and of the next one to read
+        self._position = 0
+        self._next = 0
+        # Bytes read of each package not installed yet, by index
+        self._prefetched: Dict[int, int] = {}
+        self._condition = Condition()
+        self._stopped = False
+        self._thread: Optional[Thread] = None
+
+    def __enter__(self) -> "PackagePrefetcher":
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        if not self.packages or not hasattr(os, "posix_fadvise"):
+            return
+        logger.info(
+            f"Prefetching {len(self.packages)} packages with a budget of "
+            f"{self.budget} bytes"
+        )
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def advance(self, package: str) -> None:
+        """Reports that dpkg started installing a package; the previous ones are done"""
+        # Packages for a foreign architecture have it appended to their name
+        name = package.split(":")[0]
+        with self._condition:
+            for i in range(self._position, len(self.packages)):
+                if self.packages[i][0] == name:
+                    break
+            else:
+                # Not in the plan, or a package installed before, eg: to configure it
+                return
+            done = [index for index in self._prefetched if self._position <= index < i]
+            lengths = [self._prefetched.pop(index) for index in done]
+            self._position = i
+            self._next = max(self._next, i)
+            self._condition.notify()
+        self._drop(zip(done, lengths))
+
+    def prefetched_bytes(self) -> int:
+        with self._condition:
+            return sum(self._prefetched.values())
+
+    def _drop(self, packages: Iterable[Tuple[int, int]]) -> None:
+        for index, length in packages:
+            try:
+                _fadvise(self.packages[index][1], length, os.POSIX_FADV_DONTNEED)
+            except OSError:
+                pass
+
+    def _can_prefetch(self) -> bool:
+        return (
+            self._next < len(self.packages)
+            and self._next <= self._position + self.depth
+            and sum(self._prefetched.values()) < self.budget
+        )
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._stopped and not self._can_prefetch():
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                index = self._next
+                self._next += 1
+                room = self.budget - sum(self._prefetched.values())
+
+            path = self.packages[index][1]
+            try:
+                # Large files are read only partially, dpkg reads the rest
+                length = min(os.stat(path).st_size, room)
+                _fadvise(path, length, os.POSIX_FADV_WILLNEED)
+            except OSError as e:
+                # eg: not extracted yet, it's in the page cache anyway once it is
+                logger.debug(f"Couldn't prefetch {path}: {e}")
+                continue
+
+            with self._condition:
+                if index >= self._position:
+                    self._prefetched[index] = length
+                    continue
+            # dpkg already went past it
+            self._drop([(index, length)])
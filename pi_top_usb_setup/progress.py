@@ -0,0 +1,99 @@
+from dataclasses import dataclass
+from time import monotonic
+from typing import Callable, Optional
+
+
+@dataclass
+class ProgressStats:
+    percentage: float
+    bytes_done: int
+    total_bytes: int
+    # Smoothed, in bytes per second
+    throughput: float
+    # Seconds left, if it can be estimated
+    eta: Optional[float]
+
+
+class ProgressMeter:
+    """Tracks the progress of an operation by the amount of bytes it processed.
+
+    'on_progress' is called with the percentage and 'on_stats' with a ProgressStats
+    object. Updates are cheap: callbacks run at most every REPORT_INTERVAL seconds,
+    which is also when throughput is sampled."""
+
+    REPORT_INTERVAL = 0.25
+    # Weight of the newest throughput sample in the moving average
+    SMOOTHING = 0.3
+
+    def __init__(
+        self,
+        total_bytes: int,
+        on_progress: Optional[Callable[[float], None]] = None,
+        on_stats: Optional[Callable[[ProgressStats], None]] = None,
+    ) -> None:
+        self.total_bytes = total_bytes
+        self.on_progress = on_progress
+        self.on_stats = on_stats
+        self.bytes_done = 0
+        self.throughput = 0.0
+        self._last_report: Optional[float] = None
+        self._last_bytes = 0
+
+    def advance(self, size: int) -> None:
+        self.update(self.bytes_done + size)
+
+    def update(self, bytes_done: int) -> None:
+        self.bytes_done = bytes_done
+        now = monotonic()
+        if self._last_report is None:
+            self._last_report = now
+            self._last_bytes = bytes_done
+            self._report()
+        elif now - self._last_report >= self.REPORT_INTERVAL:
+            self._sample(now)
+            self._report()
+
+    def finish(self) -> None:
+        self.bytes_done = max(self.bytes_done, self.total_bytes)
+        if self._last_report is not None:
+            self._sample(monotonic())
+        self._report()
+
+    def _sample(self, now: float) -> None:
+        elapsed = now - self._last_report if self._last_report is not None else 0
+        if elapsed > 0:
+            rate = (self.bytes_done - self._last_bytes) / elapsed
+            self.throughput = (
+                rate
+                if self.throughput == 0
+                else self.SMOOTHING * rate + (1 - self.SMOOTHING) * self.throughput
+            )
+        self._last_report = now
+        self._last_bytes = self.bytes_done
+
+    @property
+    def percentage(self) -> float:
+        if self.total_bytes <= 0:
+            return 100.0
+        return min(self.bytes_done / self.total_bytes, 1) * 100.0
+
+    @property
+    def eta(self) -> Optional[float]:
+        if self.throughput <= 0:
+            return None
+        return max(self.total_bytes - self.bytes_done, 0) / self.throughput
+
+    def stats(self) -> ProgressStats:
+        return ProgressStats(
+            percentage=self.percentage,
+            bytes_done=self.bytes_done,
+            total_bytes=self.total_bytes,
+            throughput=self.throughput,
+            eta=self.eta,
+        )
+
+    def _report(self) -> None:
+        if callable(self.on_progress):
+            self.on_progress(self.percentage)
+        if callable(self.on_stats):
+            self.on_stats(self.stats())
@@ -0,0 +1,238 @@
+import logging
+import os
+import re
+import shutil
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import monotonic
+from typing import Iterable, List, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+
+# Filesystems backed by a disk that keep permissions and symlinks; anything else
+# (eg: tmpfs, overlays over RAM, FAT USB drives) isn't used to extract bundles into
+DISK_FILESYSTEMS = ("ext2", "ext3", "ext4", "btrfs", "xfs", "f2fs")
+# Amount of data written to measure the write throughput of a filesystem
+THROUGHPUT_TEST_SIZE = 4 * 1024 * 1024
+# System folders that bundles can also be extracted into, in a folder named like the
+# preferred one; they're in the root filesystem or in data partitions mounted for them
+EXTRACTION_LOCATIONS = ("/home", "/srv")
+
+
+@dataclass
+class MountEntry:
+    device: str
+    mount_point: str
+    fs_type: str
+    options: List[str] = field(default_factory=list)
+
+    @property
+    def read_only(self) -> bool:
+        return "ro" in self.options
+
+    @property
+    def is_disk(self) -> bool:
+        return self.fs_type in DISK_FILESYSTEMS
+
+
+@dataclass
+class StorageTarget:
+    """Folder that a bundle can be extracted into"""
+
+    directory: Path
+    mount: MountEntry
+    free_space: int
+    # Bytes per second, if measured
+    throughput: Optional[float] = None
+
+
+def _unescape(value: str) -> str:
+    # Spaces and other characters are written as octal escapes in /proc/mounts
+    return re.sub(r"\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)), value)
+
+
+def read_mounts(mounts_file: str = "/proc/mounts") -> List[MountEntry]:
+    mounts = []
+    with open(mounts_file) as file:
+        for line in file:
+            fields = line.split()
+            if len(fields) < 4:
+                continue
+            mounts.append(
+                MountEntry(
+                    device=_unescape(fields[0]),
+                    mount_point=_unescape(fields[1]),
+                    fs_type=fields[2],
+                    options=fields[3].split(","),
+                )
+            )
+    return mounts
+
+
+def existing_parent(path: Union[str, Path]) -> Path:
+    """Returns 'path', or its closest parent folder that exists"""
+    path = Path(path).absolute()
+    while not path.exists() and path != path.parent:
+        path = path.parent
+    return path
+
+
+def mount_for(path: Union[str, Path], mounts: List[MountEntry]) -> Optional[MountEntry]:
+    """Returns the mount that holds 'path'"""
+    path = Path(path).absolute()
+    # Symlinks are resolved in the part of the path that exists
+    existing = existing_parent(path)
+    resolved = existing.resolve() / path.relative_to(existing)
+    found = None
+    for mount in mounts:
+        mount_point = Path(mount.mount_point)
+        if resolved == mount_point or mount_point in resolved.parents:
+            # Later mounts hide the ones below them
+            if found is None or len(mount_point.parts) >= len(
+                Path(found.mount_point).parts
+            ):
+                found = mount
+    return found
+
+
+def same_filesystem(path: Union[str, Path], other: Union[str, Path]) -> bool:
+    return (
+        os.stat(existing_parent(path)).st_dev == os.stat(existing_parent(other)).st_dev
+    )
+
+
+def measure_write_throughput(
+    folder: Union[str, Path], size: int = THROUGHPUT_TEST_SIZE
+) -> float:
+    """Writes 'size' bytes into a temporary file in 'folder' and returns how many bytes
+    per second were written, including the time to flush them to disk"""
+    path = Path(folder) / f".pi-top-usb-setup-write-test-{os.getpid()}"
+    block = os.urandom(min(size, 1024 * 1024))
+    start = monotonic()
+    try:
+        with open(path, "wb") as file:
+            written = 0
+            while written < size:
+                written += file.write(block[: size - written])
+            file.flush()
+            os.fsync(file.fileno())
+        elapsed = monotonic() - start
+    finally:
+        path.unlink(missing_ok=True)
+    return size / elapsed if elapsed > 0 else float("inf")
+
+
+def storage_targets(
+    preferred: Union[str, Path],
+    exclude: Iterable[Union[str, Path]] = (),
+    mounts: Optional[List[MountEntry]] = None,
+    owned_markers: Iterable[str] = (),
+    locations: Iterable[Union[str, Path]] = EXTRACTION_LOCATIONS,
+) -> List[StorageTarget]:
+    """Returns the folders that a bundle can be extracted into, one per writable disk
+    filesystem: 'preferred', a folder with the same name in the system 'locations',
+    and folders with the same name in other filesystems if they have any of the
+    'owned_markers' files, ie: they were created by a previous extraction. The
+    filesystems of the 'exclude' paths (eg: the USB drive with the bundle) are left
+    out."""
+    if mounts is None:
+        mounts = read_mounts()
+    preferred = Path(preferred)
+    excluded = [Path(path).absolute() for path in exclude]
+    markers = list(owned_markers)
+
+    def is_excluded(folder: Path) -> bool:
+        return any(folder == path or path in folder.parents for path in excluded)
+
+    def is_owned(folder: Path) -> bool:
+        return any((folder / marker).exists() for marker in markers)
+
+    candidates = [preferred] + [
+        Path(location) / preferred.name for location in locations
+    ]
+    candidates += [
+        Path(mount.mount_point) / preferred.name
+        for mount in mounts
+        if Path(mount.mount_point) != Path("/")
+        and is_owned(Path(mount.mount_point) / preferred.name)
+    ]
+
+    targets: List[StorageTarget] = []
+    for directory in candidates:
+        mount = mount_for(directory, mounts)
+        if (
+            mount is None
+            or not mount.is_disk
+            or mount.read_only
+            or is_excluded(Path(mount.mount_point))
+            or any(target.mount == mount for target in targets)
+        ):
+            continue
+        parent = existing_parent(directory)
+        if not os.access(parent, os.W_OK):
+            continue
+        _, _, free_space = shutil.disk_usage(parent)
+        targets.append(StorageTarget(directory, mount, free_space))
+    return targets
+
+
+def choose_extraction_directory(
+    preferred: Union[str, Path],
+    needed_space: int,
+    exclude: Iterable[Union[str, Path]] = (),
+    checkpoint_filename: Optional[str] = None,
+    marker_filename: Optional[str] = None,
+) -> Path:
+    """Chooses the folder to extract a bundle of 'needed_space' bytes into.
+
+    A folder with an interrupted extraction is used to resume it. Otherwise, out of
+    the filesystems with enough free space, the one with the fastest writes is used.
+    If none of them has enough, the one with the most free space is used, so that the
+    free space check reports the smallest shortfall."""
+    try:
+        targets = storage_targets(
+            preferred,
+            exclude,
+            owned_markers=[marker_filename] if marker_filename else [],
+        )
+    except Exception as e:
+        logger.warning(f"Couldn't look for filesystems to extract into: {e}")
+        return Path(preferred)
+
+    if not targets:
+        logger.warning(f"No disk filesystem found to extract into; using {preferred}")
+        return Path(preferred)
+
+    if checkpoint_filename:
+        for target in targets:
+            if (target.directory / checkpoint_filename).exists():
+                logger.info(f"Resuming extraction into {target.directory}")
+                return target.directory
+
+    fitting = [target for target in targets if target.free_space > needed_space]
+    if not fitting:
+        target = max(targets, key=lambda target: target.free_space)
+        logger.warning(
+            f"No filesystem has {needed_space} bytes free; using {target.directory}"
+        )
+        return target.directory
+
+    if len(fitting) > 1:
+        for target in fitting:
+            try:
+                target.throughput = measure_write_throughput(
+                    existing_parent(target.directory)
+                )
+            except Exception as e:
+                logger.warning(
+                    f"Couldn't measure write speed of {target.directory}: {e}"
+                )
+                target.throughput = 0
+            logger.info(
+                f"{target.mount.mount_point} ({target.mount.fs_type}): "
+                f"{target.free_space} bytes free, {target.throughput:.0f} bytes/s"
+            )
+    target = max(fitting, key=lambda target: target.throughput or 0)
+    logger.info(f"Extracting into {target.directory}")
+    return target.directory
@@ -1,18 +1,72 @@
+import glob
+import hashlib
 import logging
 import os
+import re
+from contextlib import contextmanager
+from dataclasses import dataclass
+from enum import Enum
 from pathlib import Path
-from typing import Callable, Optional
+from shlex import quote
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
+from pitop.common.command_runner import run_command
+
+from pi_top_usb_setup.apt_index import package_hashes, read_packages_index
+from pi_top_usb_setup.apt_status import (
+    DPKG_PHASES,
+    AptStatusType,
+    PackageTimings,
+    package_phase,
+    parse_apt_status,
+    parse_dpkg_status,
+)
+from pi_top_usb_setup.dependency_check import verify_dependencies
+from pi_top_usb_setup.dpkg_lock import LockHolder, wait_for_dpkg_lock
+from pi_top_usb_setup.dpkg_status import installed_packages, status_index
 from pi_top_usb_setup.exceptions import NotAnAptRepository
+from pi_top_usb_setup.package_cache import PackageCache
+from pi_top_usb_setup.prefetch import PackagePrefetcher
+from pi_top_usb_setup.upgrade_estimate import (
+    UpgradeEstimate,
+    estimate_upgrade,
+    read_timings_report,
+)
 from pi_top_usb_setup.utils import Process
 
 logger = logging.getLogger(__name__)
 
+# Hash of the offline repository indexes used by the last successful 'apt-get update'
+INDEX_HASH_FILE = "/var/lib/pi-top-usb-setup/apt-index.sha256"
+APT_LISTS_FOLDER = "/var/lib/apt/lists"
+# Characters apt quotes in the names of the lists, besides spaces, control characters
+# and non-ASCII bytes
+APT_QUOTED_CHARACTERS = b'\\|{}[]<>"^~_=!@#$%^&*'
+# apt source list of the offline repository, while it's in use
+OFFLINE_SOURCE_FILE = "/tmp/offline-apt-source.list"
+# Time spent in each phase of the installation of every package in the last upgrade
+TIMINGS_REPORT_FILE = "/var/lib/pi-top-usb-setup/upgrade-timings.json"
+# Packages held with apt-mark during an upgrade, to release them if it's interrupted
+HELD_BACK_FILE = "/var/lib/pi-top-usb-setup/held-back-packages"
+# Seconds apt and dpkg can go without output, CPU use or disk activity before being
+# considered stuck, eg: on a maintainer script waiting for input
+STALL_TIMEOUT = 600
+# Seconds to wait for other apt or dpkg processes, eg: unattended-upgrades on first
+# boot, to release their locks
+LOCK_TIMEOUT = 1800
+# Seconds apt waits for the dpkg lock itself, in case something takes it between
+# checking the locks and apt starting
+APT_LOCK_TIMEOUT = 60
+
 
 class CustomAptSource:
-    def __init__(self, path_to_repo: Optional[str]) -> None:
+    def __init__(
+        self, path_to_repo: Optional[str], cache: Optional[PackageCache] = None
+    ) -> None:
         self.path = path_to_repo
-        self.source = "/tmp/offline-apt-source.list"
+        # Packages missing in the repository are linked from here, if found
+        self.cache = cache
+        self.source = OFFLINE_SOURCE_FILE
         self.source_path = Path(self.source)
         self.source_path.unlink(missing_ok=True)
 
@@ -20,6 +74,9 @@ class CustomAptSource:
         if not self.path:
             return None
 
+        if self.cache:
+            self._link_cached_packages()
+
         logger.info(f"Creating offline apt source in {self.source}")
         with open(self.source, "w") as file:
             file.write(f"deb [trusted=yes] file:{self.path} ./")
@@ -28,6 +85,83 @@ class CustomAptSource:
     def __exit__(self, exc_type, exc_value, exc_traceback):
         self.source_path.unlink(missing_ok=True)
 
+    def _link_cached_packages(self) -> None:
+        assert self.cache is not None and self.path is not None
+        try:
+            index = (Path(self.path) / "Packages").read_text()
+            missing = {
+                Path(self.path) / filename: sha256
+                for filename, sha256 in package_hashes(index).items()
+                if not (Path(self.path) / filename).exists()
+            }
+            self.cache.link_packages(missing)
+        except Exception as e:
+            logger.warning(f"Couldn't link cached packages into {self.path}: {e}")
+
+
+def apt_list_prefix(path: str) -> str:
+    """Prefix of the names apt gives to the lists of a repository in a folder, as
+    apt's 'URItoFileName' does"""
+    quoted = "".join(
+        (
+            f"%{byte:02x}"
+            if byte in APT_QUOTED_CHARACTERS or byte <= 0x20 or byte >= 0x7F
+            else chr(byte)
+        )
+        for byte in path.encode()
+    )
+    return quoted.replace("/", "_")
+
+
+class AptActionType(Enum):
+    INSTALL = "Inst"
+    CONFIGURE = "Conf"
+    REMOVE = "Remv"
+
+
+@dataclass
+class AptAction:
+    type: AptActionType
+    package: str
+    version: Optional[str] = None
+    installed_version: Optional[str] = None
+
+
+# eg: 'Inst libfoo [1.0-1] (1.1-1 localhost [arm64])' or 'Conf libfoo (1.1-1 localhost [arm64])'
+APT_ACTION_REGEX = re.compile(r"^(Inst|Conf|Remv) (\S+)(?: \[([^\]]+)\])?(?: \((\S+))?")
+
+
+def parse_apt_actions(output: str) -> List[AptAction]:
+    """Parses the output of an apt command run with '--simulate', in execution order"""
+    actions = []
+    for line in output.splitlines():
+        match = APT_ACTION_REGEX.match(line.strip())
+        if match:
+            type, package, installed_version, version = match.groups()
+            actions.append(
+                AptAction(AptActionType(type), package, version, installed_version)
+            )
+    return actions
+
+
+@dataclass(frozen=True)
+class InstallProfile:
+    """How dpkg installs packages"""
+
+    # Don't fsync every unpacked file; a power cut halfway leaves packages broken
+    unsafe_io: bool = False
+    # Run triggers (man-db, initramfs-tools...) once at the end instead of after
+    # every package that activates them
+    defer_triggers: bool = False
+    # Flush everything to disk once the installation is done
+    sync: bool = False
+
+
+# apt and dpkg defaults
+DEFAULT_PROFILE = InstallProfile()
+# For one-shot offline provisioning, where an interrupted setup is run again anyway
+PROVISIONING_PROFILE = InstallProfile(unsafe_io=True, defer_triggers=True, sync=True)
+
 
 class SystemUpdater:
     def __init__(
@@ -35,8 +169,37 @@ class SystemUpdater:
         apt_repository: Optional[str] = None,
         on_progress: Optional[Callable] = None,
         on_error: Optional[Callable] = None,
+        wait_for_file: Optional[Callable[[Path], bool]] = None,
+        is_extracted: Optional[Callable[[Path], bool]] = None,
+        package_cache: Optional[PackageCache] = None,
+        profile: InstallProfile = DEFAULT_PROFILE,
+        stall_timeout: float = STALL_TIMEOUT,
+        lock_timeout: float = LOCK_TIMEOUT,
+        on_lock_wait: Optional[Callable[[Optional[LockHolder]], None]] = None,
+        held_back: Optional[Iterable[str]] = None,
+        release_files: Iterable[str] = ("Release",),
     ) -> None:
         self.apt_repository = apt_repository
+        self.profile = profile
+        self.stall_timeout = stall_timeout
+        self.lock_timeout = lock_timeout
+        # Called with the process holding the apt and dpkg locks while waiting for
+        # it, and with None once they're released
+        self.on_lock_wait = on_lock_wait
+        self.package_cache = package_cache
+        # Packages the upgrade leaves as they are, eg: because the offline repository
+        # lacks packages they depend on (see 'check_dependencies')
+        self.held_back: Set[str] = set(held_back) if held_back else set()
+        # When provided, the repository is still being written: 'wait_for_file' blocks
+        # until a file is available, returning False if it won't be.
+        self.wait_for_file = wait_for_file
+        # Returns whether a file of the repository is available, without waiting
+        self.is_extracted = is_extracted
+        # Files of the repository that 'apt-get update' reads besides the 'Packages'
+        # index, waited for too
+        self.release_files = list(release_files)
+        if self.apt_repository and callable(self.wait_for_file):
+            self.wait_for_file(Path(self.apt_repository) / "Packages")
         if (
             self.apt_repository
             and not Path(self.apt_repository).joinpath("Packages").exists()
@@ -46,6 +209,13 @@ class SystemUpdater:
             )
         self.on_progress = on_progress
         self.on_error = on_error
+        self._package_files: Optional[Dict[Tuple[str, str], str]] = None
+        # Actions of the apt commands simulated since the last change to the system
+        self._simulations: Dict[str, List[AptAction]] = {}
+        # Reads ahead the package files of the running installation, if any
+        self._prefetcher: Optional[PackagePrefetcher] = None
+        # Time spent installing each package, saved after every upgrade
+        self.timings = PackageTimings()
 
     def _message_handler(self, message):
         # Handle APT messages to provide relevant information to user
@@ -53,43 +223,446 @@ class SystemUpdater:
 
         logger.info(f"{message}")
 
-        type, *other = message.split(":")
-        if type == "pmstatus" or type == "error":
-            pkg_name, total_percentage, description = other
-            if callable(self.on_progress):
-                self.on_progress(float(total_percentage))
-            if callable(self.on_error) and type == "error":
-                self.on_error(description)
+        event = parse_apt_status(message)
+        if event is None:
+            logger.debug(f"Unsupported APT message: {message}")
+            return
+
+        if event.type in (AptStatusType.PM_STATUS, AptStatusType.PM_ERROR):
+            if event.type == AptStatusType.PM_STATUS:
+                self.timings.start(event.subject, package_phase(event.description))
+                if self._prefetcher:
+                    self._prefetcher.advance(event.subject)
+            if callable(self.on_progress) and event.percentage is not None:
+                self.on_progress(event.percentage)
+            if callable(self.on_error) and event.type == AptStatusType.PM_ERROR:
+                self.on_error(event.description)
+        elif event.type == AptStatusType.PM_CONFFILE:
+            # dpkg is told to keep the current configuration files
+            logger.warning(
+                f"Configuration file {event.subject} changed: {event.description}"
+            )
+        elif event.type == AptStatusType.MEDIA_CHANGE:
+            # Can't happen with a repository in a folder, and there's no one to do it
+            if callable(self.on_error):
+                self.on_error(f"apt asked for media change: {event.description}")
         else:
-            logger.debug(f"Unsupported APT message type: {type}")
+            logger.debug(f"Download status: {event.description}")
 
-    def _run_cmd(self, cmd: str) -> None:
+    def _dpkg_message_handler(self, message):
+        logger.info(f"{message}")
+        status = parse_dpkg_status(message)
+        if status:
+            action, package = status
+            self.timings.start(package, DPKG_PHASES.get(action))
+            if self._prefetcher:
+                self._prefetcher.advance(package)
+
+    def _save_timings(self) -> None:
+        try:
+            self.timings.save(TIMINGS_REPORT_FILE)
+        except Exception as e:
+            logger.warning(f"Couldn't save package timings: {e}")
+
+    def _source_options(self, apt_source: str) -> str:
+        return f' -o Dir::Etc::sourcelist="{apt_source}" -o Dir::Etc::sourceparts="-" -o APT::Get::List-Cleanup="0"'
+
+    def _run(self, cmd: str, stdout_callback: Optional[Callable] = None) -> None:
         def updates_env():
             env = os.environ.copy()
             env["DEBIAN_FRONTEND"] = "noninteractive"
             return env
 
-        with CustomAptSource(self.apt_repository) as apt_source:
+        # Upgrades can take hours; they're only stopped if they stop progressing
+        process = Process(
+            cmd,
+            timeout=None,
+            stall_timeout=self.stall_timeout,
+            stderr_callback=self.on_error,
+            stdout_callback=stdout_callback,
+        )
+        exit_code = process.run(environment=updates_env())
+        if process.stalled:
+            raise Exception(
+                f"Command '{cmd}' made no progress in {self.stall_timeout} seconds"
+            )
+        if exit_code != 0:
+            raise Exception(f"Command '{cmd}' exited with code '{exit_code}'")
+
+    def _run_cmd(self, cmd: str) -> None:
+        with CustomAptSource(self.apt_repository, self.package_cache) as apt_source:
             if apt_source:
-                cmd += f' -o Dir::Etc::sourcelist="{apt_source}" -o Dir::Etc::sourceparts="-" -o APT::Get::List-Cleanup="0"'
+                cmd += self._source_options(apt_source)
 
             # Send status reports to stdout
             cmd += " -o APT::Status-Fd=1"
+            cmd += f" -o DPkg::Lock::Timeout={APT_LOCK_TIMEOUT}"
+            cmd += self._profile_options()
 
-            exit_code = Process(
-                cmd,
-                timeout=3600,
-                stderr_callback=self.on_error,
-                stdout_callback=self._message_handler,
-            ).run(environment=updates_env())
-            if exit_code != 0:
-                raise Exception(f"Command '{cmd}' exited with code '{exit_code}'")
+            self._wait_for_lock()
+            # The installed packages or the lists might change
+            self._simulations.clear()
+            self._run(cmd, stdout_callback=self._message_handler)
 
-    def update(self) -> None:
+    def _wait_for_lock(self) -> None:
+        wait_for_dpkg_lock(self.lock_timeout, on_wait=self.on_lock_wait)
+
+    def _profile_options(self) -> str:
+        # dpkg options of the install profile, as passed through apt
+        options = ""
+        if self.profile.unsafe_io:
+            options += ' -o Dpkg::Options::="--force-unsafe-io"'
+        if self.profile.defer_triggers:
+            options += " -o DPkg::NoTriggers=true -o DPkg::ConfigurePending=false -o DPkg::TriggersPending=false"
+        return options
+
+    def _run_dpkg(self, args: str, run_triggers: bool = False) -> None:
+        options = ""
+        if self.profile.unsafe_io:
+            options += "--force-unsafe-io "
+        if self.profile.defer_triggers and not run_triggers:
+            options += "--no-triggers "
+        self._wait_for_lock()
+        self._simulations.clear()
+        # Keep current configuration files, there's no one to ask
+        self._run(
+            f"dpkg --force-confdef --force-confold --status-fd 1 {options}{args}",
+            stdout_callback=self._dpkg_message_handler,
+        )
+
+    def _configure_unpacked(self) -> None:
+        """Configures the packages an install with deferred triggers left unpacked, so
+        that they can be used before the rest of the work deferred to the end of the
+        installation is done"""
+        if not self.profile.defer_triggers:
+            return
+        packages = sorted(status_index.unconfigured())
+        if packages:
+            self._run_dpkg("--configure " + " ".join(quote(p) for p in packages))
+
+    def _finish_install(self) -> None:
+        """Runs the work the install profile deferred to the end of the installation"""
+        if self.profile.defer_triggers:
+            logger.info("Running deferred triggers")
+            self._run_dpkg("--configure --pending", run_triggers=True)
+            self._run_dpkg("--triggers-only --pending", run_triggers=True)
+        if self.profile.sync:
+            logger.info("Flushing installed files to disk")
+            self._run("sync")
+
+    def simulate(self, cmd: str) -> List[AptAction]:
+        """Returns the actions that running the given apt command would perform. The
+        result is reused until a command changes the system."""
+        if cmd in self._simulations:
+            return self._simulations[cmd]
+        with CustomAptSource(self.apt_repository, self.package_cache) as apt_source:
+            full_cmd = cmd + self._source_options(apt_source) if apt_source else cmd
+            output = run_command(f"{full_cmd} --simulate", timeout=300)
+        self._simulations[cmd] = parse_apt_actions(output)
+        return self._simulations[cmd]
+
+    def check_dependencies(self) -> None:
+        """Holds back the packages that need packages the offline repository lacks to
+        be upgraded. Raises UnmetDependenciesError if essential packages are among
+        them."""
+        if self.apt_repository:
+            self.held_back |= verify_dependencies(
+                (Path(self.apt_repository) / "Packages").read_text()
+            )
+
+    def estimate_upgrade(self, cmd: str = "apt-get dist-upgrade -y") -> UpgradeEstimate:
+        """Estimates the duration of an upgrade by simulating it, using the sizes in
+        the offline repository and the timings of the previous upgrade"""
+        packages = [
+            (action.package, action.version)
+            for action in self.simulate(cmd)
+            if action.type == AptActionType.INSTALL
+        ]
+        packages_index = None
+        if self.apt_repository:
+            packages_index = (Path(self.apt_repository) / "Packages").read_text()
+        history = read_timings_report(TIMINGS_REPORT_FILE)
+        installed_sizes: Dict[str, int] = {}
+        if history:
+            try:
+                installed_sizes = {
+                    package: size for package, (_, size) in installed_packages().items()
+                }
+            except Exception as e:
+                logger.warning(f"Couldn't get size of installed packages: {e}")
+        return estimate_upgrade(packages, packages_index, history, installed_sizes)
+
+    def _package_path(self, action: AptAction) -> Optional[Path]:
+        """Path to the package file used by an install action in the offline
+        repository, if it's listed in its index"""
+        if self.apt_repository is None:
+            return None
+
+        if self._package_files is None:
+            self._package_files = read_packages_index(
+                Path(self.apt_repository) / "Packages"
+            )
+
+        # Packages for a foreign architecture have it appended to their name
+        name = action.package.split(":")[0]
+        filename = self._package_files.get((name, str(action.version)))
+        if filename is None:
+            return None
+        return Path(self.apt_repository) / filename
+
+    def _package_file(self, action: AptAction) -> Path:
+        """Path to the package file used by an install action, waiting until it's available"""
+        if self.apt_repository is None or not callable(self.wait_for_file):
+            raise Exception("Package files are only available in offline repositories")
+
+        path = self._package_path(action)
+        if path is None:
+            raise Exception(
+                f"Package '{action.package}' version '{action.version}' not found in {self.apt_repository}"
+            )
+        if not self.wait_for_file(path):
+            raise Exception(f"Package file '{path}' doesn't exist")
+        return path
+
+    @contextmanager
+    def _prefetching(self, actions: List[AptAction]) -> Iterator[PackagePrefetcher]:
+        """Reads ahead the package files of the install actions while installing them"""
+        packages = []
+        for action in actions:
+            if action.type == AptActionType.INSTALL:
+                path = self._package_path(action)
+                if path:
+                    packages.append((action.package, str(path)))
+
+        with PackagePrefetcher(packages) as prefetcher:
+            self._prefetcher = prefetcher
+            try:
+                yield prefetcher
+            finally:
+                self._prefetcher = None
+
+    def _install_plan(self, cmd: str) -> List[AptAction]:
+        """Actions of an apt command, to prefetch its packages; empty if they're not
+        read from an offline repository"""
+        if self.apt_repository is None:
+            return []
+        try:
+            return self.simulate(cmd)
+        except Exception as e:
+            logger.warning(f"Couldn't simulate '{cmd}': {e}")
+            return []
+
+    def _is_available(self, action: AptAction) -> bool:
+        """Whether the package file of an install action is available already"""
+        if not callable(self.is_extracted):
+            return False
+        path = self._package_path(action)
+        return path is not None and self.is_extracted(path)
+
+    def _files_pending(self, actions: List[AptAction]) -> bool:
+        """Whether any of the package files of the actions is still being extracted"""
+        return any(
+            action.type == AptActionType.INSTALL and not self._is_available(action)
+            for action in actions
+        )
+
+    def _wait_for_packages(self, actions: List[AptAction]) -> None:
+        for action in actions:
+            if action.type == AptActionType.INSTALL:
+                self._package_file(action)
+
+    def _index_hash(self) -> Optional[str]:
+        """Hash of the location and indexes of the offline repository"""
+        if self.apt_repository is None:
+            return None
+        digest = hashlib.sha256(str(Path(self.apt_repository).resolve()).encode())
+        for name in ("Packages", "Release"):
+            path = Path(self.apt_repository) / name
+            if path.exists():
+                digest.update(name.encode())
+                digest.update(path.read_bytes())
+        return digest.hexdigest()
+
+    def _has_package_lists(self) -> bool:
+        """Whether apt still has the lists of the offline repository; an online
+        'apt-get update' removes them"""
+        prefix = apt_list_prefix(str(Path(str(self.apt_repository)).resolve()))
+        return any(Path(APT_LISTS_FOLDER).glob(f"{glob.escape(prefix)}*Packages*"))
+
+    def _update_lists(self) -> None:
         self._run_cmd("apt-get update")
 
+    def update(self) -> None:
+        if self.apt_repository and callable(self.wait_for_file):
+            for name in self.release_files:
+                self.wait_for_file(Path(self.apt_repository) / name)
+
+        index_hash = self._index_hash()
+        try:
+            last_hash = Path(INDEX_HASH_FILE).read_text().strip()
+        except OSError:
+            last_hash = None
+
+        if index_hash and index_hash == last_hash and self._has_package_lists():
+            logger.info(
+                f"Repository in {self.apt_repository} didn't change since the last update; skipping 'apt-get update'"
+            )
+            return
+
+        Path(INDEX_HASH_FILE).unlink(missing_ok=True)
+        self._update_lists()
+        if index_hash:
+            try:
+                Path(INDEX_HASH_FILE).parent.mkdir(parents=True, exist_ok=True)
+                Path(INDEX_HASH_FILE).write_text(index_hash)
+            except OSError as e:
+                logger.warning(f"Couldn't save hash of the repository indexes: {e}")
+
     def upgrade_package(self, package_name) -> None:
-        self._run_cmd(f"apt-get install -y {package_name}")
+        """Upgrades a single package before the rest of the system, eg: the app itself
+        so that it restarts with the new version. The work the install profile defers
+        is left for 'upgrade', besides configuring the package."""
+        if package_name in self.held_back:
+            logger.warning(f"'{package_name}' is held back; not upgrading it")
+            return
+        cmd = f"apt-get install -y {package_name}"
+        try:
+            if callable(self.wait_for_file):
+                actions = self.simulate(cmd)
+                self._wait_for_packages(actions)
+            else:
+                actions = self._install_plan(cmd)
+            with self._prefetching(actions):
+                self._run_cmd(cmd)
+            self._configure_unpacked()
+        finally:
+            self._save_timings()
 
     def upgrade(self) -> None:
-        self._run_cmd("apt-get dist-upgrade -y")
+        try:
+            with self._holding_back():
+                if callable(self.wait_for_file):
+                    self._pipelined_upgrade()
+                else:
+                    cmd = "apt-get dist-upgrade -y"
+                    with self._prefetching(self._install_plan(cmd)):
+                        self._run_cmd(cmd)
+            self._finish_install()
+        finally:
+            self._save_timings()
+
+    @contextmanager
+    def _holding_back(self) -> Iterator[None]:
+        """Holds the packages in 'held_back' with apt-mark while upgrading, so that
+        neither apt nor the steps replayed with dpkg install them. Packages held by an
+        upgrade that was interrupted are released first; the ones held before are
+        left as they are."""
+        self._release_held_back()
+        packages = []
+        if self.held_back:
+            already_held = run_command("apt-mark showhold", timeout=30).split()
+            packages = sorted(self.held_back - set(already_held))
+        if packages:
+            logger.info(f"Holding back {', '.join(packages)}")
+            Path(HELD_BACK_FILE).parent.mkdir(parents=True, exist_ok=True)
+            Path(HELD_BACK_FILE).write_text("\n".join(packages) + "\n")
+            self._run_cmd(f"apt-mark hold {' '.join(quote(p) for p in packages)}")
+        try:
+            yield
+        finally:
+            self._release_held_back()
+
+    def _release_held_back(self) -> None:
+        try:
+            packages = Path(HELD_BACK_FILE).read_text().split()
+        except OSError:
+            return
+        if packages:
+            self._run_cmd(f"apt-mark unhold {' '.join(quote(p) for p in packages)}")
+        Path(HELD_BACK_FILE).unlink(missing_ok=True)
+
+    def reinstall(self, packages: List[str]) -> None:
+        """Installs the given packages again, eg: 'foo=1.0'"""
+        try:
+            self._run_cmd(
+                f"apt-get install -y --reinstall {' '.join(quote(p) for p in packages)}"
+            )
+            self._finish_install()
+        finally:
+            self._save_timings()
+
+    def _pipelined_upgrade(self) -> None:
+        """Upgrades the system while the repository is still being written.
+
+        Packages are unpacked and configured with dpkg in the same order apt would use,
+        so each of them only needs to wait for its own package file to be available.
+        Once every package file left is available, apt finishes the upgrade."""
+        cmd = "apt-get dist-upgrade -y"
+        actions = self.simulate(cmd)
+        if any(action.type == AptActionType.REMOVE for action in actions):
+            logger.info("Upgrade removes packages; letting apt handle it")
+        elif not self._files_pending(actions):
+            logger.info("Package files are already available; letting apt upgrade")
+        else:
+            self._run_pipeline(cmd, actions)
+            return
+
+        self._wait_for_packages(actions)
+        with self._prefetching(actions):
+            self._run_cmd(cmd)
+
+    def _run_pipeline(self, cmd: str, actions: List[AptAction]) -> None:
+        logger.info(f"Upgrading system in up to {len(actions)} steps")
+        done = 0
+        with self._prefetching(actions) as prefetcher:
+            while done < len(actions) and self._files_pending(actions[done:]):
+                batch = [actions[done]]
+                if batch[0].type == AptActionType.INSTALL:
+                    # Together with the next packages that are available already
+                    files = [self._package_file(batch[0])]
+                    for action in actions[done + 1 :]:
+                        if action.type != AptActionType.INSTALL:
+                            break
+                        if not self._is_available(action):
+                            break
+                        batch.append(action)
+                        files.append(self._package_file(action))
+                    prefetcher.advance(batch[0].package)
+                    # Same options apt unpacks packages with
+                    self._run_dpkg(
+                        "--unpack --auto-deconfigure "
+                        + " ".join(quote(str(path)) for path in files)
+                    )
+                else:
+                    for action in actions[done + 1 :]:
+                        if action.type != AptActionType.CONFIGURE:
+                            break
+                        batch.append(action)
+                    self._run_dpkg(
+                        "--configure "
+                        + " ".join(quote(action.package) for action in batch)
+                    )
+                done += len(batch)
+                if callable(self.on_progress):
+                    self.on_progress(100.0 * done / len(actions))
+
+        if done < len(actions):
+            # apt configures the packages that were left unpacked too
+            logger.info(
+                f"Package files of the last {len(actions) - done} steps are available; letting apt finish the upgrade"
+            )
+            with self._prefetching(actions[done:]):
+                self._run_cmd(cmd)
+        else:
+            # Run pending triggers and let apt check that nothing was left behind
+            self._run_dpkg("--configure --pending")
+            self._run_cmd(cmd)
+
+        # Packages installed directly with dpkg are considered manually installed by apt
+        new_packages = [
+            quote(action.package)
+            for action in actions[:done]
+            if action.type == AptActionType.INSTALL and not action.installed_version
+        ]
+        if new_packages:
+            self._run_cmd(f"apt-mark auto {' '.join(new_packages)}")
@@ -0,0 +1,116 @@
+import logging
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from pi_top_usb_setup.apt_index import (
+    compare_versions,
+    package_relations,
+    parse_paragraph,
+    parse_relations,
+    split_paragraphs,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class UpdatePlan:
+    """Packages of an offline repository that an upgrade will install"""
+
+    # Paragraphs of the packages to install, as a 'Packages' index
+    packages_index: str
+    # Files of the packages to install, relative to the repository
+    files: Set[str] = field(default_factory=set)
+    # Files of the packages that are left out, relative to the repository
+    skipped_files: Set[str] = field(default_factory=set)
+
+
+def plan_updates(
+    packages_index: str,
+    installed: Dict[str, str],
+    installed_provides: Optional[Dict[str, Set[str]]] = None,
+) -> UpdatePlan:
+    """Selects the packages of a 'Packages' index that an upgrade of a system with the
+    'installed' package versions, by name, will use.
+
+    Those are the packages newer than the installed ones, and the packages they depend
+    on or recommend that aren't installed yet, recursively. Virtual packages that no
+    installed package provides bring in one of their providers, preferably one that
+    is installed. Only the newest version of each package in the index is used."""
+    installed_provides = installed_provides or {}
+    # Newest version of each package and architecture in the index
+    newest: Dict[Tuple[str, str], Tuple[Dict[str, str], str]] = {}
+    for paragraph in split_paragraphs(packages_index):
+        fields = parse_paragraph(paragraph)
+        if "Package" not in fields or "Version" not in fields:
+            continue
+        key = (fields["Package"], fields.get("Architecture", ""))
+        current = newest.get(key)
+        if (
+            current is None
+            or compare_versions(fields["Version"], current[0]["Version"]) > 0
+        ):
+            newest[key] = (fields, paragraph)
+
+    by_name: Dict[str, List[Tuple[str, str]]] = {}
+    # Names of the packages that provide each virtual package
+    providers: Dict[str, Set[str]] = {}
+    for key, (fields, _) in newest.items():
+        by_name.setdefault(key[0], []).append(key)
+        for alternatives in parse_relations(fields.get("Provides", "")):
+            providers.setdefault(alternatives[0][0], set()).add(key[0])
+
+    def provider(virtual: str) -> Optional[str]:
+        names = sorted(providers.get(virtual, []))
+        return next((name for name in names if name in installed), None) or next(
+            iter(names), None
+        )
+
+    selected: Set[Tuple[str, str]] = set()
+    pending: List[Tuple[str, str]] = []
+    for key, (fields, _) in newest.items():
+        name = key[0]
+        if (
+            name in installed
+            and compare_versions(fields["Version"], installed[name]) > 0
+        ):
+            pending.append(key)
+
+    # New dependencies of the upgraded packages are installed too
+    while pending:
+        key = pending.pop()
+        if key in selected:
+            continue
+        selected.add(key)
+        for name in package_relations(newest[key][0]):
+            if name in installed or name in installed_provides:
+                continue
+            if name in by_name:
+                pending.extend(by_name[name])
+                continue
+            new_provider = provider(name)
+            if new_provider:
+                pending.extend(by_name[new_provider])
+
+    plan = UpdatePlan(
+        packages_index="\n\n".join(
+            newest[key][1].strip("\n") for key in sorted(selected)
+        )
+        + "\n"
+    )
+    for paragraph in split_paragraphs(packages_index):
+        fields = parse_paragraph(paragraph)
+        if "Filename" not in fields:
+            continue
+        key = (fields.get("Package", ""), fields.get("Architecture", ""))
+        filename = str(Path(fields["Filename"]))
+        if key in selected and newest[key][1] == paragraph:
+            plan.files.add(filename)
+        else:
+            plan.skipped_files.add(filename)
+
+    logger.info(
+        f"{len(plan.files)} packages will be installed, {len(plan.skipped_files)} left out"
+    )
+    return plan
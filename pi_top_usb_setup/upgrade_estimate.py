@@ -0,0 +1,134 @@
+import json
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from pi_top_usb_setup.apt_index import parse_packages_index
+
+logger = logging.getLogger(__name__)
+
+# Install speed used when there are no timings of previous upgrades to learn from
+DEFAULT_SECONDS_PER_MB = 1.5
+# Time spent on every package regardless of its size: dpkg database updates,
+# maintainer scripts...
+PACKAGE_OVERHEAD = 1.0
+# The apt progress is trusted over the estimate once it's past this percentage
+MIN_PERCENTAGE_TO_CORRECT = 10.0
+
+
+def format_eta(seconds: float) -> str:
+    """eg: '1:05 left'"""
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}:{seconds:02d} left"
+
+
+@dataclass
+class UpgradeEstimate:
+    """Expected size and duration of an upgrade"""
+
+    packages: int = 0
+    # Size of the package files
+    download_size: int = 0
+    # Size of the packages once installed
+    installed_size: int = 0
+    # Seconds
+    duration: float = 0.0
+    # Expected seconds to install each package, by name
+    package_durations: Dict[str, float] = field(default_factory=dict)
+
+    def eta(self, elapsed: float, percentage: float) -> float:
+        """Seconds left after 'elapsed' seconds of upgrade, 'percentage' of which is done.
+
+        Starts from the estimate and moves towards the pace apt is actually going at
+        as the upgrade progresses."""
+        remaining = max(self.duration - elapsed, 0)
+        if percentage >= MIN_PERCENTAGE_TO_CORRECT and elapsed > 0:
+            measured = elapsed * (100 - percentage) / percentage
+            weight = min(percentage / 100, 1)
+            remaining = weight * measured + (1 - weight) * remaining
+        return max(remaining, 0)
+
+    def progress(self, elapsed: float, percentage: float) -> float:
+        """Percentage of the time the upgrade is expected to take that has passed"""
+        eta = self.eta(elapsed, percentage)
+        if elapsed + eta <= 0:
+            return 100.0
+        return min(elapsed / (elapsed + eta), 1) * 100.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.packages} packages, {self.download_size / 1024 / 1024:.1f} MB, "
+            f"{self.installed_size / 1024 / 1024:.1f} MB installed, "
+            f"about {int(self.duration)}s"
+        )
+
+
+def read_timings_report(path: str) -> Dict[str, float]:
+    """Seconds it took to install each package in a previous upgrade, by name, as saved
+    by PackageTimings"""
+    try:
+        with open(path) as file:
+            report = json.load(file)
+        return {entry["package"]: float(entry["total"]) for entry in report["packages"]}
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning(f"Couldn't read package timings from {path}: {e}")
+        return {}
+
+
+def seconds_per_byte(
+    history: Dict[str, float], installed_sizes: Dict[str, int]
+) -> float:
+    """Install speed learned from the timings of a previous upgrade and the installed
+    size of those packages"""
+    total_time = 0.0
+    total_size = 0
+    for package, seconds in history.items():
+        size = installed_sizes.get(package, 0)
+        if size > 0:
+            total_time += max(seconds - PACKAGE_OVERHEAD, 0)
+            total_size += size
+    if total_size == 0 or total_time == 0:
+        return DEFAULT_SECONDS_PER_MB / 1024 / 1024
+    return total_time / total_size
+
+
+def estimate_upgrade(
+    packages: List[Tuple[str, Optional[str]]],
+    packages_index: Optional[str] = None,
+    history: Optional[Dict[str, float]] = None,
+    installed_sizes: Optional[Dict[str, int]] = None,
+) -> UpgradeEstimate:
+    """Estimates how long installing 'packages', a list of names and versions, takes.
+
+    Packages that were timed in a previous upgrade are expected to take as long as
+    they did; the rest, a fixed overhead plus their installed size at the speed
+    measured in that upgrade."""
+    history = history or {}
+    rate = seconds_per_byte(history, installed_sizes or {})
+
+    sizes: Dict[Tuple[str, str], Tuple[int, int]] = {}
+    for fields in parse_packages_index(packages_index or ""):
+        if "Package" not in fields or "Version" not in fields:
+            continue
+        file_size = fields.get("Size", "0")
+        kilobytes = fields.get("Installed-Size", "0")
+        sizes[(fields["Package"], fields["Version"])] = (
+            int(file_size) if file_size.isdigit() else 0,
+            int(kilobytes) * 1024 if kilobytes.isdigit() else 0,
+        )
+
+    estimate = UpgradeEstimate(packages=len(packages))
+    for package, version in packages:
+        # Packages for a foreign architecture have it appended to their name
+        name = package.split(":")[0]
+        size, installed_size = sizes.get((name, str(version)), (0, 0))
+        estimate.download_size += size
+        estimate.installed_size += installed_size
+        duration = history.get(name, PACKAGE_OVERHEAD + installed_size * rate)
+        estimate.package_durations[name] = duration
+        estimate.duration += duration
+
+    logger.info(f"Upgrade estimate: {estimate}")
+    return estimate
@@ -5,20 +5,26 @@ import pwd
 import shutil
 import signal
 import stat
-import tarfile
 import time
+from collections import deque
 from pathlib import Path
-from queue import Queue
-from shlex import split
+from queue import Empty, Queue
+from shlex import quote, split
 from subprocess import PIPE, Popen
 from threading import Thread, Timer
-from time import sleep
-from typing import Callable, Dict, Optional
+from typing import Callable, Deque, Dict, List, Optional
 
 from pitop.common.command_runner import run_command
 
+from pi_top_usb_setup.dpkg_status import status_index
+from pi_top_usb_setup.extraction import ExtractionEngine
+from pi_top_usb_setup.watchdog import ProcessInfo, StallWatchdog, terminate_tree
+
 logger = logging.getLogger(__name__)
 
+# Output lines of a process logged when it stalls
+LAST_OUTPUT_LINES = 50
+
 
 class RestartingSystemdService(Exception):
     pass
@@ -52,38 +58,35 @@ def umount_usb_drive(mount_point: str) -> None:
         logger.error(f"Error unmounting {mount_point}: {e}")
 
 
+def mount_image(image: str, mount_point: str) -> None:
+    logger.info(f"Mounting image {image} in {mount_point}")
+    os.makedirs(mount_point, exist_ok=True)
+    run_command(
+        f"mount -t squashfs -o loop,ro {quote(image)} {quote(mount_point)}",
+        timeout=30,
+    )
+
+
+def umount_image(mount_point: str) -> None:
+    logger.info(f"Umounting image mounted in {mount_point}")
+    try:
+        run_command(f"umount {quote(mount_point)}", timeout=15)
+    except Exception as e:
+        logger.error(f"Error unmounting {mount_point}: {e}")
+
+
 def close_app() -> None:
     logger.info("Closing application")
     systemctl("stop", "'pt-usb-setup@*'")
     systemctl("stop", "pt-usb-setup")
 
 
-def get_tar_gz_extracted_size(file: str) -> int:
-    # Gets the size of the extracted content of a tar.gz file
-    # Uncompressed size is stored in the last 4 bytes of the gzip file
-    # https://stackoverflow.com/a/22348071
-    size = -1
-    with open(file, "rb") as f:
-        f.seek(-4, 2)
-        size = int.from_bytes(f.read(), "little")
-    logger.info(f"Size of {file} content is {size}")
-    return size
-
-
 def extract_file(
     file: str, destination: str, on_progress: Optional[Callable] = None
 ) -> None:
-    logger.info(f"Extracting {file} into {destination}")
-    if not Path(file).exists():
-        raise Exception(f"File {file} doesn't exist")
-
-    os.makedirs(destination, exist_ok=True)
-    with tarfile.open(file, "r:gz") as tar:
-        total_items = len(tar.getmembers())
-        for i, member in enumerate(tar.getmembers()):
-            if callable(on_progress):
-                on_progress(float(i / total_items * 100.0))
-            tar.extract(member=member, path=destination)
+    ExtractionEngine().extract(
+        file=file, destination=destination, on_progress=on_progress
+    )
 
 
 def drive_has_enough_free_space(drive: str, space: int) -> bool:
@@ -99,10 +102,7 @@ def drive_has_enough_free_space(drive: str, space: int) -> bool:
 def get_package_version(package: str) -> str:
     version = ""
     try:
-        cmd = f"dpkg-query --show {package}"
-        output = run_command(cmd, timeout=10).split()
-        if len(output) > 1:
-            version = output[1]
+        version = status_index.version(package) or ""
     except Exception as e:
         logger.error(f"Error while getting version of '{package}': {e}")
     finally:
@@ -111,25 +111,52 @@ def get_package_version(package: str) -> str:
 
 
 class Process:
-    """Runs a command allowing to handle stdout and stderr messages that it produces"""
+    """Runs a command allowing to handle stdout and stderr messages that it produces.
+
+    If 'stall_timeout' is given, the command is terminated once neither it nor its
+    children produce output, use CPU or read or write anything for that many
+    seconds; the process tree and its last output are logged to diagnose it. The
+    'timeout' is a limit for the whole command, regardless of its progress."""
 
     def __init__(
         self,
         run_command: str,
-        timeout: int,
+        timeout: Optional[int],
         stdout_callback: Optional[Callable] = None,
         stderr_callback: Optional[Callable] = None,
+        stall_timeout: Optional[float] = None,
     ) -> None:
         self.run_command = run_command
         self.timeout = timeout
+        self.stall_timeout = stall_timeout
         self.stdout_callback = stdout_callback
         self.stderr_callback = stderr_callback
+        self.stalled = False
         self._process: Optional[Popen] = None
         self._log_queue: Queue = Queue()
+        self._last_output: Deque[str] = deque(maxlen=LAST_OUTPUT_LINES)
+        self._watchdog: Optional[StallWatchdog] = None
+
+    def _on_stall(self, tree: List[ProcessInfo]) -> None:
+        self.stalled = True
+        logger.error(
+            f"No progress in {self.stall_timeout} seconds: '{self.run_command}'; "
+            "terminating. Process tree (pid, parent, state, waiting in, command):\n"
+            + "\n".join(str(info) for info in tree)
+        )
+        logger.error(
+            "Last output:\n" + "".join(self._last_output)
+            if self._last_output
+            else "No output"
+        )
+        terminate_tree(tree)
 
     def run(self, environment: Optional[Dict] = None) -> int:
         """Run command and wait for it to finish"""
-        logging.info(f"Executing '{self.run_command}' with timeout {self.timeout}")
+        logging.info(
+            f"Executing '{self.run_command}' with timeout {self.timeout} "
+            f"and stall timeout {self.stall_timeout}"
+        )
         self._process = Popen(
             split(self.run_command),
             stdout=PIPE,
@@ -137,6 +164,11 @@ class Process:
             env=environment if environment else os.environ,
             text=True,
         )
+        if self.stall_timeout:
+            self._watchdog = StallWatchdog(
+                self._process.pid, self.stall_timeout, self._on_stall
+            )
+            self._watchdog.start()
 
         # Handle stream messages produced by self._process
         def queue_logs(stream_name, stream):
@@ -144,49 +176,78 @@ class Process:
                 self._log_queue.put((stream_name, line))
             stream.close()
 
-        Thread(
-            target=queue_logs, args=["stdout", self._process.stdout], daemon=True
-        ).start()
-        Thread(
-            target=queue_logs, args=["stderr", self._process.stderr], daemon=True
-        ).start()
-
-        # Logs messages produced by streams in the background
+        readers = [
+            Thread(target=queue_logs, args=[name, stream], daemon=True)
+            for name, stream in (
+                ("stdout", self._process.stdout),
+                ("stderr", self._process.stderr),
+            )
+        ]
+        for reader in readers:
+            reader.start()
+
+        # Logs messages produced by streams in the background, until both streams
+        # are closed
         def log():
-            while self._process or not self._log_queue.empty():
+            while any(reader.is_alive() for reader in readers) or (
+                not self._log_queue.empty()
+            ):
+                try:
+                    stream, message = self._log_queue.get(timeout=0.1)
+                except Empty:
+                    continue
+                self._last_output.append(message)
+                if self._watchdog:
+                    self._watchdog.notify()
                 try:
-                    stream, message = self._log_queue.get_nowait()
-                    try:
-                        if stream == "stdout" and callable(self.stdout_callback):
-                            self.stdout_callback(message)
-                        if stream == "stderr" and callable(self.stderr_callback):
-                            self.stderr_callback(message)
-                    except Exception as e:
-                        logger.error(f"Process user callback: {e}")
-                except Exception:
-                    sleep(0.5)
-
-        Thread(target=log, daemon=True).start()
+                    if stream == "stdout" and callable(self.stdout_callback):
+                        self.stdout_callback(message)
+                    if stream == "stderr" and callable(self.stderr_callback):
+                        self.stderr_callback(message)
+                except Exception as e:
+                    logger.error(f"Process user callback: {e}")
+
+        log_thread = Thread(target=log, daemon=True)
+        log_thread.start()
 
         # Handle timeout
         def terminate(process):
             logger.warning(f"Process timed out: '{self.run_command}'; terminating")
             process.terminate()
 
-        Timer(self.timeout, terminate, [self._process]).start()
+        timer = None
+        if self.timeout:
+            timer = Timer(self.timeout, terminate, [self._process])
+            timer.daemon = True
+            timer.start()
 
         # Wait for process to exit/timeout and return
         exit_code = self._process.wait()
+        if timer:
+            timer.cancel()
+        if self._watchdog:
+            self._watchdog.stop()
+        # Children that inherited the streams might keep them open
+        log_thread.join(timeout=5)
         logger.info(f"Command exited with code {exit_code}")
-        self.process = None
+        self._process = None
         return exit_code
 
 
-def restart_service_and_skip_user_confirmation_dialog(mount_point: str):
+def restart_service_and_skip_user_confirmation_dialog(
+    mount_point: str,
+    usb_drive: Optional[str] = None,
+    mounted_image: Optional[str] = None,
+):
+    # The new instance umounts the USB drive and the setup image once it's done
+    args = f"{mount_point} --skip-dialog"
+    if usb_drive:
+        args += f" --usb-drive {usb_drive}"
+    if mounted_image:
+        args += f" --mounted-image {mounted_image}"
+
     # Start an instance with arguments; these should be encoded
-    encoded_args = run_command(
-        f"systemd-escape -- '{mount_point} --skip-dialog'", timeout=5
-    )
+    encoded_args = run_command(f"systemd-escape -- '{args}'", timeout=5)
     systemctl("start", f"pt-usb-setup@'{encoded_args}'")
 
     # Stop this instance
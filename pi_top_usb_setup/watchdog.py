@@ -0,0 +1,177 @@
+import logging
+import os
+import signal
+from dataclasses import dataclass, field
+from threading import Event, Lock, Thread, Timer
+from time import monotonic
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ProcessInfo:
+    pid: int
+    ppid: int
+    state: str
+    # CPU time of the process and of its children that already exited, in clock ticks
+    cpu_ticks: int
+    # Bytes read and written, including pipes
+    io_bytes: int = 0
+    # Kernel function the process is waiting in, if it's sleeping
+    wchan: str = ""
+    command: List[str] = field(default_factory=list)
+
+    def __str__(self) -> str:
+        return (
+            f"{self.pid:>7} {self.ppid:>7} {self.state} {self.wchan or '-':<20} "
+            f"{' '.join(self.command)}"
+        )
+
+
+def _read(path: str) -> str:
+    with open(path, "rb") as file:
+        return file.read().decode(errors="replace")
+
+
+def read_process(pid: int, proc: str = "/proc") -> Optional[ProcessInfo]:
+    """Reads the state of a process; None if it doesn't exist anymore"""
+    try:
+        stat = _read(f"{proc}/{pid}/stat")
+    except OSError:
+        return None
+    # The command name can contain spaces and parentheses, so it's skipped up to the
+    # last parenthesis; see proc(5)
+    fields = stat[stat.rfind(")") + 2 :].split()
+    info = ProcessInfo(
+        pid=pid,
+        ppid=int(fields[1]),
+        state=fields[0],
+        # utime, stime, cutime, cstime
+        cpu_ticks=sum(int(value) for value in fields[11:15]),
+    )
+    try:
+        for line in _read(f"{proc}/{pid}/io").splitlines():
+            name, _, value = line.partition(":")
+            if name in ("rchar", "wchar"):
+                info.io_bytes += int(value)
+    except (OSError, ValueError):
+        pass
+    try:
+        info.wchan = _read(f"{proc}/{pid}/wchan").strip("\0 \n")
+        info.command = _read(f"{proc}/{pid}/cmdline").rstrip("\0").split("\0")
+    except OSError:
+        pass
+    return info
+
+
+def process_tree(pid: int, proc: str = "/proc") -> List[ProcessInfo]:
+    """Returns a process and all of its descendants, parents first"""
+    children: Dict[int, List[int]] = {}
+    for entry in os.listdir(proc):
+        if not entry.isdigit():
+            continue
+        try:
+            stat = _read(f"{proc}/{entry}/stat")
+            ppid = int(stat[stat.rfind(")") + 2 :].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    tree = []
+    pending = [pid]
+    while pending:
+        info = read_process(pending.pop(0), proc)
+        if info is None:
+            continue
+        tree.append(info)
+        pending += sorted(children.get(info.pid, []))
+    return tree
+
+
+class StallWatchdog:
+    """Detects when a process and its descendants stop making progress.
+
+    Any of output lines (reported with 'notify'), CPU time or reads and writes in
+    the process tree count as progress, so a long but busy process is never
+    considered stalled. 'on_stall' is called with the process tree once nothing
+    happened for 'window' seconds."""
+
+    def __init__(
+        self,
+        pid: int,
+        window: float,
+        on_stall: Callable[[List[ProcessInfo]], None],
+        interval: Optional[float] = None,
+    ) -> None:
+        self.pid = pid
+        self.window = window
+        self.on_stall = on_stall
+        self.interval = interval if interval else min(max(window / 10, 1), 30)
+        self.stalled = False
+        self._lock = Lock()
+        self._last_activity = monotonic()
+        self._last_usage: Optional[int] = None
+        self._stop = Event()
+        self._thread: Optional[Thread] = None
+
+    def notify(self) -> None:
+        """Reports activity of the process, eg: output or progress"""
+        with self._lock:
+            self._last_activity = monotonic()
+
+    def start(self) -> None:
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            if self.check():
+                return
+
+    def check(self) -> bool:
+        """Checks the process tree for activity; returns whether it stalled"""
+        tree = process_tree(self.pid)
+        usage = sum(info.cpu_ticks + info.io_bytes for info in tree)
+        now = monotonic()
+        with self._lock:
+            if usage != self._last_usage:
+                self._last_usage = usage
+                self._last_activity = now
+            idle = now - self._last_activity
+        if not tree or idle < self.window:
+            return False
+
+        self.stalled = True
+        self.on_stall(tree)
+        return True
+
+
+def terminate_tree(tree: List[ProcessInfo], grace_period: float = 10) -> None:
+    """Terminates the processes in a tree, killing the ones still alive after the
+    grace period"""
+    # Children first, so that parents don't react to their children dying by
+    # starting something else
+    for info in reversed(tree):
+        try:
+            os.kill(info.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def kill_survivors() -> None:
+        for info in reversed(tree):
+            current = read_process(info.pid)
+            # The pid might have been reused by another process
+            if current is not None and current.command == info.command:
+                logger.warning(f"Killing process {info.pid} that didn't terminate")
+                try:
+                    os.kill(info.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+    timer = Timer(grace_period, kill_survivors)
+    timer.daemon = True
+    timer.start()
@@ -0,0 +1,100 @@
+import sys
+from unittest.mock import MagicMock
+
+import pytest
+
+
+@pytest.fixture
+def python_apt(mocker):
+    """python-apt isn't available outside of Debian systems"""
+
+    class InstallProgress:
+        pass
+
+    apt = MagicMock()
+    apt.progress.base.InstallProgress = InstallProgress
+    apt_pkg = MagicMock()
+    mocker.patch.dict(
+        sys.modules,
+        {
+            "apt": apt,
+            "apt.progress": apt.progress,
+            "apt.progress.base": apt.progress.base,
+            "apt_pkg": apt_pkg,
+        },
+    )
+    yield apt, apt_pkg
+
+
+@pytest.fixture
+def repository(tmp_path):
+    (tmp_path / "Packages").write_text("Package: foo\nVersion: 1.1\n")
+    yield tmp_path
+
+
+def test_backend_requires_python_apt(mocker, repository):
+    from pi_top_usb_setup.apt_backend import PythonAptUpdater, python_apt_available
+    from pi_top_usb_setup.exceptions import UnsupportedBackendError
+
+    mocker.patch.dict(sys.modules, {"apt": None, "apt_pkg": None})
+
+    assert not python_apt_available()
+    with pytest.raises(UnsupportedBackendError):
+        PythonAptUpdater(apt_repository=str(repository))
+
+
+def test_cache_is_shared_by_all_steps(mocker, python_apt, repository, tmp_path):
+    from pi_top_usb_setup import system_updater
+    from pi_top_usb_setup.apt_backend import PythonAptUpdater
+
+    apt, apt_pkg = python_apt
+    mocker.patch.object(system_updater, "INDEX_HASH_FILE", str(tmp_path / "hash"))
+    mocker.patch.object(
+        system_updater, "TIMINGS_REPORT_FILE", str(tmp_path / "timings.json")
+    )
+    cache = apt.Cache.return_value
+    package = MagicMock(marked_delete=False)
+    package.candidate.filename = "./foo_1.1_all.deb"
+    cache.get_changes.return_value = [package]
+    cache.commit.return_value = True
+    on_progress = mocker.Mock()
+    wait_for_file = mocker.Mock(return_value=True)
+
+    updater = PythonAptUpdater(
+        apt_repository=str(repository),
+        on_progress=on_progress,
+        wait_for_file=wait_for_file,
+    )
+    updater.update()
+    updater.upgrade_package("pi-top-usb-setup")
+    updater.upgrade()
+
+    apt.Cache.assert_called_once()
+    assert cache.update.call_args.kwargs["sources_list"].endswith(".list")
+    cache["pi-top-usb-setup"].mark_install.assert_called_once()
+    cache.upgrade.assert_called_once_with(dist_upgrade=True)
+    assert cache.commit.call_count == 2
+    wait_for_file.assert_any_call(repository / "foo_1.1_all.deb")
+    apt_pkg.config.set.assert_any_call("DPkg::Options::", "--force-confold")
+
+    # Install progress is reported like apt-get's
+    progress = cache.commit.call_args.kwargs["install_progress"]
+    progress.status_change("foo:arm64", 50.0, "Unpacking foo:arm64 (1.1)")
+    on_progress.assert_called_with(50.0)
+    assert updater.timings._current[:2] == ("foo", "unpack")
+
+
+def test_failed_commit_raises(python_apt, repository, tmp_path, mocker):
+    from pi_top_usb_setup import system_updater
+    from pi_top_usb_setup.apt_backend import PythonAptUpdater
+
+    apt, _ = python_apt
+    mocker.patch.object(
+        system_updater, "TIMINGS_REPORT_FILE", str(tmp_path / "timings.json")
+    )
+    cache = apt.Cache.return_value
+    cache.get_changes.return_value = [MagicMock(marked_delete=True)]
+    cache.commit.return_value = False
+
+    with pytest.raises(Exception, match="couldn't install"):
+        PythonAptUpdater(apt_repository=str(repository)).upgrade()
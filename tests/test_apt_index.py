@@ -0,0 +1,102 @@
+import hashlib
+
+import pytest
+
+
+@pytest.mark.parametrize(
+    "version,other,expected",
+    [
+        ("1.0", "1.0", 0),
+        ("1.0", "1.1", -1),
+        ("1.10", "1.9", 1),
+        ("1.0~rc1", "1.0", -1),
+        ("1.0", "1.0+b1", -1),
+        ("1:0.5", "2.0", 1),
+        ("2.0-1", "2.0-1+rpt1", -1),
+        ("2.0-10", "2.0-9", 1),
+        ("1.0a", "1.0", 1),
+        ("1.001", "1.1", 0),
+        ("1.0-1", "1.0", 1),
+    ],
+)
+def test_compare_versions(version, other, expected):
+    from pi_top_usb_setup.apt_index import compare_versions
+
+    result = compare_versions(version, other)
+    assert (result > 0) - (result < 0) == expected
+
+
+def test_package_relations():
+    from pi_top_usb_setup.apt_index import package_relations
+
+    fields = {
+        "Pre-Depends": "init-system-helpers (>= 1.54~)",
+        "Depends": "libc6:any (>= 2.34), libfoo | libbar [arm64]",
+        "Recommends": "baz",
+    }
+
+    assert package_relations(fields) == [
+        "init-system-helpers",
+        "libc6",
+        "libfoo",
+        "libbar",
+        "baz",
+    ]
+
+
+def test_rewrite_release():
+    from pi_top_usb_setup.apt_index import rewrite_release
+
+    release = (
+        "Origin: pi-top\n"
+        "MD5Sum:\n"
+        " 0123 100 Packages\n"
+        " 4567 50 Packages.gz\n"
+        "SHA256:\n"
+        " 89ab 100 Packages\n"
+        " cdef 50 Packages.gz\n"
+    )
+    packages = b"Package: foo\n"
+
+    rewritten = rewrite_release(release, {"Packages": packages})
+
+    md5 = hashlib.md5(packages).hexdigest()
+    sha256 = hashlib.sha256(packages).hexdigest()
+    assert rewritten.splitlines() == [
+        "Origin: pi-top",
+        "MD5Sum:",
+        f" {md5} {len(packages):>16} Packages",
+        "SHA256:",
+        f" {sha256} {len(packages):>16} Packages",
+    ]
+
+
+def test_parse_relations():
+    from pi_top_usb_setup.apt_index import parse_relations
+
+    assert parse_relations(
+        "libc6:any (>= 2.34), libfoo (<<2.0) [arm64] | libbar <!nocheck>, baz"
+    ) == [
+        [("libc6", ">=", "2.34")],
+        [("libfoo", "<<", "2.0"), ("libbar", None, None)],
+        [("baz", None, None)],
+    ]
+    assert parse_relations("") == []
+
+
+@pytest.mark.parametrize(
+    "version,operator,required,expected",
+    [
+        ("1.0", None, None, True),
+        ("1.0", "=", "1.0", True),
+        ("1.0", ">=", "1.1", False),
+        ("1.1", ">>", "1.0", True),
+        ("1.0", "<<", "1.0", False),
+        ("1.0", "<=", "1.0", True),
+        ("1.0", "<", "1.0", True),
+    ],
+)
+def test_satisfies(version, operator, required, expected):
+    from pi_top_usb_setup.apt_index import satisfies
+
+    assert satisfies(version, operator, required) == expected
@@ -0,0 +1,121 @@
+import json
+
+
+def test_parse_apt_status():
+    from pi_top_usb_setup.apt_status import AptStatusType, parse_apt_status
+
+    event = parse_apt_status(
+        "pmstatus:libc6:arm64:42.5:Unpacking libc6:arm64 (2.36-9) over (2.31-13)\n"
+    )
+    assert event.type == AptStatusType.PM_STATUS
+    assert event.subject == "libc6:arm64"
+    assert event.percentage == 42.5
+    assert event.description == "Unpacking libc6:arm64 (2.36-9) over (2.31-13)"
+
+    event = parse_apt_status("error:foo:10:dpkg: error processing package foo")
+    assert event.type == AptStatusType.PM_ERROR
+    assert event.description == "dpkg: error processing package foo"
+
+    event = parse_apt_status(
+        "pmconffile:/etc/foo.conf:50:'/etc/foo.conf' '/etc/foo.conf.dpkg-new' 1 1"
+    )
+    assert event.type == AptStatusType.PM_CONFFILE
+    assert event.subject == "/etc/foo.conf"
+
+    event = parse_apt_status("dlstatus:1:20:Retrieving file 1 of 5")
+    assert event.type == AptStatusType.DL_STATUS
+    assert event.percentage == 20
+
+    event = parse_apt_status("media-change:Debian 12:/media/cdrom:Please insert")
+    assert event.type == AptStatusType.MEDIA_CHANGE
+    assert event.subject == "Debian 12"
+    assert event.drive == "/media/cdrom"
+    assert event.percentage is None
+
+    assert parse_apt_status("Reading package lists...") is None
+    assert parse_apt_status("pmstatus:foo:not-a-number:Unpacking") is None
+
+
+def test_parse_dpkg_status():
+    from pi_top_usb_setup.apt_status import parse_dpkg_status
+
+    assert parse_dpkg_status("processing: unpack: libc6:arm64\n") == (
+        "unpack",
+        "libc6:arm64",
+    )
+    assert parse_dpkg_status("processing: trigproc: man-db:arm64") == (
+        "trigproc",
+        "man-db:arm64",
+    )
+    assert parse_dpkg_status("status: libc6:arm64: half-installed") is None
+    assert parse_dpkg_status("Setting up libc6:arm64 (2.36-9) ...") is None
+
+
+def test_package_phase():
+    from pi_top_usb_setup.apt_status import package_phase
+
+    assert package_phase("Preparing to unpack .../foo_1.1_arm64.deb") == "unpack"
+    assert package_phase("Unpacking foo (1.1) over (1.0)") == "unpack"
+    assert package_phase("Preparing to configure foo") == "configure"
+    assert package_phase("Configuring foo") == "configure"
+    assert package_phase("Removing foo") == "remove"
+    assert package_phase("Running post-installation trigger man-db") == "triggers"
+    assert package_phase("Installed foo") is None
+
+
+def test_package_timings(mocker, tmp_path):
+    from pi_top_usb_setup import apt_status
+    from pi_top_usb_setup.apt_status import PackageTimings
+
+    monotonic = mocker.patch.object(apt_status, "monotonic")
+    timings = PackageTimings()
+
+    for now, package, phase in [
+        (0, "foo:arm64", "unpack"),
+        (2, "bar", "unpack"),
+        (3, "foo", "configure"),
+        (8, "foo", None),
+        (9, "bar", "configure"),
+    ]:
+        monotonic.return_value = now
+        timings.start(package, phase)
+
+    monotonic.return_value = 10
+    report = tmp_path / "report" / "timings.json"
+    timings.save(str(report))
+
+    assert timings.packages == {
+        "foo": {"unpack": 2, "configure": 5},
+        "bar": {"unpack": 1, "configure": 1},
+    }
+    assert timings.slowest(1) == [("foo", 7)]
+    assert json.loads(report.read_text()) == {
+        "total": 9,
+        "packages": [
+            {"package": "foo", "total": 7, "unpack": 2, "configure": 5},
+            {"package": "bar", "total": 2, "unpack": 1, "configure": 1},
+        ],
+    }
+
+
+def test_package_timings_are_merged_into_saved_ones(tmp_path):
+    from pi_top_usb_setup.apt_status import PackageTimings
+
+    report = tmp_path / "timings.json"
+    PackageTimings({"foo": {"unpack": 2.0}, "bar": {"unpack": 1.0}}).save(str(report))
+    # eg: the upgrade of pi-top-usb-setup alone, before the whole system
+    PackageTimings({"bar": {"unpack": 3.0}}).save(str(report))
+
+    assert PackageTimings.load(str(report)) == {
+        "foo": {"unpack": 2.0},
+        "bar": {"unpack": 3.0},
+    }
+    assert json.loads(report.read_text())["total"] == 5
+
+
+def test_timings_without_packages_are_not_saved(tmp_path):
+    from pi_top_usb_setup.apt_status import PackageTimings
+
+    PackageTimings().save(str(tmp_path / "timings.json"))
+
+    assert not (tmp_path / "timings.json").exists()
@@ -0,0 +1,198 @@
+import gzip
+import io
+import lzma
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from tests.test_extraction import FILES, assert_extracted, bgzf_compress, create_tar
+
+
+def test_detects_format_from_magic_bytes():
+    from pi_top_usb_setup.compression import CompressionFormat, detect_format
+
+    data = create_tar(FILES)
+    assert detect_format(io.BytesIO(gzip.compress(data))) == CompressionFormat.GZIP
+    assert detect_format(io.BytesIO(lzma.compress(data))) == CompressionFormat.XZ
+    assert (
+        detect_format(io.BytesIO(b"\x28\xb5\x2f\xfd" + data)) == CompressionFormat.ZSTD
+    )
+    assert (
+        detect_format(io.BytesIO(b"\x04\x22\x4d\x18" + data)) == CompressionFormat.LZ4
+    )
+
+
+def test_detect_format_fails_on_unknown_format():
+    from pi_top_usb_setup.compression import detect_format
+    from pi_top_usb_setup.exceptions import UnsupportedCompressionError
+
+    with pytest.raises(UnsupportedCompressionError):
+        detect_format(io.BytesIO(create_tar(FILES)))
+
+
+def test_extracted_size_of_gzip_file(tmp_path):
+    from pi_top_usb_setup.compression import get_extracted_size
+
+    data = create_tar(FILES)
+    bundle = tmp_path / "pi-top-usb-setup.tar.gz"
+    bundle.write_bytes(gzip.compress(data))
+
+    assert get_extracted_size(str(bundle)) == len(data)
+
+
+def test_extracted_size_of_bgzf_file(tmp_path):
+    from pi_top_usb_setup.compression import get_extracted_size
+
+    data = create_tar(FILES)
+    bundle = tmp_path / "pi-top-usb-setup.tar.gz"
+    # The last block is an empty end-of-file marker
+    bundle.write_bytes(bgzf_compress(data, block_size=4096))
+
+    assert get_extracted_size(str(bundle)) == len(data)
+
+
+def test_extracted_size_of_gzip_file_ending_in_empty_member(tmp_path):
+    from pi_top_usb_setup.compression import get_extracted_size
+
+    data = create_tar(FILES)
+    bundle = tmp_path / "pi-top-usb-setup.tar.gz"
+    bundle.write_bytes(gzip.compress(data) + gzip.compress(b""))
+
+    assert get_extracted_size(str(bundle)) == len(data)
+
+
+def test_extracted_size_of_multi_stream_xz_file(tmp_path):
+    from pi_top_usb_setup.compression import get_extracted_size
+
+    data = create_tar(FILES)
+    bundle = tmp_path / "pi-top-usb-setup.tar.xz"
+    # two streams, with stream padding between them
+    bundle.write_bytes(
+        lzma.compress(data[:3000]) + b"\0" * 8 + lzma.compress(data[3000:])
+    )
+
+    assert get_extracted_size(str(bundle)) == len(data)
+
+
+def test_extracts_xz_bundle(tmp_path):
+    from pi_top_usb_setup.extraction import ExtractionEngine
+
+    bundle = tmp_path / "pi-top-usb-setup.tar.xz"
+    bundle.write_bytes(lzma.compress(create_tar(FILES)))
+
+    ExtractionEngine().extract(str(bundle), str(tmp_path / "destination"))
+
+    assert_extracted(tmp_path / "destination")
+
+
+def test_extracts_zstd_bundle(tmp_path):
+    zstandard = pytest.importorskip("zstandard")
+    from pi_top_usb_setup.compression import get_extracted_size
+    from pi_top_usb_setup.extraction import ExtractionEngine
+
+    data = create_tar(FILES)
+    bundle = tmp_path / "pi-top-usb-setup.tar.zst"
+    bundle.write_bytes(zstandard.ZstdCompressor().compress(data))
+
+    assert get_extracted_size(str(bundle)) == len(data)
+    ExtractionEngine().extract(str(bundle), str(tmp_path / "destination"))
+    assert_extracted(tmp_path / "destination")
+
+
+def test_extracts_multi_frame_zstd_bundle_in_parallel(tmp_path):
+    zstandard = pytest.importorskip("zstandard")
+    from pi_top_usb_setup.compression import (
+        decompress_parallel,
+        detect_format,
+        get_extracted_size,
+    )
+
+    data = create_tar(FILES)
+    compressor = zstandard.ZstdCompressor()
+    bundle = tmp_path / "pi-top-usb-setup.tar.zst"
+    bundle.write_bytes(
+        b"".join(
+            compressor.compress(data[offset : offset + 4096])
+            for offset in range(0, len(data), 4096)
+        )
+    )
+    assert get_extracted_size(str(bundle)) == len(data)
+
+    output = []
+    with open(bundle, "rb") as f, ThreadPoolExecutor(4) as executor:
+        assert decompress_parallel(
+            f, detect_format(f), output.append, lambda _: None, executor, 8
+        )
+    assert b"".join(output) == data
+
+
+def test_extracts_lz4_bundle(tmp_path):
+    lz4_frame = pytest.importorskip("lz4.frame")
+    from pi_top_usb_setup.compression import get_extracted_size
+    from pi_top_usb_setup.extraction import ExtractionEngine
+
+    data = create_tar(FILES)
+    bundle = tmp_path / "pi-top-usb-setup.tar.lz4"
+    bundle.write_bytes(lz4_frame.compress(data, store_size=True))
+
+    assert get_extracted_size(str(bundle)) == len(data)
+    ExtractionEngine().extract(str(bundle), str(tmp_path / "destination"))
+    assert_extracted(tmp_path / "destination")
+
+
+def test_bgzf_is_decompressed_in_parallel():
+    from pi_top_usb_setup.compression import CompressionFormat, decompress_parallel
+
+    data = create_tar(FILES)
+    output = []
+    with ThreadPoolExecutor(4) as executor:
+        assert decompress_parallel(
+            io.BytesIO(bgzf_compress(data, block_size=4096)),
+            CompressionFormat.GZIP,
+            output.append,
+            lambda _: None,
+            executor,
+            8,
+        )
+    assert b"".join(output) == data
+
+
+def test_regular_gzip_is_not_bgzf():
+    from pi_top_usb_setup.compression import is_bgzf
+
+    bundle = io.BytesIO(gzip.compress(create_tar(FILES)))
+    assert not is_bgzf(bundle)
+    assert bundle.tell() == 0
+
+    assert is_bgzf(io.BytesIO(bgzf_compress(create_tar(FILES))))
+
+
+def test_xz_is_not_decompressed_in_parallel():
+    from pi_top_usb_setup.compression import CompressionFormat, decompress_parallel
+
+    with ThreadPoolExecutor(4) as executor:
+        assert not decompress_parallel(
+            io.BytesIO(lzma.compress(create_tar(FILES))),
+            CompressionFormat.XZ,
+            lambda _: None,
+            lambda _: None,
+            executor,
+            8,
+        )
+
+
+def test_finds_setup_files_in_every_format(tmp_path):
+    from pi_top_usb_setup.file_structure import MountPointStructure
+
+    for extension in ("tar.gz", "tar.zst", "tar.xz", "tar.lz4", "zip"):
+        (tmp_path / f"pi-top-usb-setup.{extension}").touch()
+
+    names = {
+        file.name for file in MountPointStructure(str(tmp_path)).find_setup_files()
+    }
+    assert names == {
+        "pi-top-usb-setup.tar.gz",
+        "pi-top-usb-setup.tar.zst",
+        "pi-top-usb-setup.tar.xz",
+        "pi-top-usb-setup.tar.lz4",
+    }
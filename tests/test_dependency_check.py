@@ -0,0 +1,124 @@
+import pytest
+
+PACKAGES_INDEX = """Package: foo
+Version: 1.1
+Depends: libfoo (>= 1.1), libc6 (>= 2.31)
+Recommends: missing-recommendation
+
+Package: libfoo
+Version: 1.1
+Pre-Depends: libnew | libother
+Depends: mail-transport-agent, libabi (= 2)
+
+Package: libnew
+Version: 0.1
+
+Package: postfix
+Version: 3.0
+Provides: mail-transport-agent, libabi (= 2)
+
+Package: bar
+Version: 2.0
+Depends: libbar (>= 2.0)
+"""
+
+INSTALLED = {"foo": "1.0", "libfoo": "1.0", "libc6": "2.36", "bar": "1.0"}
+
+
+def test_unmet_dependencies_are_reported():
+    from pi_top_usb_setup.dependency_check import check_dependencies
+
+    unmet = check_dependencies(PACKAGES_INDEX, INSTALLED)
+
+    assert [str(dependency) for dependency in unmet] == [
+        "bar 2.0 depends on libbar (>= 2.0)"
+    ]
+
+
+def test_dependencies_met_by_installed_packages():
+    from pi_top_usb_setup.dependency_check import check_dependencies
+
+    installed = dict(INSTALLED, libbar="2.1")
+
+    assert check_dependencies(PACKAGES_INDEX, installed) == []
+    # Virtual packages can be provided by installed packages too
+    index = PACKAGES_INDEX.replace("Provides: mail-transport-agent, ", "Provides: ")
+    assert (
+        check_dependencies(index, installed, {"mail-transport-agent": {"exim4"}}) == []
+    )
+    assert len(check_dependencies(index, installed)) == 1
+
+
+def test_installed_version_that_is_too_old_is_unmet():
+    from pi_top_usb_setup.dependency_check import check_dependencies
+
+    installed = dict(INSTALLED, libbar="1.9")
+    index = PACKAGES_INDEX.replace(
+        "Version: 1.1\nPre-Depends", "Version: 1.0\nPre-Depends"
+    )
+
+    unmet = check_dependencies(index, installed)
+
+    assert [str(dependency) for dependency in unmet] == [
+        "foo 1.1 depends on libfoo (>= 1.1)",
+        "bar 2.0 depends on libbar (>= 2.0)",
+    ]
+
+
+def test_large_repository():
+    from pi_top_usb_setup.dependency_check import check_dependencies
+
+    count = 5000
+    index = "\n\n".join(
+        f"Package: pkg{i}\nVersion: 2.0\nDepends: pkg{i + 1} (>= 2.0) | other, libc6"
+        for i in range(count)
+    )
+    installed = {f"pkg{i}": "1.0" for i in range(0, count, 2)}
+    installed["libc6"] = "2.36"
+
+    unmet = check_dependencies(index, installed)
+
+    assert [str(dependency) for dependency in unmet] == [
+        f"pkg{count - 1} 2.0 depends on pkg{count} (>= 2.0) | other"
+    ]
+
+
+def test_packages_that_need_unmet_dependencies_are_held_back():
+    from pi_top_usb_setup.dependency_check import resolve_dependencies
+
+    index = PACKAGES_INDEX + (
+        "\nPackage: baz\nVersion: 2.0\nDepends: bar (>= 2.0) | libbaz\n"
+        "\nPackage: qux\nVersion: 2.0\nDepends: bar\n"
+    )
+    installed = dict(INSTALLED, baz="1.0", qux="1.0")
+
+    report = resolve_dependencies(index, installed)
+
+    # Only the missing package is reported; the installed 'bar' still meets 'qux'
+    assert [str(dependency) for dependency in report.unmet] == [
+        "bar 2.0 depends on libbar (>= 2.0)"
+    ]
+    assert report.held_back == {"bar", "baz"}
+    assert report.essential == set()
+
+
+def test_verify_dependencies_holds_back_packages(mocker, tmp_path):
+    from pi_top_usb_setup import dpkg_status
+    from pi_top_usb_setup.dependency_check import verify_dependencies
+    from pi_top_usb_setup.exceptions import UnmetDependenciesError
+
+    status = tmp_path / "status"
+    status.write_text(
+        "Package: bar\nStatus: install ok installed\nVersion: 1.0\n\n"
+        "Package: libbar\nStatus: install ok installed\nVersion: 1.0\n"
+    )
+    mocker.patch.object(dpkg_status.status_index, "path", str(status))
+
+    assert verify_dependencies(PACKAGES_INDEX) == {"bar"}
+
+    # Unless the system can't do without them
+    index = PACKAGES_INDEX.replace(
+        "Package: bar\nVersion: 2.0\n", "Package: bar\nVersion: 2.0\nEssential: yes\n"
+    )
+    with pytest.raises(UnmetDependenciesError, match="libbar"):
+        verify_dependencies(index)
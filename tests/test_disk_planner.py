@@ -0,0 +1,150 @@
+import gzip
+
+import pytest
+
+from tests.test_extraction import create_tar
+
+PACKAGES_INDEX = """Package: foo
+Version: 1.1
+Installed-Size: 2000
+Depends: bar
+Filename: ./foo_1.1_arm64.deb
+
+Package: bar
+Version: 2.0
+Installed-Size: 300
+Filename: ./bar_2.0_all.deb
+
+Package: baz
+Version: 1.0
+Installed-Size: 100
+Filename: ./baz_1.0_all.deb
+"""
+
+INSTALLED_PACKAGES = {"foo": ("1.0", 1500 * 1024), "baz": ("1.0", 100 * 1024)}
+
+KB = 1024
+
+
+def test_plan_disk_usage(mocker):
+    from pi_top_usb_setup import disk_planner
+
+    mocker.patch.object(
+        disk_planner, "installed_packages", return_value=INSTALLED_PACKAGES
+    )
+    mocker.patch.object(disk_planner.status_index, "provides", return_value={})
+    mocker.patch("shutil.disk_usage", return_value=(0, 0, 10000 * KB))
+
+    plan = disk_planner.plan_disk_usage("/", 5000 * KB, PACKAGES_INDEX)
+
+    assert plan.extraction == 5000 * KB
+    assert plan.package_lists == len(PACKAGES_INDEX)
+    # foo grows 500KB, bar is a new dependency of it and baz is already installed
+    assert plan.installed_growth == 800 * KB
+    # foo is unpacked next to the files it replaces
+    assert plan.unpack_overhead == 2000 * KB
+    assert plan.peak_usage == 7800 * KB + len(PACKAGES_INDEX)
+    assert plan.fits
+
+
+def test_plan_reports_shortfall(mocker):
+    from pi_top_usb_setup.disk_planner import plan_disk_usage
+
+    mocker.patch("shutil.disk_usage", return_value=(0, 0, 1000 * KB))
+
+    installed = {package: ("0.1", 0) for package in ("foo", "bar", "baz")}
+    plan = plan_disk_usage("/", 500 * KB, PACKAGES_INDEX, installed=installed)
+
+    assert plan.peak_usage == 500 * KB + len(PACKAGES_INDEX) + 2400 * KB + 2000 * KB
+    assert plan.shortfall == plan.peak_usage - 1000 * KB + 1
+    assert not plan.fits
+    assert "missing" in str(plan)
+
+
+def test_plan_leaves_out_packages_that_arent_installed(mocker):
+    from pi_top_usb_setup.disk_planner import plan_disk_usage
+
+    mocker.patch("shutil.disk_usage", return_value=(0, 0, 10000 * KB))
+    # eg: the whole package list of the reference image
+    packages_index = PACKAGES_INDEX + (
+        "\nPackage: qux\nVersion: 1.0\nInstalled-Size: 900000\n"
+        "Filename: ./qux_1.0_all.deb\n"
+    )
+
+    plan = plan_disk_usage("/", 0, packages_index, installed=INSTALLED_PACKAGES)
+
+    assert plan.installed_growth == 800 * KB
+    assert plan.unpack_overhead == 2000 * KB
+    assert plan.fits
+
+
+def test_plan_without_index_only_counts_extraction(mocker):
+    from pi_top_usb_setup.disk_planner import plan_disk_usage
+
+    mocker.patch("shutil.disk_usage", return_value=(0, 0, 1000))
+
+    assert plan_disk_usage("/", 999).fits
+    assert not plan_disk_usage("/", 1000).fits
+
+
+def test_setup_that_doesnt_fit_is_refused_before_extracting(mocker, tmp_path):
+    mocker.patch(
+        "pi_top_usb_setup.file_structure.get_linux_distro", return_value="bullseye"
+    )
+    from pi_top_usb_setup import disk_planner
+    from pi_top_usb_setup.exceptions import NotEnoughSpaceException
+    from pi_top_usb_setup.file_structure import MountPointStructure
+    from pi_top_usb_setup.operations import MountPointOperations
+
+    mocker.patch.object(
+        disk_planner, "installed_packages", return_value=INSTALLED_PACKAGES
+    )
+    mocker.patch.object(disk_planner.status_index, "provides", return_value={})
+    mocker.patch(
+        "pi_top_usb_setup.operations.mount_point.same_filesystem", return_value=True
+    )
+    usb = tmp_path / "usb"
+    usb.mkdir()
+    files = {
+        "pi-top-usb-setup/updates/Packages": PACKAGES_INDEX,
+        "pi-top-usb-setup/updates/foo_1.1_arm64.deb": "a" * 100,
+    }
+    (usb / "pi-top-usb-setup.tar.gz").write_bytes(gzip.compress(create_tar(files)))
+    operations = MountPointOperations(MountPointStructure(str(usb)))
+    disk_usage = mocker.patch("shutil.disk_usage", return_value=(0, 0, 2000 * KB))
+
+    # Without a manifest, only the updates are planned
+    with pytest.raises(NotEnoughSpaceException, match="missing"):
+        operations.plan_disk_usage(tmp_path / "destination", install_updates=True)
+
+    [plan] = operations.plan_disk_usage(tmp_path / "destination")
+    assert plan.fits
+
+    disk_usage.return_value = (0, 0, 3000 * KB)
+    [plan] = operations.plan_disk_usage(tmp_path / "destination", install_updates=True)
+    assert plan.unpack_overhead == 2000 * KB
+
+
+def test_updates_are_planned_in_the_root_filesystem(mocker, tmp_path):
+    from pi_top_usb_setup.file_structure import MountPointStructure
+    from pi_top_usb_setup.operations import MountPointOperations
+
+    mocker.patch(
+        "pi_top_usb_setup.operations.mount_point.same_filesystem", return_value=False
+    )
+    mocker.patch("shutil.disk_usage", return_value=(0, 0, 10000 * KB))
+    usb = tmp_path / "usb"
+    (usb / "pi-top-usb-setup/updates").mkdir(parents=True)
+    (usb / "pi-top-usb-setup/updates/Packages").write_text(PACKAGES_INDEX)
+    operations = MountPointOperations(MountPointStructure(str(usb)))
+    operations.updates_in_place = usb / "pi-top-usb-setup/updates"
+    mocker.patch(
+        "pi_top_usb_setup.disk_planner.installed_packages",
+        return_value=INSTALLED_PACKAGES,
+    )
+    mocker.patch("pi_top_usb_setup.disk_planner.status_index.provides", return_value={})
+
+    plans = operations.plan_disk_usage(tmp_path / "destination", True)
+
+    assert [plan.drive for plan in plans] == [str(tmp_path), "/"]
+    assert plans[1].unpack_overhead == 2000 * KB
@@ -0,0 +1,104 @@
+import subprocess
+import sys
+from time import monotonic
+
+import pytest
+
+HOLD_LOCK = """
+import fcntl, sys, time
+file = open(sys.argv[1], "w")
+fcntl.lockf(file, fcntl.LOCK_EX)
+print("locked", flush=True)
+time.sleep(float(sys.argv[2]))
+"""
+
+
+@pytest.fixture
+def hold_lock(tmp_path):
+    processes = []
+
+    def hold(seconds):
+        path = tmp_path / "lock"
+        path.touch()
+        process = subprocess.Popen(
+            [sys.executable, "-c", HOLD_LOCK, str(path), str(seconds)],
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        processes.append(process)
+        assert process.stdout.readline() == "locked\n"
+        return str(path), process
+
+    yield hold
+    for process in processes:
+        process.kill()
+        process.wait()
+
+
+def test_lock_holder_is_found(hold_lock, tmp_path):
+    from pi_top_usb_setup.dpkg_lock import lock_holder
+
+    path, process = hold_lock(30)
+    free = tmp_path / "free"
+    free.touch()
+
+    holder = lock_holder(path)
+
+    assert holder is not None
+    assert holder.pid == process.pid
+    assert holder.command[0] == sys.executable
+    assert holder.name == "-c"
+    assert lock_holder(str(free)) is None
+    assert lock_holder(str(tmp_path / "missing")) is None
+
+
+def test_lock_holder_name():
+    from pi_top_usb_setup.dpkg_lock import LockHolder
+
+    assert (
+        LockHolder(
+            "/var/lib/dpkg/lock", 1, ["/usr/bin/python3", "/usr/bin/unattended-upgrade"]
+        ).name
+        == "unattended-upgrade"
+    )
+    assert LockHolder("/var/lib/dpkg/lock", 1, ["/usr/bin/dpkg", "-i"]).name == "dpkg"
+    assert LockHolder("/var/lib/dpkg/lock", 1).name == "process 1"
+
+
+def test_wait_for_lock_returns_when_holder_exits(hold_lock, mocker):
+    from pi_top_usb_setup import dpkg_lock
+
+    path, process = hold_lock(1)
+    on_wait = mocker.Mock()
+    start = monotonic()
+
+    dpkg_lock.wait_for_dpkg_lock(30, on_wait=on_wait, paths=[path])
+
+    # Woken up by the process exiting, not by the next check
+    assert monotonic() - start < dpkg_lock.RECHECK_INTERVAL
+    assert process.poll() is not None
+    assert on_wait.call_args_list[0].args[0].pid == process.pid
+    assert on_wait.call_args_list[-1].args == (None,)
+
+
+def test_wait_for_lock_times_out(hold_lock, mocker):
+    from pi_top_usb_setup import dpkg_lock
+    from pi_top_usb_setup.exceptions import DpkgLockTimeoutError
+
+    path, _ = hold_lock(30)
+    on_wait = mocker.Mock()
+
+    with pytest.raises(DpkgLockTimeoutError):
+        dpkg_lock.wait_for_dpkg_lock(0.5, on_wait=on_wait, paths=[path])
+    on_wait.assert_called_with(None)
+
+
+def test_wait_for_free_lock_returns_right_away(tmp_path, mocker):
+    from pi_top_usb_setup import dpkg_lock
+
+    on_wait = mocker.Mock()
+    (tmp_path / "lock").touch()
+
+    dpkg_lock.wait_for_dpkg_lock(0, on_wait=on_wait, paths=[str(tmp_path / "lock")])
+
+    on_wait.assert_not_called()
@@ -0,0 +1,88 @@
+import os
+
+STATUS = """Package: foo
+Status: install ok installed
+Priority: optional
+Installed-Size: 1500
+Architecture: arm64
+Version: 1.0
+Description: foo
+ Version: 9.9
+
+Package: foo
+Status: install ok installed
+Installed-Size: 1600
+Architecture: armhf
+Version: 1.0
+
+Package: held
+Status: hold ok installed
+Installed-Size: 10
+Provides: mail-transport-agent, libheld-abi (= 3)
+Version: 2:3.0
+
+Package: removed
+Status: deinstall ok config-files
+Installed-Size: 9000
+Version: 0.1
+
+Package: broken
+Status: install reinstreq half-installed
+Version: 0.2
+
+Package: unpacked
+Status: install ok unpacked
+Version: 0.3
+"""
+
+
+def test_parse_status_file():
+    from pi_top_usb_setup.dpkg_status import parse_status_file
+
+    assert parse_status_file(STATUS) == {
+        "foo": ("1.0", 1600 * 1024),
+        "held": ("2:3.0", 10 * 1024),
+    }
+
+
+def test_index_is_read_again_when_dpkg_changes_it(mocker, tmp_path):
+    from pi_top_usb_setup import dpkg_status
+    from pi_top_usb_setup.dpkg_status import DpkgStatusIndex
+
+    status = tmp_path / "status"
+    status.write_text(STATUS)
+    index = DpkgStatusIndex(str(status))
+    parse = mocker.spy(dpkg_status, "parse_status_file")
+
+    assert index.versions(["foo:arm64", "held", "missing"]) == {
+        "foo": "1.0",
+        "held": "2:3.0",
+    }
+    assert index.version("foo") == "1.0"
+    assert index.version("missing") is None
+    assert index.provides() == {
+        "mail-transport-agent": {"held"},
+        "libheld-abi": {"held"},
+    }
+    assert index.unconfigured() == {"unpacked"}
+    assert parse.call_count == 1
+
+    # dpkg replaces the file
+    new_status = tmp_path / "status.new"
+    new_status.write_text(STATUS.replace("Version: 1.0", "Version: 1.1"))
+    os.replace(new_status, status)
+
+    assert index.versions()["foo"] == "1.1"
+    assert parse.call_count == 2
+
+
+def test_get_package_version_reads_dpkg_database(mocker, tmp_path):
+    from pi_top_usb_setup import dpkg_status
+    from pi_top_usb_setup.utils import get_package_version
+
+    status = tmp_path / "status"
+    status.write_text(STATUS)
+    mocker.patch.object(dpkg_status.status_index, "path", str(status))
+
+    assert get_package_version("held") == "2:3.0"
+    assert get_package_version("removed") == ""
@@ -0,0 +1,418 @@
+import gzip
+import io
+import os
+import struct
+import tarfile
+import zlib
+from unittest.mock import Mock, patch
+
+import pytest
+
+
+def create_tar(files: dict) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for name, content in files.items():
+            data = content.encode() if isinstance(content, str) else content
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def bgzf_compress(data: bytes, block_size: int = 65280) -> bytes:
+    blocks = []
+    for offset in range(0, len(data), block_size):
+        content = data[offset : offset + block_size]
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflated = compressor.compress(content) + compressor.flush()
+        header = struct.pack(
+            "<BBBBIBBHBBHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(deflated) + 25
+        )
+        blocks.append(
+            header
+            + deflated
+            + struct.pack("<II", zlib.crc32(content), len(content) & 0xFFFFFFFF)
+        )
+    # BGZF end-of-file marker
+    blocks.append(
+        bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+    )
+    return b"".join(blocks)
+
+
+FILES = {
+    "pi-top-usb-setup/pi-top_config.json": "{}",
+    "pi-top-usb-setup/updates/Packages": "Package: foo",
+    "pi-top-usb-setup/updates/foo.deb": bytes(range(256)) * 2048,
+}
+
+
+def assert_extracted(destination, files=FILES):
+    for name, content in files.items():
+        data = content.encode() if isinstance(content, str) else content
+        assert (destination / name).read_bytes() == data
+
+
+def test_extracts_gzip_bundle(tmp_path):
+    from pi_top_usb_setup.extraction import ExtractionEngine
+
+    bundle = tmp_path / "pi-top-usb-setup.tar.gz"
+    bundle.write_bytes(gzip.compress(create_tar(FILES)))
+
+    ExtractionEngine().extract(str(bundle), str(tmp_path / "destination"))
+
+    assert_extracted(tmp_path / "destination")
+
+
+def test_extracts_multi_member_gzip_bundle(tmp_path):
+    from pi_top_usb_setup.extraction import ExtractionEngine
+
+    tar = create_tar(FILES)
+    bundle = tmp_path / "pi-top-usb-setup.tar.gz"
+    bundle.write_bytes(gzip.compress(tar[:5000]) + gzip.compress(tar[5000:]))
+
+    ExtractionEngine().extract(str(bundle), str(tmp_path / "destination"))
+
+    assert_extracted(tmp_path / "destination")
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_extracts_bundle_with_zero_padding(tmp_path, workers):
+    from pi_top_usb_setup.compression import get_extracted_size
+    from pi_top_usb_setup.extraction import ExtractionEngine
+
+    tar = create_tar(FILES)
+    for compressed in (
+        gzip.compress(tar[:5000]) + b"\0" * 10 + gzip.compress(tar[5000:]),
+        bgzf_compress(tar, block_size=4096),
+    ):
+        # eg: written to a block device
+        bundle = tmp_path / "pi-top-usb-setup.tar.gz"
+        bundle.write_bytes(compressed + b"\0" * 512)
+        destination = tmp_path / "destination"
+
+        ExtractionEngine(workers=workers).extract(str(bundle), str(destination))
+
+        assert_extracted(destination)
+        assert get_extracted_size(str(bundle)) == len(tar)
+
+
+def test_extracts_bgzf_bundle_in_parallel(tmp_path):
+    from pi_top_usb_setup import compression
+    from pi_top_usb_setup.extraction import ExtractionEngine
+
+    bundle = tmp_path / "pi-top-usb-setup.tar.gz"
+    bundle.write_bytes(bgzf_compress(create_tar(FILES), block_size=4096))
+
+    with patch.object(
+        compression, "inflate_bgzf", wraps=compression.inflate_bgzf
+    ) as inflate_bgzf_mock:
+        ExtractionEngine(workers=4).extract(str(bundle), str(tmp_path / "destination"))
+        inflate_bgzf_mock.assert_called_once()
+
+    assert_extracted(tmp_path / "destination")
+
+
+def test_corrupt_bundle_raises_exception(tmp_path):
+    from pi_top_usb_setup.extraction import ExtractionEngine
+
+    compressed = bytearray(bgzf_compress(create_tar(FILES), block_size=4096))
+    compressed[100] ^= 0xFF
+    bundle = tmp_path / "pi-top-usb-setup.tar.gz"
+    bundle.write_bytes(bytes(compressed))
+
+    with pytest.raises(Exception):
+        ExtractionEngine(workers=2).extract(str(bundle), str(tmp_path / "destination"))
+
+
+def test_error_while_writing_stops_decompression(tmp_path):
+    from pi_top_usb_setup.extraction import ExtractionEngine
+
+    bundle = tmp_path / "pi-top-usb-setup.tar.gz"
+    bundle.write_bytes(gzip.compress(create_tar(FILES)))
+
+    with patch.object(tarfile.TarFile, "extract", side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            ExtractionEngine(max_buffered_chunks=1).extract(
+                str(bundle), str(tmp_path / "destination")
+            )
+
+
+def test_reports_progress(tmp_path):
+    from pi_top_usb_setup.extraction import ExtractionEngine
+
+    bundle = tmp_path / "pi-top-usb-setup.tar.gz"
+    bundle.write_bytes(bgzf_compress(create_tar(FILES), block_size=4096))
+
+    on_progress = Mock()
+    ExtractionEngine().extract(
+        str(bundle), str(tmp_path / "destination"), on_progress=on_progress
+    )
+
+    progress = [c.args[0] for c in on_progress.call_args_list]
+    assert progress == sorted(progress)
+    assert progress[-1] == 100.0
+
+
+def test_skip_folders_filter():
+    from pi_top_usb_setup.extraction import skip_folders
+
+    member_filter = skip_folders(["pi-top-usb-setup/updates"])
+
+    assert not member_filter(tarfile.TarInfo("pi-top-usb-setup/updates"))
+    assert not member_filter(tarfile.TarInfo("pi-top-usb-setup/updates/foo.deb"))
+    assert not member_filter(tarfile.TarInfo("./pi-top-usb-setup/updates/foo.deb"))
+    assert member_filter(tarfile.TarInfo("pi-top-usb-setup/updates_bookworm/foo.deb"))
+    assert member_filter(tarfile.TarInfo("pi-top-usb-setup/pi-top_config.json"))
+
+
+def test_tracker_waits_for_extracted_files(tmp_path):
+    from threading import Thread
+
+    from pi_top_usb_setup.extraction import ExtractionEngine, ExtractionTracker
+
+    bundle = tmp_path / "pi-top-usb-setup.tar.gz"
+    bundle.write_bytes(gzip.compress(create_tar(FILES)))
+    destination = tmp_path / "destination"
+    tracker = ExtractionTracker(destination)
+
+    def extract():
+        ExtractionEngine().extract(
+            str(bundle),
+            str(destination),
+            on_member_extracted=tracker.member_extracted,
+        )
+        tracker.finish()
+
+    Thread(target=extract).start()
+
+    deb = destination / "pi-top-usb-setup/updates/foo.deb"
+    assert tracker.wait_for(deb)
+    assert tracker.is_extracted(deb)
+    assert deb.read_bytes() == FILES["pi-top-usb-setup/updates/foo.deb"]
+    assert not tracker.wait_for(destination / "pi-top-usb-setup/updates/bar.deb")
+    assert not tracker.is_extracted(destination / "pi-top-usb-setup/updates/bar.deb")
+    assert tracker.finished
+
+
+def test_tracker_raises_if_extraction_failed(tmp_path):
+    from pi_top_usb_setup.extraction import ExtractionTracker
+
+    tracker = ExtractionTracker(tmp_path)
+    tracker.finish(OSError("disk full"))
+
+    with pytest.raises(Exception):
+        tracker.wait_for(tmp_path / "pi-top-usb-setup/updates/Packages")
+
+
+def test_progress_is_reported_while_writing_big_members(tmp_path, mocker):
+    mocker.patch("pi_top_usb_setup.progress.ProgressMeter.REPORT_INTERVAL", 0)
+    from pi_top_usb_setup.extraction import ExtractionEngine
+
+    files = {"pi-top-usb-setup/updates/big.deb": bytes(2 * 1024 * 1024)}
+    bundle = tmp_path / "pi-top-usb-setup.tar.gz"
+    bundle.write_bytes(gzip.compress(create_tar(files)))
+
+    on_stats = Mock()
+    ExtractionEngine().extract(
+        str(bundle),
+        str(tmp_path / "destination"),
+        total_size=len(files["pi-top-usb-setup/updates/big.deb"]),
+        on_stats=on_stats,
+    )
+
+    # A single member moves the progress gradually
+    progress = [c.args[0].percentage for c in on_stats.call_args_list]
+    assert len([p for p in progress if 0 < p < 100]) > 10
+    assert progress == sorted(progress)
+    assert on_stats.call_args.args[0].bytes_done == 2 * 1024 * 1024
+
+
+RESUMABLE_FILES = {
+    f"pi-top-usb-setup/updates/package{i}.deb": bytes([i]) * 20000 for i in range(10)
+}
+
+
+def interrupt_extraction(engine, bundle, destination, checkpoint_file, after):
+    extracted = []
+    original_extract = tarfile.TarFile.extract
+
+    def extract(tar, member, path):
+        if len(extracted) == after:
+            raise OSError("power loss")
+        original_extract(tar, member=member, path=path)
+        extracted.append(member.name)
+
+    with patch.object(tarfile.TarFile, "extract", extract):
+        with pytest.raises(OSError):
+            engine.extract(
+                str(bundle), str(destination), checkpoint_file=checkpoint_file
+            )
+
+
+def test_interrupted_extraction_is_resumed(tmp_path, mocker):
+    mocker.patch("pi_top_usb_setup.extraction.CHECKPOINT_INTERVAL", 0)
+    from pi_top_usb_setup.extraction import ExtractionCheckpoint, ExtractionEngine
+
+    bundle = tmp_path / "pi-top-usb-setup.tar.gz"
+    bundle.write_bytes(bgzf_compress(create_tar(RESUMABLE_FILES), block_size=8192))
+    destination = tmp_path / "destination"
+    checkpoint_file = str(tmp_path / "checkpoint.json")
+    engine = ExtractionEngine(workers=2)
+
+    interrupt_extraction(engine, bundle, destination, checkpoint_file, after=6)
+    checkpoint = ExtractionCheckpoint.load(checkpoint_file)
+    assert checkpoint.offset > 0
+    assert len(checkpoint.members) == 6
+
+    # Only the missing members are written, decompressing from the restart point
+    decompress = mocker.spy(engine, "_decompress")
+    with patch.object(
+        tarfile.TarFile, "extract", autospec=True, side_effect=tarfile.TarFile.extract
+    ) as extract:
+        engine.extract(str(bundle), str(destination), checkpoint_file=checkpoint_file)
+    assert extract.call_count == 4
+    assert decompress.call_args.args[2] == checkpoint.offset
+
+    assert_extracted(destination, RESUMABLE_FILES)
+    assert ExtractionCheckpoint.load(checkpoint_file).complete
+
+
+def test_checkpoints_only_flush_extracted_files(tmp_path, mocker):
+    mocker.patch("pi_top_usb_setup.extraction.CHECKPOINT_INTERVAL", 0)
+    from pi_top_usb_setup import extraction
+
+    bundle = tmp_path / "pi-top-usb-setup.tar.gz"
+    bundle.write_bytes(bgzf_compress(create_tar(RESUMABLE_FILES), block_size=8192))
+    destination = tmp_path / "destination"
+    sync = mocker.patch("pi_top_usb_setup.extraction.os.sync")
+    fsync = mocker.patch(
+        "pi_top_usb_setup.extraction._fsync", side_effect=extraction._fsync
+    )
+
+    extraction.ExtractionEngine(workers=2).extract(
+        str(bundle), str(destination), checkpoint_file=str(tmp_path / "checkpoint")
+    )
+
+    # Writes of other processes are not flushed with them
+    sync.assert_not_called()
+    synced = [c.args[0] for c in fsync.call_args_list]
+    for name in RESUMABLE_FILES:
+        assert synced.count(str(destination / name)) == 1
+    assert str(destination / "pi-top-usb-setup/updates") in synced
+
+
+def test_resumed_extraction_rewrites_files_that_dont_match(tmp_path, mocker):
+    mocker.patch("pi_top_usb_setup.extraction.CHECKPOINT_INTERVAL", 0)
+    from pi_top_usb_setup.extraction import ExtractionEngine
+
+    bundle = tmp_path / "pi-top-usb-setup.tar.gz"
+    bundle.write_bytes(gzip.compress(create_tar(RESUMABLE_FILES)))
+    destination = tmp_path / "destination"
+    checkpoint_file = str(tmp_path / "checkpoint.json")
+    engine = ExtractionEngine(workers=1)
+
+    interrupt_extraction(engine, bundle, destination, checkpoint_file, after=6)
+    (destination / "pi-top-usb-setup/updates/package2.deb").write_bytes(b"truncated")
+
+    on_member_extracted = Mock()
+    engine.extract(
+        str(bundle),
+        str(destination),
+        checkpoint_file=checkpoint_file,
+        on_member_extracted=on_member_extracted,
+    )
+
+    assert_extracted(destination, RESUMABLE_FILES)
+    # Every member is reported, including the ones extracted before the interruption
+    assert on_member_extracted.call_count == len(RESUMABLE_FILES)
+
+
+def test_extraction_replaces_linked_files(tmp_path):
+    from pi_top_usb_setup.extraction import ExtractionEngine
+
+    bundle = tmp_path / "pi-top-usb-setup.tar.gz"
+    bundle.write_bytes(gzip.compress(create_tar(FILES)))
+    package = tmp_path / "destination/pi-top-usb-setup/updates/foo.deb"
+    package.parent.mkdir(parents=True)
+    package.write_bytes(b"cached")
+    os.link(package, tmp_path / "cached.deb")
+
+    ExtractionEngine().extract(str(bundle), str(tmp_path / "destination"))
+
+    assert_extracted(tmp_path / "destination")
+    assert (tmp_path / "cached.deb").read_bytes() == b"cached"
+
+
+def sha256(content) -> str:
+    import hashlib
+
+    data = content.encode() if isinstance(content, str) else content
+    return hashlib.sha256(data).hexdigest()
+
+
+def test_members_are_verified_while_extracting(tmp_path):
+    from pi_top_usb_setup.extraction import ExtractionEngine
+
+    bundle = tmp_path / "pi-top-usb-setup.tar.gz"
+    bundle.write_bytes(gzip.compress(create_tar(FILES)))
+    hashes = {name: sha256(content) for name, content in FILES.items()}
+
+    on_member_extracted = Mock()
+    ExtractionEngine().extract(
+        str(bundle),
+        str(tmp_path / "destination"),
+        on_member_extracted=on_member_extracted,
+        hashes=hashes,
+    )
+
+    assert_extracted(tmp_path / "destination")
+    assert on_member_extracted.call_count == len(FILES)
+
+
+def test_member_that_doesnt_match_its_hash_stops_extraction(tmp_path):
+    from pi_top_usb_setup.exceptions import ChecksumMismatchError
+    from pi_top_usb_setup.extraction import ExtractionEngine
+
+    bundle = tmp_path / "pi-top-usb-setup.tar.gz"
+    bundle.write_bytes(gzip.compress(create_tar(FILES)))
+    hashes = {name: sha256(content) for name, content in FILES.items()}
+    hashes["pi-top-usb-setup/updates/foo.deb"] = sha256("something else")
+
+    on_member_extracted = Mock()
+    with pytest.raises(ChecksumMismatchError, match="foo.deb"):
+        ExtractionEngine().extract(
+            str(bundle),
+            str(tmp_path / "destination"),
+            on_member_extracted=on_member_extracted,
+            hashes=hashes,
+        )
+
+    assert not (tmp_path / "destination/pi-top-usb-setup/updates/foo.deb").exists()
+    reported = [c.args[0].name for c in on_member_extracted.call_args_list]
+    assert "pi-top-usb-setup/updates/foo.deb" not in reported
+
+
+@pytest.mark.parametrize("valid", [True, False])
+def test_packages_are_verified_against_their_index(tmp_path, valid):
+    from pi_top_usb_setup.exceptions import ChecksumMismatchError
+    from pi_top_usb_setup.extraction import ExtractionEngine
+
+    deb = FILES["pi-top-usb-setup/updates/foo.deb"]
+    files = dict(FILES)
+    files["pi-top-usb-setup/updates/Packages"] = (
+        "Package: foo\n"
+        "Filename: ./foo.deb\n"
+        f"SHA256: {sha256(deb if valid else b'corrupt')}\n"
+    )
+    bundle = tmp_path / "pi-top-usb-setup.tar.gz"
+    bundle.write_bytes(bgzf_compress(create_tar(files), block_size=8192))
+
+    extract = ExtractionEngine(workers=2).extract
+    if valid:
+        extract(str(bundle), str(tmp_path / "destination"), hashes={})
+        assert_extracted(tmp_path / "destination", files)
+    else:
+        with pytest.raises(ChecksumMismatchError):
+            extract(str(bundle), str(tmp_path / "destination"), hashes={})
@@ -0,0 +1,26 @@
+def test_benchmark_reinstalls_installed_packages(mocker, tmp_path):
+    from pi_top_usb_setup import install_benchmark
+    from pi_top_usb_setup.system_updater import SystemUpdater
+
+    (tmp_path / "Packages").write_text(
+        "Package: foo\nVersion: 1.0\n\nPackage: bar\nVersion: 2.0\n\n"
+        "Package: baz\nVersion: 1.0\n"
+    )
+    mocker.patch.object(
+        install_benchmark,
+        "installed_versions",
+        return_value={"foo": "1.0", "bar": "1.0", "baz": "1.0"},
+    )
+    mocker.patch.object(install_benchmark.os, "sync")
+    mocker.patch.object(SystemUpdater, "update")
+    reinstall = mocker.patch.object(SystemUpdater, "reinstall")
+
+    packages = install_benchmark.benchmark_packages(str(tmp_path))
+    durations = install_benchmark.run_benchmark(str(tmp_path), packages, rounds=2)
+
+    assert packages == ["baz=1.0", "foo=1.0"]
+    assert reinstall.call_count == 4
+    assert {name: len(times) for name, times in durations.items()} == {
+        "default": 2,
+        "provisioning": 2,
+    }
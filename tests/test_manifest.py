@@ -0,0 +1,136 @@
+import gzip
+import json
+import lzma
+
+import pytest
+
+from tests.test_extraction import create_tar
+
+FILES = {
+    "pi-top-usb-setup/pi-top_config.json": "{}",
+    "pi-top-usb-setup/updates/Packages": "a" * 100,
+    "pi-top-usb-setup/updates/foo.deb": "a" * 1000,
+    "pi-top-usb-setup/updates_bookworm/Packages": "a" * 200,
+    "pi-top-usb-setup/updates_bookworm/foo.deb": "a" * 2000,
+}
+
+
+@pytest.fixture
+def setup_folder(tmp_path):
+    for name, content in FILES.items():
+        path = tmp_path / "bundle" / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+    yield tmp_path / "bundle"
+
+
+def bundle_with_manifest(directory, compress=gzip.compress) -> bytes:
+    from pi_top_usb_setup.manifest import MANIFEST_FILENAME, BundleManifest
+
+    manifest = BundleManifest.create(str(directory))
+    files = {MANIFEST_FILENAME: json.dumps(manifest.to_dict())}
+    files.update(FILES)
+    return compress(create_tar(files))
+
+
+def test_create_manifest(setup_folder):
+    from pi_top_usb_setup.manifest import BundleManifest
+
+    manifest = BundleManifest.create(str(setup_folder))
+
+    assert manifest.members == {name: len(content) for name, content in FILES.items()}
+    assert manifest.total_size == 3302
+    assert manifest.folder_sizes == {
+        "pi-top-usb-setup/updates": 1100,
+        "pi-top-usb-setup/updates_bookworm": 2200,
+    }
+    # setup folder, 2 update folders and 5 files
+    assert manifest.member_count == 8
+    assert manifest.extracted_size(["pi-top-usb-setup/updates"]) == 2202
+    assert manifest.hashes["pi-top-usb-setup/pi-top_config.json"] == (
+        "44136fa355b3678a1146ad16f7e8649e94fb4fc21fe77e8310c060f61caaff8a"
+    )
+    assert manifest.hashes.keys() == FILES.keys()
+
+
+def test_manifest_to_dict_and_back(setup_folder):
+    from pi_top_usb_setup.manifest import BundleManifest
+
+    manifest = BundleManifest.create(str(setup_folder))
+    assert (
+        BundleManifest.from_dict(json.loads(json.dumps(manifest.to_dict()))) == manifest
+    )
+
+
+@pytest.mark.parametrize("compress", [gzip.compress, lzma.compress])
+def test_read_manifest_from_bundle(tmp_path, setup_folder, compress):
+    from pi_top_usb_setup.manifest import BundleManifest, read_manifest
+
+    bundle = tmp_path / "pi-top-usb-setup.tar"
+    bundle.write_bytes(bundle_with_manifest(setup_folder, compress))
+
+    assert read_manifest(str(bundle)) == BundleManifest.create(str(setup_folder))
+
+
+def test_read_manifest_from_bundle_without_manifest(tmp_path):
+    from pi_top_usb_setup.manifest import read_manifest
+
+    bundle = tmp_path / "pi-top-usb-setup.tar.gz"
+    bundle.write_bytes(gzip.compress(create_tar(FILES)))
+
+    assert read_manifest(str(bundle)) is None
+
+
+def test_extract_setup_file_uses_manifest_for_space_check(
+    mocker, tmp_path, setup_folder
+):
+    mocker.patch(
+        "pi_top_usb_setup.file_structure.get_linux_distro", return_value="bookworm"
+    )
+    from pi_top_usb_setup.exceptions import NotEnoughSpaceException
+    from pi_top_usb_setup.file_structure import MountPointStructure
+    from pi_top_usb_setup.operations import MountPointOperations
+
+    usb = tmp_path / "usb"
+    usb.mkdir()
+    (usb / "pi-top-usb-setup.tar.gz").write_bytes(bundle_with_manifest(setup_folder))
+    operations = MountPointOperations(MountPointStructure(str(usb)))
+    disk_usage = mocker.patch("shutil.disk_usage")
+    extract = mocker.spy(operations.extraction_engine, "extract")
+
+    # Only the bookworm updates and the config file are counted
+    disk_usage.return_value = (0, 0, 2202)
+    with pytest.raises(NotEnoughSpaceException):
+        operations.extract_setup_file(tmp_path / "destination")
+    extract.assert_not_called()
+
+    disk_usage.return_value = (0, 0, 2203)
+    on_progress = mocker.Mock()
+    operations.extract_setup_file(tmp_path / "destination", on_progress=on_progress)
+    # Progress is measured over the whole bundle, since skipped members are read too
+    assert extract.call_args.kwargs["total_size"] == 3302
+    on_progress.assert_called_with(100.0)
+    assert not (tmp_path / "destination" / "pi-top-usb-setup-manifest.json").exists()
+
+
+def test_release_files_are_read_from_manifest(mocker, tmp_path, setup_folder):
+    mocker.patch(
+        "pi_top_usb_setup.file_structure.get_linux_distro", return_value="bookworm"
+    )
+    from pi_top_usb_setup.file_structure import MountPointStructure
+    from pi_top_usb_setup.operations import MountPointOperations
+
+    (setup_folder / "pi-top-usb-setup/updates_bookworm/InRelease").write_text("a")
+    usb = tmp_path / "usb"
+    usb.mkdir()
+    (usb / "pi-top-usb-setup.tar.gz").write_bytes(bundle_with_manifest(setup_folder))
+    operations = MountPointOperations(MountPointStructure(str(usb)))
+
+    # 'Release' isn't in the bundle, so it isn't waited for
+    assert operations.release_files(tmp_path / "destination") == ["InRelease"]
+
+    (usb / "pi-top-usb-setup.tar.gz").write_bytes(
+        gzip.compress(create_tar({"pi-top-usb-setup/pi-top_config.json": "{}"}))
+    )
+    operations = MountPointOperations(MountPointStructure(str(usb)))
+    assert operations.release_files(tmp_path / "destination") == ["Release"]
@@ -1,5 +1,6 @@
 import pathlib
 import shutil
+import tarfile
 import tempfile
 from typing import Optional
 from unittest.mock import MagicMock, Mock, call, patch
@@ -121,36 +122,36 @@ def test_copy_files_creates_file_structure_in_target(
     )
 
 
-def test_copy_files_calls_progress_callback(mock_copy2, mock_makedirs, operations):
-    # Test that progress callback is called
+def test_copy_files_calls_progress_callback(
+    mocker, mock_copy2, mock_makedirs, operations
+):
+    # Test that progress callback is called with the percentage of data copied
+    mocker.patch("pi_top_usb_setup.progress.ProgressMeter.REPORT_INTERVAL", 0)
     structure = {
         "pi-top-usb-setup.tar.gz": "",
         "pi-top-usb-setup": {
             "files": {
                 "tmp": {
                     "some_folder": {
-                        "file.txt": "Hello, world!",
-                        "other_folder": {
-                            "file2.txt": "Hello, world!",
-                        },
+                        "file.txt": "a" * 600,
                     },
-                    "file3.txt": "bla",
-                    "file4.txt": "bla",
+                    "file2.txt": "b" * 200,
                 },
             },
         },
     }
     progress_callback = Mock()
+    stats_callback = Mock()
     app = operations(structure)
-    app.copy_files(on_progress=progress_callback)
+    app.copy_files(on_progress=progress_callback, on_stats=stats_callback)
     progress_callback.assert_has_calls(
         [
             call(25.0),
-            call(50.0),
-            call(75.0),
             call(100.0),
         ]
     )
+    stats = stats_callback.call_args.args[0]
+    assert stats.bytes_done == stats.total_bytes == 800
 
 
 def test_copy_files_on_files_folder_without_files(mock_copy2, operations):
@@ -424,3 +425,383 @@ def test_install_certificates_when_valid_folder_is_found(
     )
     # The associated command is run
     mock_run_command.assert_called_once_with("update-ca-certificates", timeout=60)
+
+
+@pytest.fixture
+def bundle(tmp_path):
+    from tests.test_extraction import create_tar
+
+    def _create_bundle(files: dict) -> pathlib.Path:
+        import gzip
+
+        path = tmp_path / "usb" / "pi-top-usb-setup.tar.gz"
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(gzip.compress(create_tar(files)))
+        return path
+
+    yield _create_bundle
+
+
+@pytest.mark.parametrize(
+    "distro,extracted_folder,skipped_folder",
+    [
+        ("bookworm", "updates_bookworm", "updates"),
+        ("bullseye", "updates", "updates_bookworm"),
+    ],
+)
+def test_extract_setup_file_skips_updates_for_other_distros(
+    mocker, bundle, tmp_path, distro, extracted_folder, skipped_folder
+):
+    mocker.patch(
+        "pi_top_usb_setup.file_structure.get_linux_distro", return_value=distro
+    )
+    from pi_top_usb_setup.file_structure import MountPointStructure
+    from pi_top_usb_setup.operations import MountPointOperations
+
+    bundle_path = bundle(
+        {
+            "pi-top-usb-setup/pi-top_config.json": "{}",
+            "pi-top-usb-setup/updates/Packages": "bullseye",
+            "pi-top-usb-setup/updates_bookworm/Packages": "bookworm",
+        }
+    )
+    destination = tmp_path / "destination"
+    MountPointOperations(
+        MountPointStructure(str(bundle_path.parent))
+    ).extract_setup_file(destination)
+
+    assert (destination / "pi-top-usb-setup/pi-top_config.json").exists()
+    assert (destination / "pi-top-usb-setup" / extracted_folder / "Packages").exists()
+    assert not (destination / "pi-top-usb-setup" / skipped_folder).exists()
+
+
+def test_extract_setup_file_checks_free_space_while_extracting(
+    mocker, bundle, tmp_path
+):
+    mocker.patch(
+        "pi_top_usb_setup.file_structure.get_linux_distro", return_value="bookworm"
+    )
+    from pi_top_usb_setup.exceptions import NotEnoughSpaceException
+    from pi_top_usb_setup.file_structure import MountPointStructure
+    from pi_top_usb_setup.operations import MountPointOperations
+
+    bundle_path = bundle(
+        {
+            "pi-top-usb-setup/updates/big.deb": "a" * 1000,
+            "pi-top-usb-setup/updates_bookworm/small.deb": "a" * 10,
+        }
+    )
+    operations = MountPointOperations(MountPointStructure(str(bundle_path.parent)))
+    destination = tmp_path / "destination"
+
+    # The whole bundle doesn't fit, but the bookworm updates do
+    disk_usage = mocker.patch(
+        "pi_top_usb_setup.operations.mount_point.shutil.disk_usage",
+        return_value=(0, 0, 100),
+    )
+    operations.extract_setup_file(destination)
+    assert (destination / "pi-top-usb-setup/updates_bookworm/small.deb").exists()
+
+    # Not even the bookworm updates fit
+    disk_usage.return_value = (0, 0, 5)
+    with pytest.raises(NotEnoughSpaceException):
+        operations.extract_setup_file(tmp_path / "other-destination")
+
+
+def test_setup_image_is_mounted_instead_of_extracted(mocker, tmp_path):
+    run_command = mocker.patch("pi_top_usb_setup.utils.run_command")
+    from pi_top_usb_setup.file_structure import MountPointStructure
+    from pi_top_usb_setup.operations import MountPointOperations
+
+    usb = tmp_path / "usb"
+    usb.mkdir()
+    (usb / "pi-top-usb-setup.squashfs").touch()
+    extraction_engine = Mock()
+    operations = MountPointOperations(
+        MountPointStructure(str(usb)), extraction_engine=extraction_engine
+    )
+    mocker.patch.object(MountPointOperations, "usb_drive_is_present", new=True)
+    umount_usb_drive = mocker.patch(
+        "pi_top_usb_setup.operations.mount_point.umount_usb_drive"
+    )
+
+    destination = tmp_path / "destination"
+    operations.extract_setup_file(destination)
+
+    extraction_engine.extract.assert_not_called()
+    run_command.assert_called_once_with(
+        f"mount -t squashfs -o loop,ro {usb / 'pi-top-usb-setup.squashfs'} {destination}",
+        timeout=30,
+    )
+    assert operations.usb_drive_in_use
+
+    # The USB drive can't be umounted while the image is in use
+    operations.umount_usb_drive()
+    umount_usb_drive.assert_not_called()
+
+    operations.umount_setup_image()
+    run_command.assert_called_with(f"umount {destination}", timeout=15)
+    assert not operations.usb_drive_in_use
+
+    operations.umount_usb_drive()
+    umount_usb_drive.assert_called_once_with(str(usb))
+
+
+def test_restarted_app_umounts_what_the_previous_instance_mounted(mocker, tmp_path):
+    run_command = mocker.patch("pi_top_usb_setup.utils.run_command")
+    from pi_top_usb_setup.file_structure import MountPointStructure
+    from pi_top_usb_setup.operations import MountPointOperations
+
+    usb = tmp_path / "usb"
+    usb.mkdir()
+    (usb / "pi-top-usb-setup.squashfs").touch()
+    image = tmp_path / "image"
+    image.mkdir()
+    # The restarted app gets the folder the image was mounted in
+    operations = MountPointOperations(
+        MountPointStructure(str(image)),
+        usb_drive=MountPointStructure(str(usb)),
+        mounted_image=image,
+    )
+    mocker.patch.object(MountPointOperations, "usb_drive_is_present", new=True)
+    umount_usb_drive = mocker.patch(
+        "pi_top_usb_setup.operations.mount_point.umount_usb_drive"
+    )
+
+    operations.umount_usb_drive()
+    umount_usb_drive.assert_not_called()
+
+    operations.umount_setup_image()
+    run_command.assert_called_once_with(f"umount {image}", timeout=15)
+    operations.umount_usb_drive()
+    umount_usb_drive.assert_called_once_with(str(usb))
+
+
+def test_resumable_extraction_removes_files_from_other_bundles(
+    mocker, bundle, tmp_path
+):
+    mocker.patch(
+        "pi_top_usb_setup.file_structure.get_linux_distro", return_value="bookworm"
+    )
+    from pi_top_usb_setup.extraction import (
+        CHECKPOINT_FILENAME,
+        EXTRACTION_MARKER,
+        ExtractionCheckpoint,
+    )
+    from pi_top_usb_setup.file_structure import MountPointStructure
+    from pi_top_usb_setup.operations import MountPointOperations
+
+    # Left by the extraction of another bundle
+    destination = tmp_path / "destination"
+    stale_script = destination / "pi-top-usb-setup/scripts/old.sh"
+    stale_script.parent.mkdir(parents=True)
+    stale_script.touch()
+    (destination / EXTRACTION_MARKER).touch()
+
+    bundle_path = bundle({"pi-top-usb-setup/pi-top_config.json": "{}"})
+    operations = MountPointOperations(MountPointStructure(str(bundle_path.parent)))
+    operations.extract_setup_file(destination, resumable=True)
+
+    assert not stale_script.exists()
+    assert (destination / "pi-top-usb-setup/pi-top_config.json").exists()
+    checkpoint = ExtractionCheckpoint.load(str(destination / CHECKPOINT_FILENAME))
+    assert checkpoint.complete and checkpoint.is_for(str(bundle_path))
+
+    # Extracting the same bundle again doesn't remove anything
+    (destination / "pi-top-usb-setup/extra.txt").touch()
+    operations.extract_setup_file(destination, resumable=True)
+    assert (destination / "pi-top-usb-setup/extra.txt").exists()
+
+
+def test_resumable_extraction_never_removes_other_files(mocker, bundle, tmp_path):
+    mocker.patch(
+        "pi_top_usb_setup.file_structure.get_linux_distro", return_value="bookworm"
+    )
+    from pi_top_usb_setup.extraction import CHECKPOINT_FILENAME
+    from pi_top_usb_setup.file_structure import MountPointStructure
+    from pi_top_usb_setup.operations import MountPointOperations
+    from pi_top_usb_setup.operations.mount_point import EXTRACTION_SUBFOLDER
+
+    bundle_path = bundle({"pi-top-usb-setup/pi-top_config.json": "{}"})
+    usb = bundle_path.parent
+    (usb / "pi-top-usb-setup").mkdir()
+    (usb / "pi-top-usb-setup/pi-top_config.json").write_text("{}")
+    (usb / "photos.jpg").touch()
+    other = tmp_path / "other"
+    other.mkdir()
+    (other / "notes.txt").touch()
+    operations = MountPointOperations(MountPointStructure(str(usb)))
+
+    # Nor the USB drive, nor folders that weren't created to extract bundles into
+    for destination in (usb, other):
+        operations.extract_setup_file(destination, resumable=True)
+    assert bundle_path.exists()
+    assert (usb / "photos.jpg").exists()
+    assert (other / "notes.txt").exists()
+    # Without taking them over for later extractions
+    assert not (other / CHECKPOINT_FILENAME).exists()
+
+    # A new folder is used instead, and reused next time
+    destination = operations.extraction_directory(usb)
+    assert destination == usb / EXTRACTION_SUBFOLDER
+    operations.extract_setup_file(destination, resumable=True)
+    assert (destination / "pi-top-usb-setup/pi-top_config.json").exists()
+    assert operations.extraction_directory(usb) == destination
+    assert operations.extraction_directory(tmp_path / "new") == tmp_path / "new"
+
+    # Which is the only one removed once the setup is done
+    assert operations.owns_extraction_directory(destination)
+    assert not operations.owns_extraction_directory(usb)
+    assert not operations.owns_extraction_directory(other)
+
+
+def test_updates_in_usb_drive_are_used_in_place(mocker, bundle, tmp_path):
+    mocker.patch(
+        "pi_top_usb_setup.file_structure.get_linux_distro", return_value="bookworm"
+    )
+    from pi_top_usb_setup.file_structure import MountPointStructure
+    from pi_top_usb_setup.operations import MountPointOperations
+
+    bundle_path = bundle(
+        {
+            "pi-top-usb-setup/pi-top_config.json": "{}",
+            "pi-top-usb-setup/updates_bookworm/Packages": "bookworm",
+        }
+    )
+    usb = bundle_path.parent
+    (usb / "pi-top-usb-setup/updates_bookworm").mkdir(parents=True)
+    (usb / "pi-top-usb-setup/updates_bookworm/Packages").touch()
+
+    operations = MountPointOperations(MountPointStructure(str(usb)))
+    mocker.patch.object(MountPointOperations, "usb_drive_is_present", new=True)
+    umount_usb_drive = mocker.patch(
+        "pi_top_usb_setup.operations.mount_point.umount_usb_drive"
+    )
+
+    assert (
+        operations.use_updates_in_place() == usb / "pi-top-usb-setup/updates_bookworm"
+    )
+
+    destination = tmp_path / "destination"
+    operations.extract_setup_file(destination)
+    assert (destination / "pi-top-usb-setup/pi-top_config.json").exists()
+    assert not (destination / "pi-top-usb-setup/updates_bookworm").exists()
+
+    # The USB drive is kept mounted until the updates are installed
+    operations.umount_usb_drive()
+    umount_usb_drive.assert_not_called()
+    operations.release_updates()
+    umount_usb_drive.assert_called_once_with(str(usb))
+
+
+def test_updates_are_extracted_if_usb_drive_has_none(bundle):
+    from pi_top_usb_setup.file_structure import MountPointStructure
+    from pi_top_usb_setup.operations import MountPointOperations
+
+    bundle_path = bundle({"pi-top-usb-setup/pi-top_config.json": "{}"})
+    operations = MountPointOperations(MountPointStructure(str(bundle_path.parent)))
+
+    assert operations.use_updates_in_place() is None
+    assert not operations.usb_drive_in_use
+
+
+def test_only_packages_that_will_be_installed_are_extracted(mocker, bundle, tmp_path):
+    mocker.patch(
+        "pi_top_usb_setup.file_structure.get_linux_distro", return_value="bookworm"
+    )
+    mocker.patch(
+        "pi_top_usb_setup.operations.mount_point.installed_versions",
+        return_value={"foo": "1.0", "bar": "2.0"},
+    )
+    mocker.patch(
+        "pi_top_usb_setup.operations.mount_point.status_index.provides",
+        return_value={},
+    )
+    from pi_top_usb_setup.file_structure import MountPointStructure
+    from pi_top_usb_setup.operations import MountPointOperations, mount_point
+
+    packages_index = (
+        "Package: foo\nVersion: 1.1\nFilename: ./foo_1.1_all.deb\n\n"
+        "Package: bar\nVersion: 2.0\nFilename: ./bar_2.0_all.deb\n"
+    )
+    bundle_path = bundle(
+        {
+            "pi-top-usb-setup/updates_bookworm/Packages": packages_index,
+            "pi-top-usb-setup/updates_bookworm/Release": "SHA256:\n 0 0 Packages\n",
+            "pi-top-usb-setup/pi-top_config.json": "{}",
+            "pi-top-usb-setup/updates_bookworm/bar_2.0_all.deb": "bar",
+            "pi-top-usb-setup/updates_bookworm/foo_1.1_all.deb": "foo",
+        }
+    )
+    operations = MountPointOperations(MountPointStructure(str(bundle_path.parent)))
+    destination = tmp_path / "destination"
+    read_bundle_head = mocker.spy(mount_point, "read_bundle_head")
+
+    plan = operations.plan_updates(destination)
+    assert plan.files == {"foo_1.1_all.deb"}
+    operations.plan_disk_usage(destination, install_updates=True)
+    assert operations.check_dependencies(destination) == set()
+
+    on_member_extracted = mocker.Mock()
+    operations.extract_setup_file(destination, on_member_extracted=on_member_extracted)
+    # The beginning of the bundle is only decompressed once
+    assert read_bundle_head.call_count == 1
+
+    updates = destination / "pi-top-usb-setup/updates_bookworm"
+    assert (updates / "foo_1.1_all.deb").exists()
+    assert not (updates / "bar_2.0_all.deb").exists()
+    assert "bar" not in (updates / "Packages").read_text()
+    assert str(len(plan.packages_index)) in (updates / "Release").read_text()
+    extracted = [c.args[0].name for c in on_member_extracted.call_args_list]
+    assert "pi-top-usb-setup/updates_bookworm/Packages" in extracted
+
+
+def test_cached_packages_are_linked_instead_of_extracted(mocker, bundle, tmp_path):
+    import hashlib
+
+    mocker.patch(
+        "pi_top_usb_setup.file_structure.get_linux_distro", return_value="bookworm"
+    )
+    from pi_top_usb_setup.file_structure import MountPointStructure
+    from pi_top_usb_setup.operations import MountPointOperations
+    from pi_top_usb_setup.package_cache import PackageCache
+
+    def sha256(content: str) -> str:
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    packages_index = (
+        f"Package: foo\nVersion: 1.1\nFilename: ./foo_1.1_all.deb\nSHA256: {sha256('foo')}\n\n"
+        f"Package: bar\nVersion: 2.0\nFilename: ./bar_2.0_all.deb\nSHA256: {sha256('bar')}\n"
+    )
+    bundle_path = bundle(
+        {
+            "pi-top-usb-setup/updates_bookworm/Packages": packages_index,
+            "pi-top-usb-setup/pi-top_config.json": "{}",
+            "pi-top-usb-setup/updates_bookworm/bar_2.0_all.deb": "bar",
+            "pi-top-usb-setup/updates_bookworm/foo_1.1_all.deb": "foo",
+        }
+    )
+    cache = PackageCache(tmp_path / "cache")
+    (tmp_path / "foo.deb").write_text("foo")
+    cache.add(tmp_path / "foo.deb", sha256("foo"))
+    operations = MountPointOperations(
+        MountPointStructure(str(bundle_path.parent)), package_cache=cache
+    )
+    destination = tmp_path / "destination"
+    extract = mocker.spy(operations.extraction_engine, "extract")
+    on_member_extracted = mocker.Mock()
+
+    operations.extract_setup_file(destination, on_member_extracted=on_member_extracted)
+
+    updates = destination / "pi-top-usb-setup/updates_bookworm"
+    assert (updates / "foo_1.1_all.deb").stat().st_ino == (
+        cache.path(sha256("foo")).stat().st_ino
+    )
+    member_filter = extract.call_args.kwargs["member_filter"]
+    assert not member_filter(
+        tarfile.TarInfo("pi-top-usb-setup/updates_bookworm/foo_1.1_all.deb")
+    )
+    extracted = [c.args[0].name for c in on_member_extracted.call_args_list]
+    assert "pi-top-usb-setup/updates_bookworm/foo_1.1_all.deb" in extracted
+    # Extracted packages are added to the cache
+    assert cache.has(sha256("bar"))
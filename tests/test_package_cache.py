@@ -0,0 +1,85 @@
+import hashlib
+import os
+
+
+def sha256(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def test_packages_are_linked_in_and_out_of_the_cache(tmp_path):
+    from pi_top_usb_setup.package_cache import PackageCache
+
+    cache = PackageCache(tmp_path / "cache")
+    package = tmp_path / "repository" / "foo_1.0_all.deb"
+    package.parent.mkdir()
+    package.write_bytes(b"foo")
+
+    assert cache.add(package, sha256(b"foo"))
+    assert cache.has(sha256(b"foo"))
+    assert cache.path(sha256(b"foo")).stat().st_ino == package.stat().st_ino
+
+    other = tmp_path / "other" / "foo_1.0_all.deb"
+    missing = tmp_path / "other" / "bar_1.0_all.deb"
+    assert cache.link_packages({other: sha256(b"foo"), missing: sha256(b"bar")}) == [
+        other
+    ]
+    assert other.read_bytes() == b"foo"
+    assert other.stat().st_ino == package.stat().st_ino
+    assert not missing.exists()
+
+
+def test_using_packages_keeps_their_modification_time(tmp_path):
+    from pi_top_usb_setup.package_cache import PackageCache
+
+    cache = PackageCache(tmp_path / "cache", max_size=3)
+    for content in (b"foo", b"bar"):
+        file = tmp_path / content.decode()
+        file.write_bytes(content)
+        os.utime(file, (1000, 1000))
+        cache.add(file, sha256(content))
+    os.utime(cache.path(sha256(b"bar")), (500, 1000))
+
+    # Extracted files share the modification time with the cache
+    cache.link_packages({tmp_path / "other" / "foo": sha256(b"foo")})
+    assert (tmp_path / "foo").stat().st_mtime == 1000
+    assert (tmp_path / "other" / "foo").stat().st_mtime == 1000
+
+    cache.evict()
+    assert cache.has(sha256(b"foo"))
+    assert not cache.has(sha256(b"bar"))
+
+
+def test_least_recently_used_packages_are_evicted(tmp_path):
+    from pi_top_usb_setup.package_cache import PackageCache
+
+    cache = PackageCache(tmp_path / "cache", max_size=9)
+    for age, content in enumerate([b"new", b"old", b"older", b"oldest"]):
+        file = tmp_path / content.decode()
+        file.write_bytes(content)
+        cache.add(file, sha256(content))
+        os.utime(cache.path(sha256(content)), (1000 - age, 1000 - age))
+
+    removed = cache.evict(keep={sha256(b"oldest")})
+
+    assert removed == len(b"older") + len(b"old")
+    assert cache.has(sha256(b"new"))
+    assert cache.has(sha256(b"oldest"))
+    assert not cache.has(sha256(b"old"))
+    assert cache.size() == 9
+
+
+def test_apt_source_links_missing_packages(tmp_path):
+    from pi_top_usb_setup.package_cache import PackageCache
+    from pi_top_usb_setup.system_updater import CustomAptSource
+
+    cache = PackageCache(tmp_path / "cache")
+    (tmp_path / "foo.deb").write_bytes(b"foo")
+    cache.add(tmp_path / "foo.deb", sha256(b"foo"))
+    repository = tmp_path / "repository"
+    repository.mkdir()
+    (repository / "Packages").write_text(
+        f"Package: foo\nFilename: ./pool/foo_1.0_all.deb\nSHA256: {sha256(b'foo')}\n"
+    )
+
+    with CustomAptSource(str(repository), cache):
+        assert (repository / "pool/foo_1.0_all.deb").read_bytes() == b"foo"
@@ -0,0 +1,101 @@
+import os
+from time import monotonic, sleep
+
+import pytest
+
+
+@pytest.fixture
+def packages(tmp_path):
+    files = []
+    for name in ("a", "b", "c", "d", "e"):
+        path = tmp_path / f"{name}.deb"
+        path.write_bytes(b"x" * 100)
+        files.append((name, str(path)))
+    yield files
+
+
+def wait_until(condition, timeout=5):
+    start = monotonic()
+    while not condition():
+        assert monotonic() - start < timeout
+        sleep(0.01)
+
+
+def test_prefetch_budget(tmp_path):
+    from pi_top_usb_setup.prefetch import PREFETCH_BUDGET, prefetch_budget
+
+    meminfo = tmp_path / "meminfo"
+    meminfo.write_text("MemTotal:  945512 kB\nMemAvailable:  524288 kB\n")
+    assert prefetch_budget(str(meminfo)) == 524288 * 1024 // 16
+
+    meminfo.write_text("MemTotal:  7945512 kB\nMemAvailable:  6524288 kB\n")
+    assert prefetch_budget(str(meminfo)) == PREFETCH_BUDGET
+
+    assert prefetch_budget(str(tmp_path / "missing")) == PREFETCH_BUDGET // 4
+
+
+def test_packages_ahead_are_prefetched(mocker, packages):
+    from pi_top_usb_setup import prefetch
+
+    fadvise = mocker.patch.object(prefetch, "_fadvise")
+
+    with prefetch.PackagePrefetcher(packages, budget=1000, depth=2) as prefetcher:
+        wait_until(lambda: fadvise.call_count == 3)
+        sleep(0.05)
+        assert fadvise.call_args_list == [
+            mocker.call(path, 100, os.POSIX_FADV_WILLNEED) for _, path in packages[:3]
+        ]
+        assert prefetcher.prefetched_bytes() == 300
+
+        # Installed packages are dropped from the page cache
+        prefetcher.advance("c:arm64")
+        wait_until(lambda: fadvise.call_count == 7)
+        # In any order, they happen in different threads
+        calls = fadvise.call_args_list[3:]
+        assert len(calls) == 4
+        for call in [
+            mocker.call(packages[0][1], 100, os.POSIX_FADV_DONTNEED),
+            mocker.call(packages[1][1], 100, os.POSIX_FADV_DONTNEED),
+            mocker.call(packages[3][1], 100, os.POSIX_FADV_WILLNEED),
+            mocker.call(packages[4][1], 100, os.POSIX_FADV_WILLNEED),
+        ]:
+            assert call in calls
+
+        # Packages before the current one don't move it back
+        prefetcher.advance("a")
+        assert prefetcher.prefetched_bytes() == 300
+
+
+def test_prefetch_fits_in_budget(mocker, packages):
+    from pi_top_usb_setup import prefetch
+
+    fadvise = mocker.patch.object(prefetch, "_fadvise")
+
+    with prefetch.PackagePrefetcher(packages, budget=250, depth=4) as prefetcher:
+        wait_until(lambda: fadvise.call_count == 3)
+        sleep(0.05)
+        # The last file only partially
+        assert [c.args[1] for c in fadvise.call_args_list] == [100, 100, 50]
+        assert prefetcher.prefetched_bytes() == 250
+
+
+def test_missing_files_are_skipped(mocker, packages, tmp_path):
+    from pi_top_usb_setup import prefetch
+
+    fadvise = mocker.patch.object(prefetch, "_fadvise")
+    packages[1] = ("b", str(tmp_path / "missing.deb"))
+
+    with prefetch.PackagePrefetcher(packages, budget=1000, depth=2) as prefetcher:
+        wait_until(lambda: fadvise.call_count == 2)
+        sleep(0.05)
+        assert prefetcher.prefetched_bytes() == 200
+
+
+def test_page_cache_advice(packages):
+    from pi_top_usb_setup.prefetch import PackagePrefetcher
+
+    # With the real posix_fadvise
+    with PackagePrefetcher(packages, budget=1000) as prefetcher:
+        wait_until(lambda: prefetcher.prefetched_bytes() == 500)
+        prefetcher.advance("e")
+        assert prefetcher.prefetched_bytes() == 100
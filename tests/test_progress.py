@@ -0,0 +1,53 @@
+from unittest.mock import Mock
+
+
+def test_progress_meter_reports_percentage_throughput_and_eta(mocker):
+    from pi_top_usb_setup import progress
+    from pi_top_usb_setup.progress import ProgressMeter
+
+    now = mocker.patch.object(progress, "monotonic", return_value=0.0)
+    on_progress = Mock()
+    on_stats = Mock()
+    meter = ProgressMeter(1000, on_progress, on_stats)
+
+    meter.update(0)
+    now.return_value = 1.0
+    meter.advance(100)
+
+    assert on_progress.call_args.args[0] == 10.0
+    stats = on_stats.call_args.args[0]
+    assert stats.throughput == 100.0
+    assert stats.eta == 9.0
+
+    # Throughput is smoothed
+    now.return_value = 2.0
+    meter.advance(200)
+    assert 100.0 < meter.throughput < 200.0
+
+    meter.finish()
+    assert on_progress.call_args.args[0] == 100.0
+    assert on_stats.call_args.args[0].eta == 0
+
+
+def test_progress_meter_only_reports_once_per_interval(mocker):
+    from pi_top_usb_setup import progress
+    from pi_top_usb_setup.progress import ProgressMeter
+
+    mocker.patch.object(progress, "monotonic", return_value=0.0)
+    on_progress = Mock()
+    meter = ProgressMeter(1000, on_progress)
+
+    for _ in range(10):
+        meter.advance(10)
+
+    on_progress.assert_called_once_with(1.0)
+    assert meter.bytes_done == 100
+
+
+def test_progress_meter_with_nothing_to_do():
+    from pi_top_usb_setup.progress import ProgressMeter
+
+    on_progress = Mock()
+    ProgressMeter(0, on_progress).finish()
+
+    on_progress.assert_called_once_with(100.0)
@@ -0,0 +1,112 @@
+import pytest
+
+MOUNTS = """/dev/mmcblk0p2 / ext4 rw,noatime 0 0
+tmpfs /tmp tmpfs rw,nosuid,nodev 0 0
+/dev/mmcblk0p1 /boot/firmware vfat rw,relatime 0 0
+/dev/sda1 /media/pi/my\\040drive vfat rw,relatime 0 0
+/dev/sdb1 /mnt/ssd ext4 rw,relatime 0 0
+/dev/sdc1 /mnt/backup ext4 ro,relatime 0 0
+"""
+
+
+@pytest.fixture
+def mounts(tmp_path):
+    from pi_top_usb_setup.storage import read_mounts
+
+    (tmp_path / "mounts").write_text(MOUNTS)
+    yield read_mounts(str(tmp_path / "mounts"))
+
+
+def test_read_mounts(mounts):
+    assert [mount.mount_point for mount in mounts] == [
+        "/",
+        "/tmp",
+        "/boot/firmware",
+        "/media/pi/my drive",
+        "/mnt/ssd",
+        "/mnt/backup",
+    ]
+    assert mounts[5].read_only
+    assert not mounts[1].is_disk
+
+
+def test_mount_for(mounts):
+    from pi_top_usb_setup.storage import mount_for
+
+    assert mount_for("/tmp/pi-top-usb-setup", mounts).fs_type == "tmpfs"
+    assert mount_for("/var/tmp/pi-top-usb-setup", mounts).mount_point == "/"
+
+
+def test_storage_targets_are_writable_disk_filesystems(mocker, tmp_path):
+    from pathlib import Path
+
+    from pi_top_usb_setup.storage import read_mounts, storage_targets
+
+    mocker.patch("pi_top_usb_setup.storage.os.access", return_value=True)
+    mocker.patch("shutil.disk_usage", return_value=(0, 0, 1000))
+    for name in ("ssd", "data", "backup", "home"):
+        (tmp_path / name).mkdir()
+    (tmp_path / "mounts").write_text(
+        MOUNTS
+        + f"/dev/sdd1 {tmp_path}/ssd ext4 rw 0 0\n"
+        + f"/dev/sde1 {tmp_path}/data ext4 rw 0 0\n"
+        + f"/dev/sdf1 {tmp_path}/backup ext4 ro 0 0\n"
+        + f"/dev/sdg1 {tmp_path}/home ext4 rw 0 0\n"
+    )
+    # Used by a previous extraction
+    (tmp_path / "ssd/pi-top-usb-setup").mkdir()
+    (tmp_path / "ssd/pi-top-usb-setup/.marker").touch()
+    (tmp_path / "backup/pi-top-usb-setup").mkdir()
+    (tmp_path / "backup/pi-top-usb-setup/.marker").touch()
+    # Not created by the setup
+    (tmp_path / "data/pi-top-usb-setup").mkdir()
+
+    targets = storage_targets(
+        "/var/tmp/pi-top-usb-setup",
+        mounts=read_mounts(str(tmp_path / "mounts")),
+        owned_markers=[".marker"],
+        locations=[tmp_path / "home", "/srv"],
+    )
+
+    assert [target.directory for target in targets] == [
+        Path("/var/tmp/pi-top-usb-setup"),
+        tmp_path / "home/pi-top-usb-setup",
+        tmp_path / "ssd/pi-top-usb-setup",
+    ]
+
+
+def test_choose_extraction_directory(mocker, tmp_path):
+    from pi_top_usb_setup import storage
+    from pi_top_usb_setup.storage import MountEntry, StorageTarget
+
+    root = StorageTarget(tmp_path / "root", MountEntry("a", "/", "ext4"), 1000)
+    ssd = StorageTarget(tmp_path / "ssd", MountEntry("b", "/mnt/ssd", "ext4"), 5000)
+    mocker.patch.object(storage, "storage_targets", return_value=[root, ssd])
+    throughput = mocker.patch.object(
+        storage, "measure_write_throughput", side_effect=[10.0, 20.0]
+    )
+
+    # Only the SSD fits
+    assert storage.choose_extraction_directory("/var/tmp", 2000) == ssd.directory
+    throughput.assert_not_called()
+
+    # Both fit; the fastest one is used
+    assert storage.choose_extraction_directory("/var/tmp", 500) == ssd.directory
+    assert throughput.call_count == 2
+
+    # An interrupted extraction is resumed where it was
+    (root.directory).mkdir()
+    (root.directory / "checkpoint.json").touch()
+    assert (
+        storage.choose_extraction_directory(
+            "/var/tmp", 2000, checkpoint_filename="checkpoint.json"
+        )
+        == root.directory
+    )
+
+
+def test_measure_write_throughput(tmp_path):
+    from pi_top_usb_setup.storage import measure_write_throughput
+
+    assert measure_write_throughput(tmp_path, size=1024 * 1024) > 0
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,481 @@
+import json
+from unittest.mock import call
+
+import pytest
+
+SIMULATION_OUTPUT = """Reading package lists...
+Building dependency tree...
+The following packages will be upgraded:
+  libfoo foo
+Inst libfoo [1.0-1] (1.1-1 localhost [arm64])
+Inst libbar (2:0.5 localhost [all])
+Conf libfoo (1.1-1 localhost [arm64])
+Conf libbar (2:0.5 localhost [all])
+Inst foo [1.0] (1.1 localhost [arm64])
+Conf foo (1.1 localhost [arm64])
+"""
+
+PACKAGES_INDEX = """Package: libfoo
+Version: 1.1-1
+Filename: ./libfoo_1.1-1_arm64.deb
+Description: a library
+ with a long description
+
+Package: libbar
+Version: 2:0.5
+Filename: ./libbar_0.5_all.deb
+
+Package: foo
+Version: 1.1
+Filename: ./foo_1.1_arm64.deb
+"""
+
+
+def test_parse_apt_actions():
+    from pi_top_usb_setup.system_updater import (
+        AptAction,
+        AptActionType,
+        parse_apt_actions,
+    )
+
+    actions = parse_apt_actions(SIMULATION_OUTPUT)
+
+    assert actions[0] == AptAction(AptActionType.INSTALL, "libfoo", "1.1-1", "1.0-1")
+    assert actions[1] == AptAction(AptActionType.INSTALL, "libbar", "2:0.5", None)
+    assert actions[2] == AptAction(AptActionType.CONFIGURE, "libfoo", "1.1-1", None)
+    assert len(actions) == 6
+
+
+def test_read_packages_index(tmp_path):
+    from pi_top_usb_setup.system_updater import read_packages_index
+
+    (tmp_path / "Packages").write_text(PACKAGES_INDEX)
+
+    assert read_packages_index(tmp_path / "Packages") == {
+        ("libfoo", "1.1-1"): "./libfoo_1.1-1_arm64.deb",
+        ("libbar", "2:0.5"): "./libbar_0.5_all.deb",
+        ("foo", "1.1"): "./foo_1.1_arm64.deb",
+    }
+
+
+@pytest.fixture
+def repository(tmp_path):
+    (tmp_path / "Packages").write_text(PACKAGES_INDEX)
+    yield tmp_path
+
+
+def test_pipelined_upgrade_waits_for_each_package(mocker, repository):
+    from pi_top_usb_setup import system_updater
+    from pi_top_usb_setup.system_updater import SystemUpdater
+
+    mocker.patch.object(system_updater, "run_command", return_value=SIMULATION_OUTPUT)
+    run = mocker.patch.object(SystemUpdater, "_run")
+
+    extracted = set()
+
+    def wait_for_file(path):
+        if path.name == "foo_1.1_arm64.deb":
+            # dpkg already went through the libraries when the last package arrives
+            assert run.call_count == 3
+        extracted.add(path.name)
+        return True
+
+    updater = SystemUpdater(apt_repository=str(repository), wait_for_file=wait_for_file)
+    updater.upgrade()
+
+    dpkg_commands = [
+        c.args[0].replace("dpkg --force-confdef --force-confold --status-fd 1 ", "")
+        for c in run.call_args_list
+        if c.args[0].startswith("dpkg")
+    ]
+    assert dpkg_commands == [
+        f"--unpack --auto-deconfigure {repository}/libfoo_1.1-1_arm64.deb",
+        f"--unpack --auto-deconfigure {repository}/libbar_0.5_all.deb",
+        "--configure libfoo libbar",
+        f"--unpack --auto-deconfigure {repository}/foo_1.1_arm64.deb",
+    ]
+    # Once there are no files to wait for, apt configures the rest
+    assert run.call_args_list[-2].args[0].startswith("apt-get dist-upgrade -y ")
+    assert extracted == {
+        "Packages",
+        "libfoo_1.1-1_arm64.deb",
+        "libbar_0.5_all.deb",
+        "foo_1.1_arm64.deb",
+    }
+    # New dependencies are marked as automatically installed
+    assert run.call_args_list[-1].args[0].startswith("apt-mark auto libbar ")
+
+
+def test_pipelined_upgrade_fails_if_package_is_missing(mocker, repository):
+    from pi_top_usb_setup import system_updater
+    from pi_top_usb_setup.system_updater import SystemUpdater
+
+    mocker.patch.object(system_updater, "run_command", return_value=SIMULATION_OUTPUT)
+    run = mocker.patch.object(SystemUpdater, "_run")
+
+    updater = SystemUpdater(
+        apt_repository=str(repository),
+        wait_for_file=lambda path: path.name != "libbar_0.5_all.deb",
+    )
+    with pytest.raises(Exception, match="libbar_0.5_all.deb"):
+        updater.upgrade()
+
+    assert run.call_args_list == [
+        call(
+            f"dpkg --force-confdef --force-confold --status-fd 1 --unpack --auto-deconfigure {repository}/libfoo_1.1-1_arm64.deb",
+            stdout_callback=mocker.ANY,
+        )
+    ]
+
+
+def test_pipelined_upgrade_unpacks_available_packages_together(mocker, repository):
+    from pi_top_usb_setup import system_updater
+    from pi_top_usb_setup.system_updater import SystemUpdater
+
+    mocker.patch.object(system_updater, "run_command", return_value=SIMULATION_OUTPUT)
+    run = mocker.patch.object(SystemUpdater, "_run")
+    available = {"Packages", "libbar_0.5_all.deb"}
+
+    def wait_for_file(path):
+        available.add(path.name)
+        return True
+
+    def dpkg(cmd, stdout_callback=None):
+        if "--unpack" in cmd:
+            # The last package is extracted while the first ones are installed
+            available.add("foo_1.1_arm64.deb")
+
+    run.side_effect = dpkg
+
+    SystemUpdater(
+        apt_repository=str(repository),
+        wait_for_file=wait_for_file,
+        is_extracted=lambda path: path.name in available,
+    ).upgrade()
+
+    commands = [c.args[0] for c in run.call_args_list]
+    assert commands[0].endswith(
+        f"--unpack --auto-deconfigure {repository}/libfoo_1.1-1_arm64.deb "
+        f"{repository}/libbar_0.5_all.deb"
+    )
+    # apt installs the rest, once every package file is available
+    assert commands[1].startswith("apt-get dist-upgrade -y ")
+    assert commands[2].startswith("apt-mark auto libbar ")
+    assert len(commands) == 3
+
+
+def test_upgrade_after_extraction_uses_apt(mocker, repository):
+    from pi_top_usb_setup import system_updater
+    from pi_top_usb_setup.system_updater import SystemUpdater
+
+    mocker.patch.object(system_updater, "run_command", return_value=SIMULATION_OUTPUT)
+    run = mocker.patch.object(SystemUpdater, "_run")
+
+    SystemUpdater(
+        apt_repository=str(repository),
+        wait_for_file=lambda path: True,
+        is_extracted=lambda path: True,
+    ).upgrade()
+
+    assert len(run.call_args_list) == 1
+    assert run.call_args_list[0].args[0].startswith("apt-get dist-upgrade -y ")
+
+
+def test_upgrade_without_pipelining_uses_apt(mocker, repository):
+    from pi_top_usb_setup import system_updater
+    from pi_top_usb_setup.system_updater import SystemUpdater
+
+    mocker.patch.object(system_updater, "run_command", return_value=SIMULATION_OUTPUT)
+    run = mocker.patch.object(SystemUpdater, "_run")
+
+    SystemUpdater(apt_repository=str(repository)).upgrade()
+
+    run.assert_called_once()
+    assert run.call_args.args[0].startswith("apt-get dist-upgrade -y ")
+
+
+def test_commands_wait_for_dpkg_lock(mocker, repository):
+    from pi_top_usb_setup import system_updater
+    from pi_top_usb_setup.system_updater import SystemUpdater
+
+    mocker.patch.object(system_updater, "run_command", return_value=SIMULATION_OUTPUT)
+    run = mocker.patch.object(SystemUpdater, "_run")
+    wait = mocker.patch.object(system_updater, "wait_for_dpkg_lock")
+    on_lock_wait = mocker.Mock()
+
+    SystemUpdater(
+        apt_repository=str(repository), lock_timeout=10, on_lock_wait=on_lock_wait
+    ).upgrade()
+
+    wait.assert_called_once_with(10, on_wait=on_lock_wait)
+    assert "-o DPkg::Lock::Timeout=" in run.call_args.args[0]
+
+
+def test_upgrade_prefetches_packages_in_install_order(mocker, repository):
+    from pi_top_usb_setup import system_updater
+    from pi_top_usb_setup.system_updater import SystemUpdater
+
+    mocker.patch.object(system_updater, "run_command", return_value=SIMULATION_OUTPUT)
+    prefetcher = mocker.patch.object(system_updater, "PackagePrefetcher")
+    advance = prefetcher.return_value.__enter__.return_value.advance
+
+    def run(cmd, stdout_callback=None):
+        stdout_callback("pmstatus:libbar:20:Preparing to unpack libbar")
+
+    mocker.patch.object(SystemUpdater, "_run", side_effect=run)
+
+    SystemUpdater(apt_repository=str(repository)).upgrade()
+
+    prefetcher.assert_called_once_with(
+        [
+            ("libfoo", f"{repository}/libfoo_1.1-1_arm64.deb"),
+            ("libbar", f"{repository}/libbar_0.5_all.deb"),
+            ("foo", f"{repository}/foo_1.1_arm64.deb"),
+        ]
+    )
+    advance.assert_called_once_with("libbar")
+
+
+def test_apt_list_prefix():
+    from pi_top_usb_setup.system_updater import apt_list_prefix
+
+    assert apt_list_prefix("/media/pi/USB_DRIVE/updates_bookworm") == (
+        "_media_pi_USB%5fDRIVE_updates%5fbookworm"
+    )
+    assert (
+        apt_list_prefix("/media/pi/my drive~1/ñ") == "_media_pi_my%20drive%7e1_%c3%b1"
+    )
+
+
+def test_update_is_skipped_if_repository_did_not_change(mocker, repository, tmp_path):
+    from pi_top_usb_setup import system_updater
+    from pi_top_usb_setup.system_updater import SystemUpdater
+
+    lists = tmp_path / "lists"
+    lists.mkdir()
+    mocker.patch.object(system_updater, "INDEX_HASH_FILE", str(tmp_path / "hash"))
+    mocker.patch.object(system_updater, "APT_LISTS_FOLDER", str(lists))
+    run = mocker.patch.object(SystemUpdater, "_run")
+
+    def apt_get_update(*args, **kwargs):
+        # apt quotes underscores, like the ones in the name of the test folder
+        prefix = str(repository.resolve()).replace("_", "%5f").replace("/", "_")
+        (lists / f"{prefix}_._Packages").touch()
+
+    run.side_effect = apt_get_update
+
+    updater = SystemUpdater(apt_repository=str(repository))
+    updater.update()
+    updater.update()
+    assert run.call_count == 1
+
+    # A changed index is read again
+    (repository / "Packages").write_text(PACKAGES_INDEX + "\n")
+    updater.update()
+    assert run.call_count == 2
+
+    # Lists removed by an online update are created again
+    for file in lists.iterdir():
+        file.unlink()
+    updater.update()
+    assert run.call_count == 3
+
+
+def test_update_waits_for_release_files(mocker, repository, tmp_path):
+    from pi_top_usb_setup import system_updater
+    from pi_top_usb_setup.system_updater import SystemUpdater
+
+    mocker.patch.object(system_updater, "INDEX_HASH_FILE", str(tmp_path / "hash"))
+    mocker.patch.object(system_updater, "APT_LISTS_FOLDER", str(tmp_path / "lists"))
+    run = mocker.patch.object(SystemUpdater, "_run")
+
+    waited = []
+
+    def wait_for_file(path):
+        # apt reads the release files, so they must be complete before it runs
+        assert run.call_count == 0
+        waited.append(path.name)
+        return True
+
+    updater = SystemUpdater(
+        apt_repository=str(repository),
+        wait_for_file=wait_for_file,
+        release_files=["Release", "InRelease"],
+    )
+    updater.update()
+    assert waited == ["Packages", "Release", "InRelease"]
+    assert run.call_count == 1
+
+
+def test_apt_messages_are_reported(mocker, tmp_path):
+    from pi_top_usb_setup import system_updater
+    from pi_top_usb_setup.system_updater import SystemUpdater
+
+    report = tmp_path / "timings.json"
+    mocker.patch.object(system_updater, "TIMINGS_REPORT_FILE", str(report))
+    on_progress = mocker.Mock()
+    on_error = mocker.Mock()
+
+    def run(command, stdout_callback=None):
+        for message in [
+            "dlstatus:1:0:Retrieving file 1 of 1",
+            "pmstatus:foo:arm64:10:Unpacking foo:arm64 (1.1) over (1.0)",
+            "pmconffile:/etc/foo.conf:20:'/etc/foo.conf' '/etc/foo.conf.dpkg-new' 1 1",
+            "pmstatus:foo:arm64:50:Configuring foo:arm64",
+            "pmerror:foo:arm64:60:installed post-installation script: exit status 1",
+            "Some other output",
+        ]:
+            stdout_callback(message)
+
+    mocker.patch.object(SystemUpdater, "_run", side_effect=run)
+
+    SystemUpdater(on_progress=on_progress, on_error=on_error).upgrade()
+
+    assert on_progress.call_args_list == [call(10), call(50), call(60)]
+    on_error.assert_called_once_with(
+        "installed post-installation script: exit status 1"
+    )
+    assert [
+        entry["package"] for entry in json.loads(report.read_text())["packages"]
+    ] == ["foo"]
+
+
+def test_upgrade_is_estimated_from_simulation(mocker, repository, tmp_path):
+    from pi_top_usb_setup import system_updater
+    from pi_top_usb_setup.system_updater import SystemUpdater
+
+    mocker.patch.object(system_updater, "run_command", return_value=SIMULATION_OUTPUT)
+    mocker.patch.object(
+        system_updater, "TIMINGS_REPORT_FILE", str(tmp_path / "timings.json")
+    )
+
+    estimate = SystemUpdater(apt_repository=str(repository)).estimate_upgrade()
+
+    assert estimate.packages == 3
+    assert set(estimate.package_durations) == {"libfoo", "libbar", "foo"}
+    assert estimate.duration > 0
+
+
+def test_simulation_is_reused_until_the_system_changes(mocker, repository, tmp_path):
+    from pi_top_usb_setup import system_updater
+    from pi_top_usb_setup.system_updater import SystemUpdater
+
+    run_command = mocker.patch.object(
+        system_updater, "run_command", return_value=SIMULATION_OUTPUT
+    )
+    mocker.patch.object(SystemUpdater, "_run")
+    mocker.patch.object(
+        system_updater, "TIMINGS_REPORT_FILE", str(tmp_path / "timings.json")
+    )
+    updater = SystemUpdater(apt_repository=str(repository))
+
+    updater.upgrade_package("pi-top-usb-setup")
+    updater.estimate_upgrade()
+    updater.upgrade()
+
+    assert [c.args[0].split(" -o ")[0] for c in run_command.call_args_list] == [
+        "apt-get install -y pi-top-usb-setup",
+        "apt-get dist-upgrade -y",
+    ]
+
+    updater.estimate_upgrade()
+    assert run_command.call_count == 3
+
+
+def test_provisioning_profile_defers_triggers_and_syncs(mocker, repository):
+    from pi_top_usb_setup import system_updater
+    from pi_top_usb_setup.system_updater import PROVISIONING_PROFILE, SystemUpdater
+
+    mocker.patch.object(system_updater, "run_command", return_value=SIMULATION_OUTPUT)
+    run = mocker.patch.object(SystemUpdater, "_run")
+
+    SystemUpdater(
+        apt_repository=str(repository),
+        wait_for_file=lambda path: True,
+        profile=PROVISIONING_PROFILE,
+    ).upgrade()
+
+    commands = [c.args[0] for c in run.call_args_list]
+    dpkg_prefix = (
+        "dpkg --force-confdef --force-confold --status-fd 1 --force-unsafe-io "
+    )
+    assert commands[0] == (
+        f"{dpkg_prefix}--no-triggers --unpack --auto-deconfigure "
+        f"{repository}/libfoo_1.1-1_arm64.deb"
+    )
+    apt_command = next(c for c in commands if c.startswith("apt-get dist-upgrade"))
+    assert '-o Dpkg::Options::="--force-unsafe-io"' in apt_command
+    assert "-o DPkg::NoTriggers=true" in apt_command
+    # Triggers run once, after everything else, and the result is flushed to disk
+    assert commands[-3:] == [
+        f"{dpkg_prefix}--configure --pending",
+        f"{dpkg_prefix}--triggers-only --pending",
+        "sync",
+    ]
+
+
+def test_held_back_packages_are_not_installed(mocker, repository, tmp_path):
+    from pi_top_usb_setup import system_updater
+    from pi_top_usb_setup.system_updater import SystemUpdater
+
+    mocker.patch.object(system_updater, "HELD_BACK_FILE", str(tmp_path / "held"))
+    held = set()
+
+    def run_command(cmd, timeout):
+        if cmd == "apt-mark showhold":
+            return ""
+        # apt leaves held packages as they are
+        return "\n".join(
+            line
+            for line in SIMULATION_OUTPUT.splitlines()
+            if not any(f" {package} " in line for package in held)
+        )
+
+    def run(cmd, stdout_callback=None):
+        args = cmd.split(" -o ")[0].split()
+        if args[:2] == ["apt-mark", "hold"]:
+            held.update(args[2:])
+        elif args[:2] == ["apt-mark", "unhold"]:
+            held.difference_update(args[2:])
+
+    mocker.patch.object(system_updater, "run_command", side_effect=run_command)
+    run = mocker.patch.object(SystemUpdater, "_run", side_effect=run)
+
+    SystemUpdater(
+        apt_repository=str(repository),
+        wait_for_file=lambda path: True,
+        held_back={"foo"},
+    ).upgrade()
+
+    commands = [c.args[0].split(" -o ")[0] for c in run.call_args_list]
+    assert commands[0] == "apt-mark hold foo"
+    assert not any("foo_1.1_arm64.deb" in command for command in commands)
+    assert commands[-1] == "apt-mark unhold foo"
+    assert not held
+    assert not (tmp_path / "held").exists()
+
+
+def test_package_upgraded_first_is_only_configured(mocker, repository):
+    from pi_top_usb_setup import system_updater
+    from pi_top_usb_setup.system_updater import PROVISIONING_PROFILE, SystemUpdater
+
+    mocker.patch.object(system_updater, "run_command", return_value=SIMULATION_OUTPUT)
+    mocker.patch.object(
+        system_updater.status_index,
+        "unconfigured",
+        return_value={"pi-top-usb-setup", "libfoo"},
+    )
+    run = mocker.patch.object(SystemUpdater, "_run")
+    updater = SystemUpdater(
+        apt_repository=str(repository), profile=PROVISIONING_PROFILE
+    )
+
+    updater.upgrade_package("pi-top-usb-setup")
+
+    # Triggers and the sync are left for the end of the upgrade
+    commands = [c.args[0] for c in run.call_args_list]
+    assert commands[0].startswith("apt-get install -y pi-top-usb-setup")
+    assert commands[1:] == [
+        "dpkg --force-confdef --force-confold --status-fd 1 --force-unsafe-io "
+        "--no-triggers --configure libfoo pi-top-usb-setup"
+    ]
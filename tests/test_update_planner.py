@@ -0,0 +1,118 @@
+PACKAGES_INDEX = """Package: foo
+Version: 1.1
+Architecture: arm64
+Depends: libfoo (>= 1.1), libc6
+Filename: ./foo_1.1_arm64.deb
+
+Package: foo
+Version: 1.0
+Architecture: arm64
+Filename: ./foo_1.0_arm64.deb
+
+Package: libfoo
+Version: 1.1
+Architecture: arm64
+Depends: libfoo-data
+Filename: ./libfoo_1.1_arm64.deb
+
+Package: libfoo-data
+Version: 1.1
+Architecture: all
+Filename: ./libfoo-data_1.1_all.deb
+
+Package: libc6
+Version: 2.36
+Architecture: arm64
+Filename: ./libc6_2.36_arm64.deb
+
+Package: unrelated
+Version: 3.0
+Architecture: all
+Filename: ./unrelated_3.0_all.deb
+"""
+
+INSTALLED = {"foo": "1.0", "libc6": "2.36"}
+
+
+def test_only_newer_packages_and_their_new_dependencies_are_planned():
+    from pi_top_usb_setup.update_planner import plan_updates
+
+    plan = plan_updates(PACKAGES_INDEX, INSTALLED)
+
+    assert plan.files == {
+        "foo_1.1_arm64.deb",
+        "libfoo_1.1_arm64.deb",
+        "libfoo-data_1.1_all.deb",
+    }
+    assert plan.skipped_files == {
+        "foo_1.0_arm64.deb",
+        "libc6_2.36_arm64.deb",
+        "unrelated_3.0_all.deb",
+    }
+
+
+def test_planned_index_only_lists_planned_packages():
+    from pi_top_usb_setup.apt_index import parse_packages_index
+    from pi_top_usb_setup.update_planner import plan_updates
+
+    plan = plan_updates(PACKAGES_INDEX, INSTALLED)
+
+    packages = parse_packages_index(plan.packages_index)
+    assert sorted((p["Package"], p["Version"]) for p in packages) == [
+        ("foo", "1.1"),
+        ("libfoo", "1.1"),
+        ("libfoo-data", "1.1"),
+    ]
+
+
+def test_nothing_is_planned_for_an_up_to_date_system():
+    from pi_top_usb_setup.update_planner import plan_updates
+
+    plan = plan_updates(
+        PACKAGES_INDEX, {"foo": "1.1", "libfoo": "1.1", "libc6": "2.36"}
+    )
+
+    assert plan.files == set()
+
+
+VIRTUAL_INDEX = """Package: foo
+Version: 1.1
+Depends: mail-transport-agent, www-browser
+Filename: ./foo_1.1_all.deb
+
+Package: exim4
+Version: 4.96
+Provides: mail-transport-agent
+Filename: ./exim4_4.96_all.deb
+
+Package: postfix
+Version: 3.7
+Provides: mail-transport-agent
+Filename: ./postfix_3.7_all.deb
+
+Package: chromium
+Version: 120
+Provides: www-browser
+Filename: ./chromium_120_all.deb
+"""
+
+
+def test_virtual_dependencies_bring_in_a_provider():
+    from pi_top_usb_setup.update_planner import plan_updates
+
+    plan = plan_updates(VIRTUAL_INDEX, {"foo": "1.0", "postfix": "3.6"})
+    # The installed provider is preferred, even if its installed version doesn't
+    # provide the package yet
+    assert plan.files == {
+        "foo_1.1_all.deb",
+        "postfix_3.7_all.deb",
+        "chromium_120_all.deb",
+    }
+
+    # Nothing is needed if an installed package provides it
+    plan = plan_updates(
+        VIRTUAL_INDEX,
+        {"foo": "1.0", "firefox": "115"},
+        {"www-browser": {"firefox"}},
+    )
+    assert plan.files == {"foo_1.1_all.deb", "exim4_4.96_all.deb"}
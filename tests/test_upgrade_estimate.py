@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+PACKAGES_INDEX = """Package: foo
+Version: 1.1
+Size: 1000
+Installed-Size: 2048
+
+Package: bar
+Version: 2.0
+Size: 500
+Installed-Size: 1024
+"""
+
+MB = 1024 * 1024
+
+
+def test_estimate_without_history_uses_default_speed():
+    from pi_top_usb_setup.upgrade_estimate import (
+        DEFAULT_SECONDS_PER_MB,
+        PACKAGE_OVERHEAD,
+        estimate_upgrade,
+    )
+
+    estimate = estimate_upgrade(
+        [("foo:arm64", "1.1"), ("bar", "2.0"), ("unknown", "1.0")], PACKAGES_INDEX
+    )
+
+    assert estimate.packages == 3
+    assert estimate.download_size == 1500
+    assert estimate.installed_size == 3 * MB
+    assert estimate.duration == pytest.approx(
+        3 * PACKAGE_OVERHEAD + 3 * DEFAULT_SECONDS_PER_MB
+    )
+    assert estimate.package_durations["unknown"] == PACKAGE_OVERHEAD
+
+
+def test_estimate_learns_from_previous_upgrade():
+    from pi_top_usb_setup.upgrade_estimate import PACKAGE_OVERHEAD, estimate_upgrade
+
+    # 'baz' took 10 seconds to install 1MB
+    history = {"baz": 10 + PACKAGE_OVERHEAD, "bar": 3}
+    estimate = estimate_upgrade(
+        [("foo", "1.1"), ("bar", "2.0")],
+        PACKAGES_INDEX,
+        history,
+        installed_sizes={"baz": MB},
+    )
+
+    assert estimate.package_durations == {
+        "foo": pytest.approx(PACKAGE_OVERHEAD + 20),
+        "bar": 3,
+    }
+
+
+def test_read_timings_report(tmp_path):
+    from pi_top_usb_setup.upgrade_estimate import read_timings_report
+
+    report = tmp_path / "timings.json"
+    report.write_text(
+        json.dumps({"total": 3, "packages": [{"package": "foo", "total": 3}]})
+    )
+
+    assert read_timings_report(str(report)) == {"foo": 3}
+    assert read_timings_report(str(tmp_path / "missing.json")) == {}
+    report.write_text("not json")
+    assert read_timings_report(str(report)) == {}
+
+
+def test_eta_follows_apt_progress():
+    from pi_top_usb_setup.upgrade_estimate import UpgradeEstimate, format_eta
+
+    estimate = UpgradeEstimate(packages=10, duration=100)
+
+    # Until apt reports enough progress, the estimate is used
+    assert estimate.eta(20, 5) == 80
+    assert estimate.progress(20, 5) == pytest.approx(20)
+    # Half of the way, apt going twice as slow as expected
+    assert estimate.eta(100, 50) == pytest.approx(50)
+    assert estimate.eta(200, 100) == 0
+    assert estimate.progress(200, 100) == 100
+
+    assert format_eta(65) == "1:05 left"
@@ -79,3 +79,83 @@ def test_print_folder_recursively_error(
     mock_logging.error.assert_called_once_with(
         "Error reading /sample_folder/file1.txt: Permission denied"
     )
+
+
+def create_tar_gz(path, files: dict) -> str:
+    import io
+    import tarfile
+
+    with tarfile.open(path, "w:gz") as tar:
+        for name, content in files.items():
+            data = content.encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return str(path)
+
+
+def test_restart_passes_what_is_still_mounted_to_the_new_instance(mocker):
+    from pi_top_usb_setup import utils
+
+    run_command = mocker.patch.object(utils, "run_command", return_value="args")
+    systemctl = mocker.patch.object(utils, "systemctl")
+    kill = mocker.patch.object(utils.os, "kill")
+
+    utils.restart_service_and_skip_user_confirmation_dialog(
+        "/tmp/image", usb_drive="/media/usb", mounted_image="/tmp/image"
+    )
+
+    run_command.assert_called_once_with(
+        "systemd-escape -- '/tmp/image --skip-dialog --usb-drive /media/usb "
+        "--mounted-image /tmp/image'",
+        timeout=5,
+    )
+    systemctl.assert_called_once_with("start", "pt-usb-setup@'args'")
+    kill.assert_called_once()
+
+
+def test_extract_file_extracts_all_members(tmp_path):
+    from pi_top_usb_setup.utils import extract_file
+
+    files = {
+        "pi-top-usb-setup/pi-top_config.json": "{}",
+        "pi-top-usb-setup/updates/Packages": "Package: foo",
+        "pi-top-usb-setup/files/tmp/file.txt": "Hello, world!",
+    }
+    bundle = create_tar_gz(tmp_path / "pi-top-usb-setup.tar.gz", files)
+
+    extract_file(bundle, str(tmp_path / "destination"))
+
+    for name, content in files.items():
+        assert (tmp_path / "destination" / name).read_text() == content
+
+
+def test_extract_file_reads_archive_as_a_stream(tmp_path):
+    import tarfile
+
+    from pi_top_usb_setup.utils import extract_file
+
+    bundle = create_tar_gz(
+        tmp_path / "pi-top-usb-setup.tar.gz", {"pi-top-usb-setup/file.txt": "bla"}
+    )
+
+    with patch.object(tarfile.TarFile, "getmembers") as getmembers_mock:
+        extract_file(bundle, str(tmp_path / "destination"))
+        getmembers_mock.assert_not_called()
+
+
+def test_extract_file_reports_progress_based_on_compressed_bytes(tmp_path):
+    from pi_top_usb_setup.utils import extract_file
+
+    files = {
+        f"pi-top-usb-setup/file{i}.bin": os.urandom(256 * 1024).hex() for i in range(5)
+    }
+    bundle = create_tar_gz(tmp_path / "pi-top-usb-setup.tar.gz", files)
+
+    on_progress = Mock()
+    extract_file(bundle, str(tmp_path / "destination"), on_progress=on_progress)
+
+    progress = [c.args[0] for c in on_progress.call_args_list]
+    assert progress == sorted(progress)
+    assert progress[0] < 100.0
+    assert progress[-1] == 100.0
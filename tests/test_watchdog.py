@@ -0,0 +1,93 @@
+import os
+from time import monotonic
+
+
+def test_process_tree_includes_children():
+    from pi_top_usb_setup.watchdog import process_tree
+
+    tree = process_tree(os.getppid())
+
+    assert tree[0].pid == os.getppid()
+    assert os.getpid() in [info.pid for info in tree]
+    me = next(info for info in tree if info.pid == os.getpid())
+    assert me.ppid == os.getppid()
+    assert me.state == "R"
+    assert me.command
+
+
+def test_read_process_handles_names_with_spaces(tmp_path):
+    from pi_top_usb_setup.watchdog import read_process
+
+    (tmp_path / "42").mkdir()
+    (tmp_path / "42" / "stat").write_text(
+        "42 (dpkg (weird) name) S 7 42 42 0 -1 4194560 "
+        "100 0 0 0 11 22 33 44 20 0 1 0 100 0 0\n"
+    )
+    (tmp_path / "42" / "io").write_text("rchar: 100\nwchar: 50\nsyscr: 3\n")
+    (tmp_path / "42" / "wchan").write_text("pipe_read")
+    (tmp_path / "42" / "cmdline").write_text("dpkg\0--configure\0")
+
+    info = read_process(42, str(tmp_path))
+
+    assert info is not None
+    assert (info.pid, info.ppid, info.state) == (42, 7, "S")
+    assert info.cpu_ticks == 11 + 22 + 33 + 44
+    assert info.io_bytes == 150
+    assert info.wchan == "pipe_read"
+    assert info.command == ["dpkg", "--configure"]
+    assert read_process(43, str(tmp_path)) is None
+
+
+def test_watchdog_output_counts_as_progress(mocker):
+    from pi_top_usb_setup import watchdog
+
+    tree = [watchdog.ProcessInfo(pid=1, ppid=0, state="S", cpu_ticks=5)]
+    mocker.patch.object(watchdog, "process_tree", return_value=tree)
+    clock = mocker.patch.object(watchdog, "monotonic", return_value=0)
+    on_stall = mocker.Mock()
+    dog = watchdog.StallWatchdog(1, window=10, on_stall=on_stall)
+
+    assert not dog.check()
+    clock.return_value = 9
+    dog.notify()
+    clock.return_value = 18
+    assert not dog.check()
+
+    # CPU use too
+    clock.return_value = 25
+    tree[0].cpu_ticks += 1
+    assert not dog.check()
+    on_stall.assert_not_called()
+
+    clock.return_value = 35
+    assert dog.check()
+    on_stall.assert_called_once_with(tree)
+    assert dog.stalled
+
+
+def test_stalled_process_is_terminated():
+    from pi_top_usb_setup.utils import Process
+
+    process = Process("sleep 60", timeout=None, stall_timeout=1)
+    start = monotonic()
+    exit_code = process.run()
+
+    assert process.stalled
+    assert exit_code != 0
+    assert monotonic() - start < 30
+
+
+def test_busy_process_is_not_terminated():
+    from pi_top_usb_setup.utils import Process
+
+    lines = []
+    process = Process(
+        "sh -c 'for i in 1 2 3 4 5 6; do echo $i; sleep 0.5; done'",
+        timeout=None,
+        stall_timeout=1,
+        stdout_callback=lines.append,
+    )
+
+    assert process.run() == 0
+    assert not process.stalled
+    assert lines == [f"{i}\n" for i in range(1, 7)]